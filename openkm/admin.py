@@ -4,5 +4,11 @@ import openkm
 
 
 class OpenKMEventAdmin(admin.ModelAdmin):
-    pass
-admin.site.register(openkm.models.OpenKMEvent, OpenKMEventAdmin)
\ No newline at end of file
+    list_display = ('occured', 'operation', 'path', 'size', 'checksum')
+    list_filter = ('operation',)
+admin.site.register(openkm.models.OpenKMEvent, OpenKMEventAdmin)
+
+class OpenKMSyncJobAdmin(admin.ModelAdmin):
+    list_display = ('content_type', 'object_id', 'operation', 'state', 'attempts', 'run_after', 'claimed_by')
+    list_filter = ('state', 'operation')
+admin.site.register(openkm.models.OpenKMSyncJob, OpenKMSyncJobAdmin)
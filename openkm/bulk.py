@@ -0,0 +1,317 @@
+"""
+Bulk synchronisation of querysets of documents with OpenKM
+"""
+import time
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import ManyToManyField
+from django.db.models.fields import FieldDoesNotExist
+
+import cache, models, sync, utils
+
+logger = logging.getLogger(__name__)
+
+
+def close_connections(pool, workers):
+    """
+    Closes the database connection opened by each worker thread of a ThreadPool, which
+    Django would otherwise leave open for the life of the process.  Every worker takes
+    one task and waits for the others, so each thread closes its own connection.
+    :param workers: the number of threads in the pool
+    """
+    arrived = [0]
+    condition = threading.Condition()
+
+    def close(i):
+        connection.close()
+        with condition:
+            arrived[0] += 1
+            condition.notify_all()
+            while arrived[0] < workers:
+                condition.wait()
+    pool.map(close, range(workers), chunksize=1)
+
+
+class BulkSyncResult(object):
+    """
+    Per-document outcomes and throughput of a bulk sync
+    """
+    def __init__(self):
+        self.succeeded = []
+        self.skipped = []
+        self.failed = {}
+        self.started = time.time()
+        self.finished = None
+
+    def record(self, pk, error=None, skipped=False):
+        if error is not None:
+            self.failed[pk] = error
+        elif skipped:
+            self.skipped.append(pk)
+        else:
+            self.succeeded.append(pk)
+
+    def merge(self, other):
+        """ Adds the outcomes of another BulkSyncResult to this one """
+        self.succeeded.extend(other.succeeded)
+        self.skipped.extend(other.skipped)
+        self.failed.update(other.failed)
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def processed(self):
+        return len(self.succeeded) + len(self.skipped) + len(self.failed)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rate(self):
+        """ Documents processed per second """
+        return self.processed / self.elapsed if self.elapsed else 0.0
+
+    def __unicode__(self):
+        return u"%s succeeded, %s skipped, %s failed in %.1fs (%.2f documents/s)" % (
+            len(self.succeeded), len(self.skipped), len(self.failed), self.elapsed, self.rate)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class BulkDjangoToOpenKm(object):
+    """
+    Syncs a queryset of documents to OpenKM in chunks on a pool of worker threads.
+
+    Each worker reuses a single DjangoToOpenKm (and therefore its web service clients
+    and session) for every document it handles, m2m category data is prefetched per
+    chunk and categories are resolved from the shared category index.  Documents
+    whose sync fingerprint is unchanged are skipped without any web service call.
+
+    Give the run a checkpoint name to record, after each chunk, the pk up to which
+    every document has been synced, and pass resume=True to execute() to carry on
+    from there after an interruption.  The checkpoint never moves past a document
+    that failed, so resuming retries it.
+
+        bulk = BulkDjangoToOpenKm(FolderList, workers=8, checkpoint='assets')
+        result = bulk.execute(Asset.objects.all(), resume=True)
+    """
+    def __init__(self, folderlist_class, workers=4, chunk_size=100, taxonomy=False, custom=False, checkpoint=None):
+        """
+        :param folderlist_class: your OpenKmFolderList model class
+        :param workers: number of concurrent worker threads
+        :param chunk_size: number of documents loaded, prefetched and checkpointed at a time
+        :param taxonomy: passed to DjangoToOpenKm.execute
+        :param custom: use CustomDjangoToOpenKM (requires the modified OpenKM web services)
+        :param checkpoint: string name of the OpenKMSyncCheckpoint to record progress against
+        """
+        self.folderlist_class = folderlist_class
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.taxonomy = taxonomy
+        self.custom = custom
+        self.checkpoint = models.OpenKMSyncCheckpoint.get(checkpoint) if checkpoint else None
+        self._local = threading.local()
+
+    def execute(self, queryset, resume=False):
+        """
+        :param queryset: queryset of your OpenKmDocument model
+        :param resume: start after the pk recorded in the checkpoint
+        :returns BulkSyncResult
+        """
+        result = BulkSyncResult()
+        queryset = self.prefetch(queryset).order_by('pk')
+        last_pk = self.checkpoint.position if (resume and self.checkpoint) else None
+        if last_pk is not None:
+            logger.info('Resuming bulk sync after pk %s', last_pk)
+
+        # build the category index once up front rather than in the first worker
+        cache.get_category_index(self.folderlist_class)
+
+        # the pk up to which every document has been synced, held back at the first failure
+        completed_pk = last_pk
+        pool = ThreadPool(self.workers)
+        try:
+            while True:
+                chunk = self.get_chunk(queryset, last_pk)
+                if not chunk:
+                    break
+                for pk, error, skipped in pool.map(self.sync_document, chunk):
+                    result.record(pk, error, skipped)
+                    if not result.failed:
+                        completed_pk = pk
+                last_pk = chunk[-1].pk
+                if self.checkpoint and completed_pk is not None:
+                    self.checkpoint.advance(completed_pk)
+                logger.info('Bulk sync up to pk %s: %s', last_pk, result)
+            close_connections(pool, self.workers)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            result.finish()
+
+        if self.checkpoint and not result.failed:
+            self.checkpoint.reset()
+        logger.info('Bulk sync finished: %s', result)
+        return result
+
+    def get_chunk(self, queryset, last_pk):
+        if last_pk is not None:
+            queryset = queryset.filter(pk__gt=last_pk)
+        return list(queryset[:self.chunk_size])
+
+    def prefetch(self, queryset):
+        """ Prefetches the m2m managers that categories are read from """
+        names = [klass.__name__.lower() for klass in settings.OPENKM['categories'].keys()]
+        names = [name for name in names if hasattr(queryset.model, name)]
+        return queryset.prefetch_related(*names) if names else queryset
+
+    def get_syncer(self):
+        """ Returns the syncer belonging to the current worker thread """
+        syncer = getattr(self._local, 'syncer', None)
+        if syncer is None:
+            syncer = sync.CustomDjangoToOpenKM(asset=None) if self.custom else sync.DjangoToOpenKm()
+            self._local.syncer = syncer
+        return syncer
+
+    def sync_document(self, document):
+        """
+        :returns a tuple of (pk, error message or None, skipped)
+        """
+        try:
+            syncer = self.get_syncer()
+            if syncer.is_unchanged(document, self.folderlist_class):
+                return document.pk, None, True
+            if self.custom:
+                syncer.asset = document
+                if not syncer.execute(self.folderlist_class, taxonomy=self.taxonomy):
+                    return document.pk, 'Document could not be written to OpenKM', False
+            else:
+                syncer.run(document, self.folderlist_class, self.taxonomy)
+            return document.pk, None, False
+        except Exception, e:
+            logger.exception('Bulk sync of document %s failed', document.pk)
+            return document.pk, unicode(e) or e.__class__.__name__, False
+
+
+class BulkOpenKmToDjango(object):
+    """
+    Applies a batch of OpenKM documents to their Django counterparts.
+
+    Keywords and properties are read on a pool of worker threads, each reusing its
+    own OpenKmToDjango, then all the documents are saved in a single transaction.
+    Categories are resolved with one name__in query per related class and written
+    straight to the m2m through tables with bulk_create.
+
+        importer = BulkOpenKmToDjango(workers=8)
+        result = importer.execute([(asset, okm_document), ...])
+    """
+    def __init__(self, workers=4):
+        self.workers = workers
+
+    def execute(self, pairs):
+        """
+        :param pairs: iterable of (Django document, OpenKM document as returned by a webservice)
+        :returns BulkSyncResult
+        """
+        result = BulkSyncResult()
+        pairs = list(pairs)
+        if not pairs:
+            result.finish()
+            return result
+
+        pool = ThreadPool(self.workers)
+        try:
+            outcomes = pool.map(self.read_document, pairs)
+            close_connections(pool, self.workers)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        updated = []
+        for (document, okm_document), error in zip(pairs, outcomes):
+            if error is None:
+                updated.append((document, okm_document))
+            else:
+                result.record(document.pk, error)
+
+        try:
+            with transaction.commit_on_success():
+                for document, okm_document in updated:
+                    document.save()
+                self.write_categories(updated)
+        except Exception, e:
+            logger.exception('Bulk import of %s documents failed', len(updated))
+            for document, okm_document in updated:
+                result.record(document.pk, unicode(e) or e.__class__.__name__)
+        else:
+            for document, okm_document in updated:
+                result.record(document.pk)
+
+        result.finish()
+        logger.info('Bulk import finished: %s', result)
+        return result
+
+    def read_document(self, pair):
+        """
+        Sets the keywords and properties from OpenKM on the document, without saving it
+        :returns an error message, or None on success
+        """
+        document, okm_document = pair
+        try:
+            importer = utils.thread_local_instance(sync.OpenKmToDjango)
+            importer.keywords(document, okm_document, save=False)
+            importer.properties(document, save=False)
+        except Exception, e:
+            logger.exception('Bulk import of document %s failed', document.pk)
+            return unicode(e) or e.__class__.__name__
+
+    def write_categories(self, pairs):
+        """
+        Replaces the m2m rows of each related class found in the documents' categories
+        :param pairs: list of (Django document, OpenKM document)
+        """
+        by_class = {}
+        for document, okm_document in pairs:
+            if not hasattr(okm_document, 'categories'):
+                continue
+            for related_class, names in sync.OpenKmToDjango.get_category_bin(okm_document).items():
+                by_class.setdefault(related_class, []).append((document, names))
+
+        for related_class, entries in by_class.items():
+            all_names = set(name for document, names in entries for name in names)
+            objects = sync.OpenKmToDjango.get_related_objects(related_class, all_names)
+            field = self.get_m2m_field(type(entries[0][0]), related_class)
+            if field is None:
+                # not a forward m2m field, so fall back to the related managers
+                for document, names in entries:
+                    _set = getattr(document, related_class.__name__.lower())
+                    _set.clear()
+                    _set.add(*[objects[name] for name in set(names) if name in objects])
+                continue
+
+            through = field.rel.through
+            source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+            through.objects.filter(**{'%s__in' % source: [document.pk for document, names in entries]}).delete()
+            rows = [through(**{'%s_id' % source: document.pk, '%s_id' % target: objects[name].pk})
+                    for document, names in entries for name in set(names) if name in objects]
+            through.objects.bulk_create(rows)
+
+    def get_m2m_field(self, model, related_class):
+        try:
+            field = model._meta.get_field(related_class.__name__.lower())
+        except FieldDoesNotExist:
+            return None
+        return field if isinstance(field, ManyToManyField) else None
@@ -0,0 +1,306 @@
+"""
+Caches of data that rarely changes on OpenKM
+"""
+import json
+import time
+import threading
+import logging
+import collections
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache as django_cache
+from django.db.models.signals import post_save, post_delete
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+
+class CategoryRecord(object):
+    """
+    A lightweight stand-in for an OpenKmFolderList row
+    """
+    __slots__ = ('okm_uuid', 'okm_path', 'okm_category', 'okm_name')
+
+    def __init__(self, okm_uuid, okm_path, okm_category, okm_name):
+        self.okm_uuid = okm_uuid
+        self.okm_path = okm_path
+        self.okm_category = okm_category
+        self.okm_name = okm_name
+
+    def __unicode__(self):
+        return u"%s" % self.okm_path
+
+
+class CategoryIndex(object):
+    """
+    An in-memory index of the category folders stored in an OpenKmFolderList class,
+    keyed by (category root, normalised leaf name) and by path.
+
+    The index is built on first use, rebuilt after SyncFolderList runs and
+    invalidated whenever a row is saved or deleted.  As other processes can
+    update the folder list it is also rebuilt once it is older than
+    OPENKM['configuration']['CategoryIndexTimeout'] seconds (default 300).
+    """
+    def __init__(self, folderlist_class):
+        self.folderlist_class = folderlist_class
+        self.timeout = settings.OPENKM['configuration'].get('CategoryIndexTimeout', 300)
+        self._lock = threading.Lock()
+        # (leaves, paths, built), replaced as a whole so readers never see a mix of two builds
+        self._maps = None
+
+    def build(self):
+        """ Loads every folder in a single query and swaps in the new index """
+        leaves = {}
+        paths = {}
+        rows = self.folderlist_class.objects.values_list('okm_uuid', 'okm_path')
+        for uuid, path in rows.iterator():
+            category, name = utils.get_category_segments(path)
+            record = CategoryRecord(uuid, path, category, name)
+            leaves.setdefault((category, name), []).append(record)
+            paths.setdefault(path, []).append(record)
+
+        with self._lock:
+            self._maps = (leaves, paths, time.time())
+        logger.debug('Category index built for %s: %s folders', self.folderlist_class.__name__, len(paths))
+        return leaves, paths
+
+    def invalidate(self, **kwargs):
+        with self._lock:
+            self._maps = None
+
+    def _get_maps(self):
+        maps = self._maps
+        if maps is None or (self.timeout and time.time() - maps[2] > self.timeout):
+            return self.build()
+        return maps[0], maps[1]
+
+    def leaves(self, category, names):
+        """
+        :param category: string, the top level category name eg. 'Region'
+        :param names: list of leaf folder names eg. ['Latin-America', 'EMEA']
+        :returns a list of CategoryRecord objects
+        """
+        leaves, paths = self._get_maps()
+        records = []
+        for name in set(utils.normalise_category_leaf(name) for name in names):
+            records.extend(leaves.get((category, name), []))
+        return records
+
+    def leaf_uuids(self, category, names):
+        return [record.okm_uuid for record in self.leaves(category, names)]
+
+    def get_by_path(self, path):
+        """ :returns a list of CategoryRecord objects with the given path """
+        leaves, paths = self._get_maps()
+        return list(paths.get(path, []))
+
+
+_category_indexes = {}
+_category_indexes_lock = threading.Lock()
+
+
+def get_category_index(folderlist_class):
+    """
+    Returns the shared CategoryIndex for an OpenKmFolderList class
+    """
+    try:
+        return _category_indexes[folderlist_class]
+    except KeyError:
+        with _category_indexes_lock:
+            if folderlist_class not in _category_indexes:
+                index = CategoryIndex(folderlist_class)
+                uid = 'openkm.cache.category_index.%s' % folderlist_class.__name__
+                post_save.connect(index.invalidate, sender=folderlist_class, weak=False, dispatch_uid=uid)
+                post_delete.connect(index.invalidate, sender=folderlist_class, weak=False, dispatch_uid=uid)
+                _category_indexes[folderlist_class] = index
+        return _category_indexes[folderlist_class]
+
+
+def refresh_category_index(folderlist_class):
+    get_category_index(folderlist_class).build()
+
+
+class KnownFolders(object):
+    """
+    The set of folder paths known to exist on OpenKM, so that Taxonomy can skip
+    existence checks for them.
+
+    Paths are held in process memory and, when OPENKM['configuration']['FolderCache']
+    is True, also in the Django cache so that they are shared between processes.
+    Cached entries expire after FolderCacheTimeout seconds (default 3600).
+    """
+    KEY_PREFIX = 'openkm.folder.'
+
+    def __init__(self):
+        configuration = settings.OPENKM['configuration']
+        self.use_django_cache = configuration.get('FolderCache', False)
+        self.timeout = configuration.get('FolderCacheTimeout', 3600)
+        self._paths = set()
+        self._lock = threading.Lock()
+
+    def get_key(self, path):
+        return self.KEY_PREFIX + utils.path_hash(path)
+
+    def __contains__(self, path):
+        if path in self._paths:
+            return True
+        if self.use_django_cache and django_cache.get(self.get_key(path)):
+            with self._lock:
+                self._paths.add(path)
+            return True
+        return False
+
+    def add(self, *paths):
+        with self._lock:
+            self._paths.update(paths)
+        if self.use_django_cache:
+            django_cache.set_many(dict((self.get_key(path), True) for path in paths), self.timeout)
+
+    def discard(self, path):
+        with self._lock:
+            self._paths.discard(path)
+        if self.use_django_cache:
+            django_cache.delete(self.get_key(path))
+
+    def clear(self):
+        with self._lock:
+            self._paths.clear()
+
+
+known_folders = KnownFolders()
+
+
+class SearchCache(object):
+    """
+    A least recently used cache of search results, bounded by number of entries
+    and by their approximate size in bytes, with entries expiring after timeout
+    seconds.
+
+    Any write to OpenKM made through openkm.client clears the cache, see
+    invalidates_search.  Writes made by other processes are only picked up once
+    entries expire, so keep the timeout short.
+
+    Results are not copied: every caller of an equivalent search gets the same
+    SUDS objects, so they must be treated as read only.  Configured through
+    OPENKM['configuration']: SearchCache (default False) turns it on,
+    SearchCacheTimeout (default 60), SearchCacheMaxEntries (default 1000) and
+    SearchCacheMaxBytes (default 10MB) bound it.
+    """
+    def __init__(self, timeout=60, max_entries=1000, max_bytes=10485760):
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def make_key(cls, method, *args):
+        """
+        Normalises a query so that equivalent searches share an entry: whitespace is
+        collapsed, lists of keywords are sorted and SUDS query objects are reduced to
+        their non-empty fields
+        """
+        return json.dumps([method] + [cls.normalise(arg) for arg in args], sort_keys=True)
+
+    @classmethod
+    def normalise(cls, value):
+        if isinstance(value, basestring):
+            return utils.strip_runs_of_whitespace(value.strip())
+        if isinstance(value, (list, tuple, set)):
+            return sorted(set(cls.normalise(item) for item in value))
+        return utils.suds_to_dict(value)
+
+    def get(self, key):
+        """ :returns the cached result, shared with every other caller, or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            # move to the most recently used end
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+        return entry[2]
+
+    def set(self, key, result):
+        size = len(key) + len(json.dumps(utils.suds_to_dict(result)))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + self.timeout, size, result)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        expires, size, result = self._entries.pop(key)
+        self._bytes -= size
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_search_cache = None
+_search_cache_lock = threading.Lock()
+
+
+def get_search_cache():
+    """
+    Returns the shared SearchCache, or None if OPENKM['configuration']['SearchCache'] is not set
+    """
+    global _search_cache
+    configuration = settings.OPENKM['configuration']
+    if not configuration.get('SearchCache', False):
+        return None
+    if _search_cache is None:
+        with _search_cache_lock:
+            if _search_cache is None:
+                _search_cache = SearchCache(timeout=configuration.get('SearchCacheTimeout', 60),
+                                            max_entries=configuration.get('SearchCacheMaxEntries', 1000),
+                                            max_bytes=configuration.get('SearchCacheMaxBytes', 10485760))
+    return _search_cache
+
+
+def cached_search(fn):
+    """
+    Decorates a client.Search method so that its results are served from the SearchCache
+    """
+    def wrapped(self, *args, **kwargs):
+        search_cache = get_search_cache()
+        if search_cache is None or kwargs:
+            return fn(self, *args, **kwargs)
+        key = SearchCache.make_key(fn.__name__, *args)
+        result = search_cache.get(key)
+        if result is None:
+            result = fn(self, *args)
+            search_cache.set(key, result)
+        return result
+    return wraps(fn)(wrapped)
+
+
+def invalidates_search(fn):
+    """
+    Decorates a client method that writes to OpenKM, clearing the SearchCache once it has run
+    """
+    def wrapped(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if _search_cache is not None:
+                _search_cache.invalidate()
+    return wraps(fn)(wrapped)
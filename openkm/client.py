@@ -5,10 +5,10 @@ from functools import wraps
 
 from django.conf import settings
 
-from suds import WebFault
+from suds import WebFault, TypeNotFound
 from suds.client import Client
 
-import exceptions
+import cache, exceptions
 
 from openkm.services import OpenKMAuditService
 logging.getLogger('suds.client').setLevel(logging.INFO)
@@ -62,6 +62,21 @@ class BaseService(object):
         self.token = get_token() if start_session else None
         self.log_events = log_events if log_events else None
 
+    def create_object(self, name):
+        """
+        Creates a WSDL type by name, as client.factory.create does, but looks each name up
+        in the schema only once for the life of the client.  Clients should not be shared
+        between threads (see utils.thread_local_instance) so the cache is per thread too
+        :param name: string name of the WSDL type, eg. 'documentData.document.categories'
+        """
+        types = self.__dict__.setdefault('_types', {})
+        if name not in types:
+            type = self.client.factory.resolver.find(name)
+            if type is None:
+                raise TypeNotFound(name)
+            types[name] = type
+        return self.client.factory.builder.build(types[name])
+
 
 class Auth(BaseService):
     """ Methods related to authentication, granting and revoking privileges. """
@@ -110,6 +125,7 @@ class Document(BaseService):
         """
         return self.client.factory.create('document')
 
+    @cache.invalidates_search
     def create(self, doc, content):
         """
             Create a new document in the repository.
@@ -119,6 +135,7 @@ class Document(BaseService):
             """
         return self.service.create(token=self.token, doc=doc, content=content)
 
+    @cache.invalidates_search
     def delete(self, doc_path):
         """
         Removes a document from the repository and move it to the user trash.
@@ -146,6 +163,7 @@ class Document(BaseService):
         return self.service.unlock(token=self.token, docPath=doc_path)
 
 
+    @cache.invalidates_search
     def rename(self, doc_path, new_name):
         """
         Rename a document in the repository.
@@ -155,6 +173,7 @@ class Document(BaseService):
         """
         return self.service.rename(token=self.token, docPath=doc_path, newName=new_name)
 
+    @cache.invalidates_search
     def move(self, doc_path, new_name):
         """
         Move a document to another location in the repository.
@@ -173,6 +192,7 @@ class Document(BaseService):
         return self.service.getProperties(token=self.token, docPath=doc_path)
 
 
+    @cache.invalidates_search
     def set_properties(self, doc):
         """
         Set the properties of a repository document
@@ -182,6 +202,7 @@ class Document(BaseService):
         return self.service.setProperties(token=self.token, doc=doc)
 
 
+    @cache.invalidates_search
     def set_content(self, doc_path, content, comment=None):
         """
         Set document content in the repository.
@@ -244,6 +265,7 @@ class Document(BaseService):
     def force_unlock(self, doc_path):
         return self.service.forceUnlock(token=self.token, docPath=doc_path)
 
+    @cache.invalidates_search
     def checkin(self, doc_path, comment='Document update'):
         """
         Check in the document to create a new version.
@@ -262,6 +284,7 @@ class Document(BaseService):
         return self.service.getVersionHistory(token=self.token, docPath=doc_path)
 
 
+    @cache.invalidates_search
     def restore_version(self, doc_path, version_id):
         """
         Revert the document to an specific previous version.
@@ -300,42 +323,50 @@ class Document(BaseService):
     on the stable version.
     """
     def create_document_data_object(self):
-        return self.client.factory.create('documentData')
+        return self.create_object('documentData')
 
     def create_group_properties_object(self):
-        return self.client.factory.create('groupProperties')
+        return self.create_object('groupProperties')
 
     def create_group_property_object(self):
-        return self.client.factory.create('groupProperties.properties')
+        return self.create_object('groupProperties.properties')
 
     def create_category_folder_object(self, path):
-        folder = self.client.factory.create('documentData.document.categories')
+        folder = self.create_object('documentData.document.categories')
         folder.path = path
         return folder
 
-    def create_document(self, content, data):
+    @cache.invalidates_search
+    def create_document(self, content, data, checksum=None, size=None):
         """
         Custom web service to upload a document and all associated metadata in a single call
         :param content: file binary data
         :param data: an instance of 'documentData'.  Use the convenience method create_document_data() to
         instantiate an empty object
+        :param checksum, size: sha1 and size of the file as returned by utils.encode_file_for_transport,
+        recorded in the audit event
         """
         if not hasattr(self.service, 'createDocument'):
             raise AttributeError('createDocument is not available on your instance of OpenKM')
         if self.log_events:
-            OpenKMAuditService().record_update(self.token, content, occured=datetime.datetime.now())
+            OpenKMAuditService().record_create(self.token, content, occured=datetime.datetime.now(),
+                                               path=data.document.path, checksum=checksum, size=size)
         return self.service.createDocument(token=self.token, content=content, data=data)
 
-    def update_document(self, data):
+    @cache.invalidates_search
+    def update_document(self, data, checksum=None, size=None):
         """
         Custom web service to update a document and all associated metadata in a single call
         :param data: an instance of 'documentData'.  Use the convenience method create_document_data() to
         instantiate an empty object
+        :param checksum, size: sha1 and size of any content uploaded with set_content as part of the
+        update, recorded in the audit event
         """
         if not hasattr(self.service, 'updateDocument'):
             raise AttributeError('updateDocument is not available on your instance of OpenKM')
         if self.log_events:
-            OpenKMAuditService().record_create(self.token, data, occured=datetime.datetime.now())
+            OpenKMAuditService().record_update(self.token, data, occured=datetime.datetime.now(),
+                                               path=data.document.path, checksum=checksum, size=size)
         return self.service.updateDocument(token=self.token, data=data)
 
     def preview_document(self, uuid, format, version=None):
@@ -353,18 +384,22 @@ class Document(BaseService):
 class Search(BaseService):
     """Methods related to repository search. """
 
+    @cache.cached_search
     def by_content(self, words):
         """Search for documents using it indexed content.  """
         return self.service.findByContent(self.token, words)
 
+    @cache.cached_search
     def by_name(self, words):
         """Search for documents by document name. """
         return self.service.findByName(token=self.token, name=words)
 
+    @cache.cached_search
     def by_keyword(self, keywords):
         """Search for documents using it associated keywords. """
         return self.service.findByKeywords(token=self.token, keywords=keywords)
 
+    @cache.cached_search
     def by_statement(self, statement, type):
         """
         Example (returns all published documents):
@@ -372,14 +407,24 @@ class Search(BaseService):
         """
         return self.service.findByStatement(token=self.token, statement=statement, type=type)
 
+    @cache.cached_search
     def find(self, params):
         """ Performs a complex search by content, name and keywords (between others). """
         return self.service.find(token=self.token, params=params)
 
+    @cache.cached_search
+    def find_paginated(self, params, offset, limit):
+        """ As find, but returns a resultSet holding one page of results and the total number of matches """
+        return self.service.findPaginated(token=self.token, params=params, offset=offset, limit=limit)
+
+    def new_query_params(self):
+        return self.client.factory.create('queryParams')
+
     def get_keyword_map(self, filter):
         """ Return a Keyword map. This is a hash with the keywords and the occurrence.  """
         return self.service.getKeywordMap(token=self.token, filter=filter)
 
+    @cache.cached_search
     def get_categorised_documents(self, category_id):
         """ Get the documents within a category """
         return self.service.getCategorizedDocuments(token=self.token, categoryId=category_id)
@@ -438,12 +483,14 @@ class Folder(BaseService):
     def new(self):
         return self.client.factory.create('folder')
 
+    @cache.invalidates_search
     def create(self, folder_obj):
         return self.service.create(token=self.token, fld=folder_obj)
 
     def get_properties(self, folder_path):
         return self.service.getProperties(token=self.token, fldPath=folder_path)
 
+    @cache.invalidates_search
     def delete(self, folder_path):
         return self.service.delete(token=self.token, fldPath=folder_path)
 
@@ -452,9 +499,11 @@ class Folder(BaseService):
         for child in children.item:
             self.delete(child.path)
 
+    @cache.invalidates_search
     def rename(self, folder_path, new_folder_path):
         return self.service.rename(token=self.token, fldPath=folder_path, newName=new_folder_path)
 
+    @cache.invalidates_search
     def move(self, current_folder_path, destination_path):
         return self.service.move(token=self.token, fldPath=current_folder_path, dstPath=destination_path)
 
@@ -471,15 +520,19 @@ class Folder(BaseService):
 
 class Property(BaseService):
 
+    @cache.invalidates_search
     def add_category(self, node_path, category_uuid):
         return self.service.addCategory(self.token, nodePath=node_path, catId=category_uuid)
 
+    @cache.invalidates_search
     def remove_category(self, node_path, category_uuid):
         return self.service.removeCategory(token=self.token, nodePath=node_path, catId=category_uuid)
 
+    @cache.invalidates_search
     def add_keyword(self, node_path, keyword):
         return self.service.addKeyword(token=self.token, nodePath=node_path, keyword=keyword)
 
+    @cache.invalidates_search
     def remove_keyword(self, node_path, keyword):
         ''' Add a keyword to a document.  '''
         return self.service.removeKeyword(token=self.token, nodePath=node_path, keyword=keyword)
@@ -490,10 +543,12 @@ class PropertyGroup(BaseService):
     Methods related to Property Groups.
     '''
 
+    @cache.invalidates_search
     def add_group(self, node_path, group_name):
         ''' Add a property group to a document. '''
         return self.service.addGroup(token=self.token, nodePath=node_path, grpName=group_name)
 
+    @cache.invalidates_search
     def remove_group(self, node_path, group_name):
         return self.service.removeGroup(token=self.token, nodePath=node_path, grpName=group_name)
 
@@ -508,6 +563,7 @@ class PropertyGroup(BaseService):
     def get_properties(self, node_path, group_name):
         return self.service.getProperties(token=self.token, nodePath=node_path, grpName=group_name)
 
+    @cache.invalidates_search
     def set_properties(self, node_path, group_name, properties):
         return self.service.setProperties(token=self.token, nodePath=node_path, grpName=group_name, properties=properties)
 
@@ -2,7 +2,10 @@ import logging
 
 from django.conf import settings
 
-import client, utils
+import cache, client, exceptions, utils
+
+# QueryParams.domain value that limits a search to documents
+DOCUMENT_DOMAIN = 1
 
 
 class Session(object):
@@ -188,6 +191,29 @@ class DirectoryListing(object):
 
         return self.documents
 
+    def walk(self, path=None, workers=4):
+        """
+        Traverses the folders below path a level at a time, listing the folders of
+        each level concurrently
+        :returns a generator of (folder path, list of document objects) tuples
+        """
+        level = [path or self.get_root_path()]
+        while level:
+            next_level = []
+            for chunk in utils.chunks(level, workers * 4):
+                for folder_path, documents, folders in utils.concurrent_map(self.list_folder, chunk, workers):
+                    yield folder_path, documents
+                    next_level.extend(folder.path for folder in folders)
+            level = next_level
+
+    def list_folder(self, path):
+        """
+        :returns a tuple of (path, documents, child folders), using the calling thread's clients
+        """
+        documents = utils.get_array_items(utils.thread_local_instance(client.Document).get_children(path))
+        folders = utils.get_array_items(utils.thread_local_instance(client.Folder).get_children(path))
+        return path, documents, folders
+
     def traverse_folders(self, path):
         print path
         folders_temp = self.folder.get_children(path)
@@ -277,6 +303,11 @@ class Property(object):
     def get_property_groups_for_document(self, doc_path):
         return self.property_group.get_groups(doc_path)
 
+    def get_group_names(self, doc_path):
+        """ :returns the set of the names of the property groups a document has, in one call """
+        groups = self.get_property_groups_for_document(doc_path)
+        return set(group.name for group in utils.get_array_items(groups) if hasattr(group, 'name'))
+
     def get_document_properties_for_group(self, doc_path, group_name):
         return self.property_group.get_properties(doc_path, group_name)
 
@@ -285,25 +316,41 @@ class Property(object):
         :param properties: formElementComplexArray as returned by SUDs
         :new_values: dictionary of the form { label : value }
         """
-        for property in properties[0]:
-            if hasattr(property, 'label') and property.name in new_values.keys():
-                print('Found %s to %s' % (property.name, new_values[property.name]))
-                if hasattr(property, 'options'):
-                    try:
-                        value = new_values[property.name]['value']
-                        print 'Property name: ', property.name
-                        if property.name == 'okp:customProperties.languages':
-                            value = self.get_language_label(value)
-                        print 'Value: ', value
-                        property.options = self.update_options_list(property.options, new_values[property.name]['value'])
-                    except KeyError, e:
-                        print(e)
-                else:
-                    print('Updating %s to %s' % (property.name, new_values[property.name]))
-                    property.value = new_values[property.name]['value']
-
+        self.get_changed_properties(properties, new_values)
         return properties
 
+    def get_changed_properties(self, properties, new_values):
+        """
+        Sets the new values on the properties and returns only those whose value changed.
+        A list of values selects every matching option of a select; other properties
+        hold a single value, so only the first value of a list is used for them.
+        :param properties: formElementComplexArray as returned by SUDs
+        :new_values: dictionary of the form { name : { 'value' : value or list of values } }
+        :returns list of form elements
+        """
+        changed = []
+        for property in utils.get_array_items(properties):
+            if not hasattr(property, 'label') or property.name not in new_values:
+                continue
+            try:
+                value = new_values[property.name]['value']
+            except KeyError:
+                continue
+            values = list(value) if isinstance(value, (list, tuple)) else [value]
+            if hasattr(property, 'options'):
+                selected = set(option.value for option in property.options if option.selected)
+                if selected != set(self.option_matches(property.options, values)):
+                    property.options = self.update_options_list(property.options, values)
+                    changed.append(property)
+                continue
+            if len(values) > 1:
+                logging.warning('%s holds a single value, only the first of %s is sent', property.name, values)
+            value = values[0] if values else None
+            if getattr(property, 'value', None) != value:
+                property.value = value
+                changed.append(property)
+        return changed
+
     def get_language_label(self, language_code):
         map = (
             ('en', 'English'),
@@ -324,26 +371,217 @@ class Property(object):
         except:
             return 'English'
 
-    def update_options_list(self, options, new_value):
+    def get_selected_option_value(self, options):
         for option in options:
-            print option.label, '==', new_value
-            if (option.label == new_value) or (option.value == new_value):
-                option.selected = True
-                print('Updating option[%s].selected to True', option.label)
-            else:
-                option.selected = False
+            if option.selected:
+                return option.value
+
+    def option_matches(self, options, new_value):
+        """
+        :param new_value: a value or label, or a list of them
+        :returns the values of the options that new_value would select
+        """
+        values = new_value if isinstance(new_value, (list, tuple)) else [new_value]
+        return [option.value for option in options if option.label in values or option.value in values]
 
+    def update_options_list(self, options, new_value):
+        """ :param new_value: a value or label, or a list of them """
+        selected = self.option_matches(options, new_value)
+        for option in options:
+            option.selected = option.value in selected
         return options
 
     def update_document_on_openkm(self, node_path, group_name, properties):
-        self.property_group.remove_group(node_path, group_name)
+        """
+        Sets the properties of a group on a document, adding the group first if the
+        document does not have it yet
+        """
+        if not self.property_group.has_group(node_path, group_name):
+            self.property_group.add_group(node_path, group_name)
         return self.property_group.set_properties(node_path, group_name, properties)
 
+    def sync_group(self, node_path, group_name, new_values, has_group=None):
+        """
+        Brings a document's property group in line with new_values, sending only the
+        properties whose value has changed in a single set_properties call
+        :new_values: dictionary of the form { name : { 'value' : value or list of values } }
+        :param has_group: whether the document already has the group, eg. from get_group_names.
+        Looked up if not given; the group is added if the document does not have it.
+        :returns list of the changed form elements
+        """
+        if has_group is None:
+            has_group = self.property_group.has_group(node_path, group_name)
+        if not has_group:
+            self.property_group.add_group(node_path, group_name)
+        properties = self.property_group.get_properties(node_path, group_name)
+        changed = self.get_changed_properties(properties, new_values)
+        if changed:
+            setattr(properties, properties.__keylist__[0], changed)
+            self.property_group.set_properties(node_path, group_name, properties)
+        return changed
+
+
+class NodeRecord(object):
+    """
+    A lightweight, read only summary of a document returned by a search
+    """
+    __slots__ = ('uuid', 'path', 'name', 'author', 'mime_type', 'version', 'last_modified',
+                 'keywords', 'categories', 'score')
+
+    def __init__(self, uuid, path, author=None, mime_type=None, version=None, last_modified=None,
+                 keywords=(), categories=(), score=None):
+        self.uuid = uuid
+        self.path = path
+        self.name = path.split('/')[-1] if path else None
+        self.author = author
+        self.mime_type = mime_type
+        self.version = version
+        self.last_modified = last_modified
+        self.keywords = list(keywords)
+        self.categories = list(categories)
+        self.score = score
+
+    @classmethod
+    def from_result(cls, result):
+        """
+        :param result: a queryResult as returned by the web services, or a document
+        """
+        document = getattr(result, 'document', None) or result
+        return cls(uuid=getattr(document, 'uuid', None),
+                   path=getattr(document, 'path', None),
+                   author=getattr(document, 'author', None),
+                   mime_type=getattr(document, 'mimeType', None),
+                   version=getattr(getattr(document, 'actualVersion', None), 'name', None),
+                   last_modified=getattr(document, 'lastModified', None),
+                   keywords=getattr(document, 'keywords', None) or [],
+                   categories=[category.path for category in getattr(document, 'categories', None) or []],
+                   score=getattr(result, 'score', None))
+
+    def __unicode__(self):
+        return u"%s" % self.path
+
+    def __repr__(self):
+        return '<NodeRecord: %s>' % self.path
+
+
+class SearchResults(object):
+    """
+    A lazy sequence of search results, fetched a page at a time as they are used
+    and converted to NodeRecord objects only when accessed.
+
+    Supports len(), indexing, slicing and iteration, so it can be handed to a
+    django.core.paginator.Paginator or sliced in a template.  Random access keeps
+    the pages it has fetched; iteration does not, so walking a large result set
+    only ever holds one page.
+    """
+    def __init__(self, fetch_page, page_size=20, convert=None):
+        """
+        :param fetch_page: a callable taking (offset, limit) and returning (total, list of raw results)
+        :param convert: a callable turning a raw result into a NodeRecord, defaults to NodeRecord.from_result
+        """
+        self.fetch_page = fetch_page
+        self.page_size = page_size
+        self.convert = convert or NodeRecord.from_result
+        self._pages = {}
+        self._total = None
+
+    def _fetch(self, number):
+        total, results = self.fetch_page(number * self.page_size, self.page_size)
+        self._total = total
+        return results
+
+    def _get_page(self, number):
+        if number not in self._pages:
+            self._pages[number] = self._fetch(number)
+        return self._pages[number]
+
+    def count(self):
+        if self._total is None:
+            self._get_page(0)
+        return self._total
+
+    __len__ = count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(self.count()))]
+        if index < 0:
+            index += self.count()
+        page = self._get_page(index // self.page_size)
+        try:
+            return self.convert(page[index % self.page_size])
+        except IndexError:
+            raise IndexError('search result index out of range')
+
+    def __iter__(self):
+        number = 0
+        while True:
+            results = self._pages.get(number)
+            if results is None:
+                results = self._fetch(number)
+            for result in results:
+                yield self.convert(result)
+            number += 1
+            if not results or number * self.page_size >= self._total:
+                return
+
+    def page(self, number):
+        """
+        :param number: 1 based page number
+        :returns a list of NodeRecord objects
+        """
+        return [self.convert(result) for result in self._get_page(number - 1)]
+
 
 class SearchManager(client.Search):
+    """
+    Searches returning lazy SearchResults rather than the full result list
+
+        results = SearchManager().find_documents(keywords=['sales'], page_size=20)
+        len(results)       # total number of hits, fetches the first page only
+        results.page(2)    # NodeRecords for hits 21 to 40
+    """
     def __init__(self):
         super(SearchManager, self).__init__(class_name='Search')
 
+    def find_documents(self, content=None, name=None, keywords=None, path=None, mime_type=None, page_size=20):
+        """
+        :param keywords: list of strings, documents must have all of them
+        :returns SearchResults
+        """
+        params = self.new_query_params()
+        params.domain = DOCUMENT_DOMAIN
+        params.content = content
+        params.name = name
+        params.keywords = ' '.join(keywords) if keywords else None
+        params.path = path
+        params.mimeType = mime_type
+        return self.results(params, page_size)
+
+    def results(self, params, page_size=20):
+        """
+        :param params: queryParams, see client.Search.new_query_params
+        :returns SearchResults, each page being fetched with a findPaginated call
+        """
+        def fetch_page(offset, limit):
+            result_set = self.find_paginated(params, offset, limit)
+            return result_set.total, list(getattr(result_set, 'results', None) or [])
+        return SearchResults(fetch_page, page_size)
+
+    def statement_results(self, statement, type, page_size=20):
+        """
+        As client.Search.by_statement, but returns SearchResults.  There is no paginated
+        statement search, so every hit is fetched by the first access, but hits are still
+        only converted to NodeRecords as they are used
+        """
+        hits = []
+
+        def fetch_page(offset, limit):
+            if not hits:
+                hits.append(utils.get_array_items(self.by_statement(statement, type)))
+            return len(hits[0]), hits[0][offset:offset + limit]
+        return SearchResults(fetch_page, page_size)
+
 
 class Taxonomy(object):
     """
@@ -355,11 +593,22 @@ class Taxonomy(object):
     def __init__(self, folders=[]):
         # Remove the leading forward slash if present
         self.root_path = utils.remove_trailing_slash(settings.OPENKM['configuration']['UploadRoot'])
-        self.repository = RepositoryManager()
-        self.folder = FolderManager()
+        self._repository = None
+        self._folder = None
         if folders:
-            dependencies = self.generate_path_dependencies(folders)
-            self.build_path(dependencies)
+            self.build_path(folders)
+
+    @property
+    def repository(self):
+        if self._repository is None:
+            self._repository = utils.thread_local_instance(RepositoryManager)
+        return self._repository
+
+    @property
+    def folder(self):
+        if self._folder is None:
+            self._folder = utils.thread_local_instance(FolderManager)
+        return self._folder
 
     def generate_path(self, folders=None):
         """
@@ -408,26 +657,75 @@ class Taxonomy(object):
 
     def build_path(self, dependencies, root_path=settings.OPENKM['configuration']['UploadRoot']):
         """
-        Check if root folder exists, then dependencies in order. If they don't exist then they are
-        created.
-        :param dependencies: (list of strings) eg. ['sports', 'football']
+        Makes sure the root folder and each of the dependencies exist on OpenKM, creating
+        any that don't.  Folders already known to exist are not checked again.
+        :param dependencies: (list of strings) folder names eg. ['sports', 'football'], or
+        full paths as returned by generate_path_dependencies
         :param root_path: (string - optional) eg. '/okm:root/'
         """
-        folder = client.Folder()
-        repository = client.Repository()
-
-        current_path = ''
-        paths = [self._remove_trailing_slash(root_path)] + dependencies
+        current_path = self._remove_trailing_slash(root_path)
+        paths = [current_path]
+        for path in dependencies:
+            path = self._remove_trailing_slash(path)
+            if path.startswith('/'):
+                paths.append(path)
+            else:
+                current_path = current_path + '/' + path
+                paths.append(current_path)
 
         for path in paths:
-            current_path = path if not current_path else (current_path + '/' + path)
-            if not repository.has_node(current_path):
-                folder_obj = folder.new()
-                folder_obj.path = current_path
-                folder.create(folder_obj)
+            # parents are made sure of along with their deepest descendant
+            if not any(other.startswith(path + '/') for other in paths):
+                self.ensure_folder(path)
+
+    def ensure_folder(self, path):
+        """
+        Creates the folder at path and any missing parents.  Existence is checked from
+        the deepest folder upwards, so only the missing suffix of the path is created
+        """
+        if path in cache.known_folders:
+            return
+        segments = path.split('/')
+        missing = []
+        # stop below the repository root eg. /okm:root
+        while len(segments) > 2:
+            current_path = '/'.join(segments)
+            if current_path in cache.known_folders or self.repository.has_node(current_path):
+                break
+            missing.append(current_path)
+            segments.pop()
+        existing = '/'.join(segments)
+
+        for current_path in reversed(missing):
+            folder_obj = self.folder.new()
+            folder_obj.path = current_path
+            try:
+                self.folder.create(folder_obj)
+            except Exception, e:
+                # another process may have created it since we checked
+                if not is_item_exists_exception(e):
+                    raise
+        cache.known_folders.add(existing, *missing)
 
     def _remove_trailing_slash(self, string):
         return string[:-1] if string[-1:] == '/' else string
 
 
-
+def is_item_exists_exception(e):
+    """ True if e is OpenKM's ItemExistsException, raised directly or as a SUDS WebFault """
+    if isinstance(e, exceptions.ItemExistsException):
+        return True
+    try:
+        return exceptions.ExceptionParser().get_raised_exception_class_name(e) == 'ItemExistsException'
+    except (AttributeError, IndexError, TypeError):
+        return False
+
+
+def is_path_not_found_exception(e):
+    """ True if e is OpenKM's PathNotFoundException, raised directly or as a SUDS WebFault """
+    if isinstance(e, exceptions.PathNotFoundException):
+        return True
+    try:
+        return exceptions.ExceptionParser().get_raised_exception_class_name(e) == 'PathNotFoundException'
+    except (AttributeError, IndexError, TypeError):
+        return False
@@ -0,0 +1,149 @@
+"""
+Polling change feed of the documents modified on OpenKM
+"""
+import datetime
+import logging
+
+from django.conf import settings
+
+import bulk, client, facades, index, models
+
+logger = logging.getLogger(__name__)
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class ChangeFeed(object):
+    """
+    Pulls the documents modified on OpenKM since the last poll and applies them to
+    their Django counterparts with BulkOpenKmToDjango.
+
+    The time of the last completed poll is kept as the high-water mark in an
+    OpenKMSyncCheckpoint, and each poll searches from that mark less
+    OPENKM['configuration']['ChangeFeedOverlap'] seconds (default 60) to allow for
+    clock skew with the OpenKM server.  Results are fetched page_size documents at
+    a time, so memory use is bounded however many documents changed.  With no mark
+    recorded yet the first poll imports every document.  When the MetadataIndex is
+    enabled each page is indexed as well.
+
+    If documents fail to apply, the mark is only advanced as far as the earliest of
+    their modification dates, so that the next poll fetches them again.
+
+        feed = ChangeFeed(Asset, name='assets')
+        result = feed.poll()
+    """
+    def __init__(self, document_class, name='changes', page_size=100, workers=4, path=None):
+        """
+        :param document_class: your OpenKmDocument model class
+        :param name: string name of the OpenKMSyncCheckpoint holding the high-water mark
+        :param page_size: number of documents fetched and applied at a time
+        :param workers: passed to BulkOpenKmToDjango
+        :param path: optionally limit the feed to documents below this OpenKM folder
+        """
+        self.document_class = document_class
+        self.page_size = page_size
+        self.path = path
+        self.overlap = datetime.timedelta(seconds=settings.OPENKM['configuration'].get('ChangeFeedOverlap', 60))
+        self.checkpoint = models.OpenKMSyncCheckpoint.get('openkm.feed.%s' % name)
+        self.importer = bulk.BulkOpenKmToDjango(workers=workers)
+        self.search = None
+        # modification dates of the documents that failed to apply during the current poll
+        self.failed_modified = []
+
+    def get_high_water_mark(self):
+        if not self.checkpoint.position:
+            return None
+        return datetime.datetime.strptime(self.checkpoint.position, DATETIME_FORMAT)
+
+    def set_high_water_mark(self, mark):
+        self.checkpoint.advance(mark.strftime(DATETIME_FORMAT))
+
+    def poll(self):
+        """
+        Applies every document modified since the high-water mark, then advances the mark
+        :returns BulkSyncResult
+        """
+        until = datetime.datetime.now()
+        mark = self.get_high_water_mark()
+        since = mark - self.overlap if mark else None
+        logger.info('Polling OpenKM for documents modified since %s', since or 'the beginning')
+
+        self.failed_modified = []
+        result = bulk.BulkSyncResult()
+        for page in self.pages(since, until):
+            result.merge(self.apply(page))
+        result.finish()
+
+        # only advanced once every page is applied, as results are not ordered by date
+        next_mark = self.get_next_mark(until)
+        if next_mark is not None:
+            self.set_high_water_mark(next_mark)
+        else:
+            logger.warning('%s documents failed to apply, the high-water mark was not advanced', len(result.failed))
+        logger.info('Change feed poll finished: %s', result)
+        return result
+
+    def get_next_mark(self, until):
+        """
+        :returns until, or the earliest modification date of the documents that failed to
+        apply, or None if the date of a failed document is not known
+        """
+        if not self.failed_modified:
+            return until
+        for modified in self.failed_modified:
+            if not isinstance(modified, datetime.datetime) or modified.tzinfo is not None:
+                return None
+        return min([until] + self.failed_modified)
+
+    def pages(self, since, until):
+        """
+        Yields lists of OpenKM documents modified between since and until
+        """
+        params = self.get_query_params(since, until)
+        offset = 0
+        while True:
+            result_set = self.get_search().find_paginated(params, offset, self.page_size)
+            documents = [result.document for result in getattr(result_set, 'results', None) or []]
+            if not documents:
+                return
+            yield documents
+            offset += len(documents)
+            if offset >= result_set.total:
+                return
+
+    def get_search(self):
+        if self.search is None:
+            self.search = client.Search()
+        return self.search
+
+    def get_query_params(self, since, until):
+        params = self.get_search().new_query_params()
+        params.domain = facades.DOCUMENT_DOMAIN
+        params.lastModifiedFrom = since
+        params.lastModifiedTo = until
+        if self.path:
+            params.path = self.path
+        return params
+
+    def apply(self, okm_documents):
+        """
+        Matches a page of OpenKM documents to Django documents by uuid and imports them.
+        OpenKM documents with no Django counterpart are recorded as skipped
+        """
+        uuids = [okm_document.uuid for okm_document in okm_documents]
+        documents = dict((document.okm_uuid, document)
+                         for document in self.document_class._default_manager.filter(okm_uuid__in=uuids))
+        pairs = [(documents[okm_document.uuid], okm_document)
+                 for okm_document in okm_documents if okm_document.uuid in documents]
+
+        result = self.importer.execute(pairs)
+        self.failed_modified.extend(getattr(okm_document, 'lastModified', None)
+                                    for document, okm_document in pairs if document.pk in result.failed)
+        for okm_document in okm_documents:
+            if okm_document.uuid not in documents:
+                result.record(okm_document.uuid, skipped=True)
+
+        metadata_index = index.get_metadata_index()
+        if metadata_index is not None:
+            metadata_index.update_documents(okm_documents)
+        return result
@@ -0,0 +1,266 @@
+"""
+An optional local index of OpenKM document metadata, for searches that don't need OpenKM
+
+Set OPENKM['configuration']['MetadataIndex'] to the path of a SQLite file to enable it.
+"""
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+from django.conf import settings
+
+import client, facades, utils
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS documents (uuid TEXT PRIMARY KEY, path TEXT, name TEXT, author TEXT, '
+    'mime_type TEXT, version TEXT, last_modified TEXT, keywords TEXT, categories TEXT, indexed REAL)',
+    'CREATE INDEX IF NOT EXISTS documents_path ON documents (path)',
+    'CREATE TABLE IF NOT EXISTS keywords (uuid TEXT, keyword TEXT)',
+    'CREATE INDEX IF NOT EXISTS keywords_keyword ON keywords (keyword, uuid)',
+    'CREATE INDEX IF NOT EXISTS keywords_uuid ON keywords (uuid)',
+    'CREATE TABLE IF NOT EXISTS categories (uuid TEXT, path TEXT)',
+    'CREATE INDEX IF NOT EXISTS categories_path ON categories (path, uuid)',
+    'CREATE INDEX IF NOT EXISTS categories_uuid ON categories (uuid)',
+    'CREATE TABLE IF NOT EXISTS properties (uuid TEXT, name TEXT, value TEXT)',
+    'CREATE INDEX IF NOT EXISTS properties_value ON properties (name, value, uuid)',
+    'CREATE INDEX IF NOT EXISTS properties_uuid ON properties (uuid)',
+    'CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5 '
+    '(uuid UNINDEXED, name, keywords, categories, properties)',
+)
+
+CHILD_TABLES = ('keywords', 'categories', 'properties', 'documents_fts')
+
+
+def get_property_values(form_element):
+    """
+    :returns a list of the values of a property as returned by PropertyGroup.get_properties,
+    the selected options for a select
+    """
+    if getattr(form_element, 'options', None):
+        return [option.value for option in form_element.options if getattr(option, 'selected', False)]
+    value = getattr(form_element, 'value', None)
+    return [value] if value not in (None, '') else []
+
+
+def match_expression(text, column=None):
+    """
+    Builds an FTS5 query matching every word of text as a prefix, quoting each word
+    so that user input can't inject query syntax
+    """
+    terms = ' '.join('"%s"*' % word.replace('"', '""') for word in text.split())
+    return '%s : (%s)' % (column, terms) if column else terms
+
+
+class MetadataIndex(object):
+    """
+    Document metadata (name, keywords, categories and property values) held in a
+    SQLite database with an FTS5 full text index.
+
+    Each thread uses its own connection, and the database runs in WAL mode so that
+    searches are not blocked while the index is being updated.
+    """
+    def __init__(self, path, workers=4):
+        self.path = path
+        self.workers = workers
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        connection = self.get_connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+    def get_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            self._local.connection = connection
+        return connection
+
+    def update_documents(self, okm_documents, properties=True):
+        """
+        Indexes documents as returned by the web services, replacing what was held for them
+        :param properties: also fetch and index the documents' property groups (concurrently)
+        """
+        okm_documents = [document for document in okm_documents if getattr(document, 'uuid', None)]
+        if properties:
+            values = utils.concurrent_map(self.fetch_properties, okm_documents, self.workers)
+        else:
+            values = [None] * len(okm_documents)
+        indexed = time.time()
+        with self._write_lock:
+            connection = self.get_connection()
+            with connection:
+                for document, document_properties in zip(okm_documents, values):
+                    self._write(connection, document, document_properties, indexed)
+        return len(okm_documents)
+
+    def fetch_properties(self, okm_document):
+        """ :returns a list of (property name, value) tuples """
+        property_group = utils.thread_local_instance(client.PropertyGroup)
+        values = []
+        for group in utils.get_array_items(property_group.get_groups(okm_document.path)):
+            if not hasattr(group, 'name'):
+                continue
+            for element in utils.get_array_items(property_group.get_properties(okm_document.path, group.name)):
+                values.extend((element.name, value) for value in get_property_values(element))
+        return values
+
+    def _write(self, connection, document, properties, indexed):
+        record = facades.NodeRecord.from_result(document)
+        if properties is None:
+            # keep the properties already indexed
+            properties = connection.execute('SELECT name, value FROM properties WHERE uuid = ?',
+                                            (record.uuid,)).fetchall()
+        self._delete(connection, record.uuid)
+        connection.execute('INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+            record.uuid, record.path, record.name, record.author, record.mime_type, record.version,
+            utils.suds_to_dict(record.last_modified), json.dumps(record.keywords), json.dumps(record.categories),
+            indexed))
+        connection.executemany('INSERT INTO keywords VALUES (?, ?)', [(record.uuid, k) for k in record.keywords])
+        connection.executemany('INSERT INTO categories VALUES (?, ?)', [(record.uuid, c) for c in record.categories])
+        connection.executemany('INSERT INTO properties VALUES (?, ?, ?)',
+                               [(record.uuid, name, value) for name, value in properties])
+        connection.execute('INSERT INTO documents_fts VALUES (?, ?, ?, ?, ?)', (
+            record.uuid, record.name, ' '.join(record.keywords),
+            ' '.join(category.split('/')[-1] for category in record.categories),
+            ' '.join(value for name, value in properties)))
+
+    def _delete(self, connection, uuid):
+        connection.execute('DELETE FROM documents WHERE uuid = ?', (uuid,))
+        for table in CHILD_TABLES:
+            connection.execute('DELETE FROM %s WHERE uuid = ?' % table, (uuid,))
+
+    def remove(self, uuid):
+        with self._write_lock:
+            connection = self.get_connection()
+            with connection:
+                self._delete(connection, uuid)
+
+    def rebuild(self, path=None):
+        """
+        Indexes every document below path, then drops the documents that were not found
+        :returns the number of documents indexed
+        """
+        path = path or settings.OPENKM['configuration']['UploadRoot']
+        started = time.time()
+        count = 0
+        for folder_path, documents in facades.DirectoryListing().walk(path, self.workers):
+            count += self.update_documents(documents)
+        with self._write_lock:
+            connection = self.get_connection()
+            with connection:
+                stale = connection.execute('SELECT uuid FROM documents WHERE indexed < ? AND path LIKE ? ESCAPE ?',
+                                           (started, like_prefix(path), '\\')).fetchall()
+                for (uuid,) in stale:
+                    self._delete(connection, uuid)
+        logger.info('Metadata index rebuilt: %s documents indexed, %s removed', count, len(stale))
+        return count
+
+    def find_documents(self, name=None, keywords=None, path=None, mime_type=None, text=None,
+                       categories=None, properties=None, page_size=20):
+        """
+        :param name: words the document name must contain (as prefixes)
+        :param keywords: list of strings, documents must have all of them
+        :param path: only documents below this folder
+        :param text: words to match against the name, keywords, categories and property values
+        :param categories: list of category paths, documents must have all of them
+        :param properties: dict of { property name : value }
+        :returns facades.SearchResults of NodeRecord objects, ordered by path
+        """
+        where, parameters = [], []
+        if name:
+            where.append('d.uuid IN (SELECT uuid FROM documents_fts WHERE documents_fts MATCH ?)')
+            parameters.append(match_expression(name, 'name'))
+        if text:
+            where.append('d.uuid IN (SELECT uuid FROM documents_fts WHERE documents_fts MATCH ?)')
+            parameters.append(match_expression(text))
+        for keyword in keywords or []:
+            where.append('EXISTS (SELECT 1 FROM keywords k WHERE k.keyword = ? AND k.uuid = d.uuid)')
+            parameters.append(keyword)
+        for category in categories or []:
+            where.append('EXISTS (SELECT 1 FROM categories c WHERE c.path = ? AND c.uuid = d.uuid)')
+            parameters.append(category)
+        for property_name, value in (properties or {}).items():
+            where.append('EXISTS (SELECT 1 FROM properties p WHERE p.name = ? AND p.value = ? AND p.uuid = d.uuid)')
+            parameters.extend([property_name, value])
+        if path:
+            where.append("d.path LIKE ? ESCAPE '\\'")
+            parameters.append(like_prefix(path))
+        if mime_type:
+            where.append('d.mime_type = ?')
+            parameters.append(mime_type)
+        condition = ' WHERE ' + ' AND '.join(where) if where else ''
+
+        def fetch_page(offset, limit):
+            connection = self.get_connection()
+            total = connection.execute('SELECT COUNT(*) FROM documents d' + condition, parameters).fetchone()[0]
+            rows = connection.execute('SELECT uuid, path, author, mime_type, version, last_modified, keywords, '
+                                      'categories FROM documents d%s ORDER BY d.path LIMIT ? OFFSET ?' % condition,
+                                      parameters + [limit, offset]).fetchall()
+            return total, rows
+        return facades.SearchResults(fetch_page, page_size, convert=row_to_record)
+
+
+def row_to_record(row):
+    uuid, path, author, mime_type, version, last_modified, keywords, categories = row
+    return facades.NodeRecord(uuid, path, author=author, mime_type=mime_type, version=version,
+                              last_modified=last_modified, keywords=json.loads(keywords or '[]'),
+                              categories=json.loads(categories or '[]'))
+
+
+def like_prefix(path):
+    """ :returns a LIKE pattern matching the paths below path, with wildcards in path escaped """
+    path = utils.remove_trailing_slash(path)
+    return path.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '/%'
+
+
+class LocalSearchManager(object):
+    """
+    A SearchManager compatible search served from the MetadataIndex.  Searches by
+    content are passed on to OpenKM, as content is not indexed locally.
+    """
+    def __init__(self, index=None):
+        self.index = index or get_metadata_index()
+
+    def find_documents(self, content=None, name=None, keywords=None, path=None, mime_type=None, page_size=20,
+                       **criteria):
+        """
+        As facades.SearchManager.find_documents, also accepting the text, categories and
+        properties criteria of MetadataIndex.find_documents
+        """
+        if content:
+            return facades.SearchManager().find_documents(content=content, name=name, keywords=keywords, path=path,
+                                                          mime_type=mime_type, page_size=page_size)
+        return self.index.find_documents(name=name, keywords=keywords, path=path, mime_type=mime_type,
+                                         page_size=page_size, **criteria)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_metadata_index():
+    """
+    Returns the shared MetadataIndex, or None if OPENKM['configuration']['MetadataIndex'] is not set
+    """
+    global _index
+    path = settings.OPENKM['configuration'].get('MetadataIndex')
+    if not path:
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = MetadataIndex(path)
+    return _index
+
+
+def get_search_manager():
+    """
+    Returns a LocalSearchManager when the metadata index is enabled, otherwise a facades.SearchManager
+    """
+    return LocalSearchManager() if get_metadata_index() else facades.SearchManager()
@@ -0,0 +1,221 @@
+"""
+A database backed queue of documents waiting to be synced to OpenKM.
+
+Saving a document only enqueues an OpenKMSyncJob, the web service calls are
+made by the openkm_worker management command:
+
+    from openkm import jobs
+    jobs.enqueue(asset, FolderList)
+
+    python manage.py openkm_worker --processes=4
+"""
+import os
+import time
+import socket
+import logging
+import datetime
+import threading
+import traceback
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db.models import get_model
+from django.db.models.signals import post_save
+
+import models, sync
+
+logger = logging.getLogger(__name__)
+
+Job = models.OpenKMSyncJob
+
+_local = threading.local()
+
+
+def get_configuration(key, default):
+    return settings.OPENKM['configuration'].get(key, default)
+
+
+def enqueue(document, folderlist_class, operation=Job.DJANGO_TO_OPENKM, taxonomy=False, delay=None):
+    """
+    Queues a document to be synced, coalescing with any job already queued for it.
+
+    Jobs are debounced: the job runs delay seconds after the latest enqueue, so a
+    burst of saves results in a single sync of the document's final state.  A job
+    is never postponed more than SyncDebounceMaxSeconds after it was first queued.
+    :param document: an instance of your OpenKmDocument model
+    :param folderlist_class: your OpenKmFolderList model class
+    :param delay: seconds, defaults to OPENKM['configuration']['SyncDebounceSeconds'] or 0
+    :returns the OpenKMSyncJob
+    """
+    if delay is None:
+        delay = get_configuration('SyncDebounceSeconds', 0)
+    now = datetime.datetime.now()
+    run_after = now + datetime.timedelta(seconds=delay)
+    content_type = ContentType.objects.get_for_model(document)
+    lookup = dict(content_type=content_type, object_id=document.pk, operation=operation)
+    defaults = dict(folderlist='%s.%s' % (folderlist_class._meta.app_label, folderlist_class.__name__),
+                    taxonomy=taxonomy, state=Job.PENDING, run_after=run_after, pending_since=now)
+    while True:
+        job, created = Job.objects.get_or_create(defaults=defaults, **lookup)
+        if created:
+            return job
+        if job.state == Job.PENDING:
+            latest = job.pending_since + datetime.timedelta(seconds=get_configuration('SyncDebounceMaxSeconds', 300))
+            job.run_after = max(job.run_after, min(run_after, latest))
+            if Job.objects.filter(pk=job.pk, state=Job.PENDING).update(run_after=job.run_after):
+                return job
+        elif job.state == Job.RUNNING:
+            # run it again once the current run finishes, as it may have read stale values
+            if Job.objects.filter(pk=job.pk, state=Job.RUNNING).update(requeue=True):
+                return job
+        elif Job.objects.filter(pk=job.pk, state=job.state).update(attempts=0, last_error=None, **defaults):
+            return job
+        # the job changed state under us, so look again
+
+
+def is_running_job():
+    """ True while the current thread is running a sync job """
+    return getattr(_local, 'running', False)
+
+
+def connect(document_class, folderlist_class, operation=Job.DJANGO_TO_OPENKM, taxonomy=False):
+    """
+    Enqueues a job whenever an instance of document_class is saved, other than by
+    the worker recording the outcome of a sync
+    """
+    def handler(sender, instance, raw=False, **kwargs):
+        if not raw and not is_running_job():
+            enqueue(instance, folderlist_class, operation, taxonomy)
+    uid = 'openkm.jobs.%s.%s' % (document_class.__name__, operation)
+    post_save.connect(handler, sender=document_class, weak=False, dispatch_uid=uid)
+
+
+def get_backoff(attempts):
+    """ Seconds to wait before retrying a job that has failed attempts times """
+    base = get_configuration('SyncJobBackoff', 30)
+    return min(base * 2 ** (attempts - 1), get_configuration('SyncJobMaxBackoff', 3600))
+
+
+def release_stale_jobs():
+    """
+    Returns running jobs claimed more than SyncJobTimeout seconds ago, whose
+    worker has presumably died, to the queue
+    :returns the number of jobs released
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=get_configuration('SyncJobTimeout', 3600))
+    return Job.objects.filter(state=Job.RUNNING, claimed_at__lt=cutoff).update(
+        state=Job.PENDING, claimed_by=None, claimed_at=None)
+
+
+class SyncWorker(object):
+    """
+    Claims due jobs and runs them, one syncer being reused for every job.
+
+    Jobs are claimed with a conditional update, so any number of workers can
+    share the queue.  A failed job is retried with exponential backoff until
+    it has been attempted OPENKM['configuration']['SyncJobMaxAttempts'] times
+    (default 5), after which it is left in the failed state.
+    """
+    def __init__(self, batch_size=10, name=None):
+        self.batch_size = batch_size
+        self.name = name or '%s:%s' % (socket.gethostname(), os.getpid())
+        self.max_attempts = get_configuration('SyncJobMaxAttempts', 5)
+        self._syncers = {}
+
+    def claim(self):
+        """ :returns a list of the jobs this worker has claimed """
+        now = datetime.datetime.now()
+        due = Job.objects.filter(state=Job.PENDING, run_after__lte=now).order_by('run_after')
+        claimed = []
+        for pk in due.values_list('pk', flat=True)[:self.batch_size]:
+            if Job.objects.filter(pk=pk, state=Job.PENDING).update(
+                    state=Job.RUNNING, requeue=False, claimed_by=self.name, claimed_at=now):
+                claimed.append(pk)
+        return list(Job.objects.filter(pk__in=claimed).select_related('content_type'))
+
+    def run_once(self):
+        """
+        Runs one batch of due jobs
+        :returns the number of jobs run
+        """
+        jobs = self.claim()
+        for job in jobs:
+            error = self.run_job(job)
+            if error is None:
+                self.complete(job)
+            else:
+                self.fail(job, error)
+        return len(jobs)
+
+    def run(self, sleep=5, stop=None):
+        """
+        Runs jobs until stop() returns True, sleeping when the queue is empty
+        """
+        while not (stop and stop()):
+            release_stale_jobs()
+            if not self.run_once():
+                time.sleep(sleep)
+
+    def get_syncer(self, operation):
+        if operation not in self._syncers:
+            if operation == Job.CUSTOM_DJANGO_TO_OPENKM:
+                self._syncers[operation] = sync.CustomDjangoToOpenKM(asset=None)
+            else:
+                self._syncers[operation] = sync.DjangoToOpenKm()
+        return self._syncers[operation]
+
+    def run_job(self, job):
+        """
+        :returns an error message, or None on success
+        """
+        _local.running = True
+        try:
+            model = job.content_type.model_class()
+            try:
+                document = model._default_manager.get(pk=job.object_id)
+            except model.DoesNotExist:
+                logger.info('The document of %s no longer exists, dropping the job', job)
+                return None
+            folderlist_class = get_model(*job.folderlist.split('.', 1))
+            syncer = self.get_syncer(job.operation)
+            if job.operation == Job.CUSTOM_DJANGO_TO_OPENKM:
+                syncer.asset = document
+                if not syncer.execute(folderlist_class, taxonomy=job.taxonomy):
+                    return 'Document could not be written to OpenKM'
+            else:
+                syncer.run(document, folderlist_class, job.taxonomy)
+            return None
+        except Exception, e:
+            logger.exception('Sync job %s failed', job)
+            return traceback.format_exc() if not unicode(e) else unicode(e)
+        finally:
+            _local.running = False
+
+    def complete(self, job):
+        # a job enqueued again while it was running goes back to the queue
+        if not Job.objects.filter(pk=job.pk, requeue=False).update(state=Job.DONE):
+            now = datetime.datetime.now()
+            run_after = now + datetime.timedelta(seconds=get_configuration('SyncDebounceSeconds', 0))
+            Job.objects.filter(pk=job.pk).update(
+                state=Job.PENDING, requeue=False, attempts=0, last_error=None, claimed_by=None, claimed_at=None,
+                run_after=run_after, pending_since=now)
+            return
+        Job.objects.filter(pk=job.pk, state=Job.DONE).delete()
+
+    def fail(self, job, error):
+        attempts = job.attempts + 1
+        values = dict(attempts=attempts, last_error=error, claimed_by=None, claimed_at=None)
+        if attempts >= self.max_attempts:
+            logger.error('Giving up on %s after %s attempts: %s', job, attempts, error)
+            Job.objects.filter(pk=job.pk, requeue=False).update(state=Job.FAILED, **values)
+        values['run_after'] = datetime.datetime.now() + datetime.timedelta(seconds=get_backoff(attempts))
+        Job.objects.filter(pk=job.pk, state=Job.RUNNING).update(state=Job.PENDING, requeue=False, **values)
+
+
+def run_worker(batch_size=10, sleep=5):
+    """
+    Entry point for worker processes.  Connections are not shared with the parent
+    """
+    connection.close()
+    SyncWorker(batch_size=batch_size).run(sleep=sleep)
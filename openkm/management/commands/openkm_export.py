@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from openkm import transfer
+
+
+class Command(BaseCommand):
+    args = '<okm_path> <directory>'
+    help = 'Mirrors an OpenKM folder to a local directory, skipping documents already exported'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=4,
+                    help='Number of concurrent downloads and folder listings'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=100,
+                    help='Number of documents downloaded at a time'),
+        make_option('--manifest', dest='manifest', default=None,
+                    help='Manifest file recording the exported documents (defaults to <directory>/.openkm_export)'),
+        make_option('--no-metadata', action='store_false', dest='metadata', default=True,
+                    help='Do not write .metadata.json sidecar files'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Usage: openkm_export %s' % self.args)
+        exporter = transfer.SubtreeExporter(args[0], args[1], workers=options['workers'],
+                                            chunk_size=options['chunk_size'], manifest=options['manifest'],
+                                            metadata=options['metadata'])
+        result = exporter.execute()
+        self.stdout.write('%s\n' % result)
+        for path, error in sorted(result.failed.items()):
+            self.stderr.write('%s: %s\n' % (path, error))
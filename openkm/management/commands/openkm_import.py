@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from openkm import transfer
+
+
+class Command(BaseCommand):
+    args = '<directory> <okm_path>'
+    help = 'Uploads a local directory tree to an OpenKM folder, skipping files already imported'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=4,
+                    help='Number of concurrent uploads'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=100,
+                    help='Number of files queued for upload at a time'),
+        make_option('--manifest', dest='manifest', default=None,
+                    help='Manifest file recording the imported files (defaults to <directory>/.openkm_import)'),
+        make_option('--overwrite', action='store_true', dest='overwrite', default=False,
+                    help='Replace the content of documents that already exist on OpenKM'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Usage: openkm_import %s' % self.args)
+        importer = transfer.DirectoryImporter(args[0], args[1], workers=options['workers'],
+                                              chunk_size=options['chunk_size'], manifest=options['manifest'],
+                                              overwrite=options['overwrite'])
+        result = importer.execute()
+        self.stdout.write('%s\n' % result)
+        for path, error in sorted(result.failed.items()):
+            self.stderr.write('%s: %s\n' % (path, error))
@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from openkm import index
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the local metadata index from the documents on OpenKM'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--path', dest='path', default=None,
+                    help='OpenKM folder to index (defaults to the UploadRoot)'),
+        make_option('--workers', type='int', dest='workers', default=4,
+                    help='Number of concurrent folder listings and property lookups'),
+    )
+
+    def handle(self, *args, **options):
+        metadata_index = index.get_metadata_index()
+        if metadata_index is None:
+            raise CommandError("Set OPENKM['configuration']['MetadataIndex'] to the path of the index file")
+        metadata_index.workers = options['workers']
+        count = metadata_index.rebuild(options['path'])
+        self.stdout.write('%s documents indexed\n' % count)
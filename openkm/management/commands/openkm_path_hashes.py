@@ -0,0 +1,47 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import get_model
+
+from openkm import utils
+
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName app_label.ModelName ...>'
+    help = 'Fills in okm_path_hash on rows saved before the column existed, so that filter_by_path finds them'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of rows updated per transaction'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Give the OpenKmDocument and OpenKmFolderList models as app_label.ModelName')
+        for label in args:
+            model_class = get_model(*label.split('.', 1)) if '.' in label else None
+            if model_class is None:
+                raise CommandError('Unknown model %s' % label)
+            updated = fill_path_hashes(model_class, options['batch_size'])
+            self.stdout.write('%s: okm_path_hash set on %s rows\n' % (label, updated))
+
+
+def fill_path_hashes(model_class, batch_size=1000):
+    """
+    Sets okm_path_hash on the rows that have an okm_path but no hash, batch_size
+    rows per transaction.  Rows are updated with update() so no save signals fire
+    :param model_class: a model extending OpenKmMetadata
+    :returns the number of rows updated
+    """
+    manager = model_class._default_manager
+    missing = manager.filter(okm_path_hash__isnull=True, okm_path__isnull=False).order_by('pk')
+    updated = 0
+    while True:
+        rows = list(missing.values_list('pk', 'okm_path')[:batch_size])
+        if not rows:
+            return updated
+        with transaction.commit_on_success():
+            for pk, path in rows:
+                manager.filter(pk=pk).update(okm_path_hash=utils.path_hash(path))
+        updated += len(rows)
@@ -0,0 +1,47 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from openkm import feed
+
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName>'
+    help = 'Applies the documents modified on OpenKM since the last poll to the given OpenKmDocument model'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--name', dest='name', default=None,
+                    help='Name of the feed checkpoint (defaults to the model label)'),
+        make_option('--interval', type='int', dest='interval', default=0,
+                    help='Keep polling every INTERVAL seconds (polls once if 0)'),
+        make_option('--page-size', type='int', dest='page_size', default=100,
+                    help='Number of documents fetched from OpenKM at a time'),
+        make_option('--workers', type='int', dest='workers', default=4,
+                    help='Number of concurrent worker threads'),
+        make_option('--path', dest='path', default=None,
+                    help='Only poll documents below this OpenKM folder'),
+        make_option('--reset', action='store_true', dest='reset', default=False,
+                    help='Forget the high-water mark and import every document'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or '.' not in args[0]:
+            raise CommandError('Give the document model as app_label.ModelName')
+        document_class = get_model(*args[0].split('.', 1))
+        if document_class is None:
+            raise CommandError('Unknown model %s' % args[0])
+
+        change_feed = feed.ChangeFeed(document_class, name=options['name'] or args[0].lower(),
+                                      page_size=options['page_size'], workers=options['workers'],
+                                      path=options['path'])
+        if options['reset']:
+            change_feed.checkpoint.reset()
+
+        while True:
+            result = change_feed.poll()
+            self.stdout.write('%s\n' % result)
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
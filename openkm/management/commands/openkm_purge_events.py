@@ -0,0 +1,43 @@
+import datetime
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from openkm import models
+
+
+class Command(BaseCommand):
+    help = 'Deletes OpenKM audit events older than the retention period, in batches'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=None,
+                    help='Retention period in days (defaults to OPENKM AuditRetentionDays, or 90)'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of events deleted per query'),
+    )
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days is None:
+            days = settings.OPENKM['configuration'].get('AuditRetentionDays', 90)
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+        deleted = purge_events(cutoff, options['batch_size'])
+        self.stdout.write('%s events recorded before %s deleted\n' % (deleted, cutoff))
+
+
+def purge_events(cutoff, batch_size=1000):
+    """
+    Deletes events that occured before cutoff, batch_size rows per query, so the
+    purge never holds long locks on the events table
+    :param cutoff: datetime.datetime
+    :returns the number of events deleted
+    """
+    expired = models.OpenKMEvent.objects.filter(occured__lt=cutoff).order_by('pk')
+    deleted = 0
+    while True:
+        pks = list(expired.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        models.OpenKMEvent.objects.filter(pk__in=pks).delete()
+        deleted += len(pks)
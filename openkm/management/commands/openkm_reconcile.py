@@ -0,0 +1,41 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from openkm import reconcile
+
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName>'
+    help = 'Reports (and optionally repairs) documents whose OpenKM uuid, path or version no longer match OpenKM'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--path', dest='path', default=None,
+                    help='OpenKM folder to traverse (defaults to the UploadRoot)'),
+        make_option('--workers', type='int', dest='workers', default=4,
+                    help='Number of concurrent folder listings and lookups'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                    help='Number of rows compared at a time'),
+        make_option('--repair', action='store_true', dest='repair', default=False,
+                    help='Update moved and stale rows, and clear the OpenKM metadata of missing ones'),
+        make_option('--verbose-report', action='store_true', dest='verbose_report', default=False,
+                    help='List the pks of the rows found in each state'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or '.' not in args[0]:
+            raise CommandError('Give the document model as app_label.ModelName')
+        document_class = get_model(*args[0].split('.', 1))
+        if document_class is None:
+            raise CommandError('Unknown model %s' % args[0])
+
+        reconciler = reconcile.Reconciler(document_class, path=options['path'], workers=options['workers'],
+                                          chunk_size=options['chunk_size'], repair=options['repair'])
+        result = reconciler.execute()
+        self.stdout.write('%s\n' % result)
+        if options['verbose_report']:
+            for state in ('missing', 'moved', 'stale', 'unsynced', 'unknown'):
+                self.stdout.write('%s: %s\n' % (state, ', '.join(str(pk) for pk in getattr(result, state))))
+            for path in result.orphaned_paths:
+                self.stdout.write('on OpenKM only: %s\n' % path)
@@ -0,0 +1,45 @@
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from openkm import jobs
+
+
+class Command(BaseCommand):
+    help = 'Runs the queued OpenKM sync jobs in one or more worker processes'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=1,
+                    help='Number of worker processes'),
+        make_option('--batch-size', type='int', dest='batch_size', default=10,
+                    help='Number of jobs claimed by a worker at a time'),
+        make_option('--sleep', type='float', dest='sleep', default=5,
+                    help='Seconds a worker waits before polling an empty queue again'),
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Run the jobs that are due in this process, then exit'),
+    )
+
+    def handle(self, *args, **options):
+        if options['once']:
+            worker = jobs.SyncWorker(batch_size=options['batch_size'])
+            total = 0
+            while True:
+                count = worker.run_once()
+                if not count:
+                    break
+                total += count
+            self.stdout.write('%s jobs run\n' % total)
+            return
+
+        processes = [multiprocessing.Process(target=jobs.run_worker, name='openkm-worker-%s' % i,
+                                             args=(options['batch_size'], options['sleep']))
+                     for i in range(options['processes'])]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
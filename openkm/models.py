@@ -1,7 +1,9 @@
+import base64
 import datetime
+import json
 import operator
 import logging
-import pickle
+import zlib
 
 from django.db import models
 from django.conf import settings
@@ -10,6 +12,32 @@ from django.template.defaultfilters import filesizeformat
 from django.forms import forms
 
 import openkm
+from openkm import utils
+
+
+class OpenKmMetadataManager(models.Manager):
+
+    def get_by_uuid(self, uuid):
+        """
+        :param uuid: string OpenKM node uuid
+        :returns model instance, raises DoesNotExist if not found
+        """
+        return self.get_query_set().get(okm_uuid=uuid)
+
+    def filter_by_uuids(self, uuids):
+        return self.get_query_set().filter(okm_uuid__in=uuids)
+
+    def filter_by_path(self, path):
+        """
+        Looks up a path through the indexed okm_path_hash column, comparing the full
+        path as well to rule out hash collisions
+        :param path: string OpenKM node path
+        :returns queryset
+        """
+        return self.get_query_set().filter(okm_path_hash=utils.path_hash(path), okm_path=path)
+
+    def get_by_path(self, path):
+        return self.filter_by_path(path).get()
 
 
 class OpenKmMetadata(models.Model):
@@ -19,16 +47,24 @@ class OpenKmMetadata(models.Model):
     okm_author = models.CharField(max_length=255, blank=True, null=True)
     okm_created = models.DateTimeField(auto_now_add=True)
     okm_path = models.CharField(max_length=1000, blank=True, null=True)
+    # okm_path is too long to index on most databases, so lookups go through its hash
+    okm_path_hash = models.CharField(max_length=40, blank=True, null=True, db_index=True, editable=False)
     okm_permissions = models.CharField(max_length=255, blank=True, null=True)
     okm_subscribed = models.CharField(max_length=255, blank=True, null=True)
-    okm_uuid = models.CharField(max_length=255, blank=True, null=True)
+    okm_uuid = models.CharField(max_length=255, blank=True, null=True, db_index=True)
     okm_latest_version = models.CharField(max_length=255, default='None')
 
+    objects = OpenKmMetadataManager()
+
     class Meta:
         abstract = True
 
+    def save(self, *args, **kwargs):
+        self.okm_path_hash = utils.path_hash(self.okm_path)
+        super(OpenKmMetadata, self).save(*args, **kwargs)
+
 
-class OpenKmFolderListManager(models.Manager):
+class OpenKmFolderListManager(OpenKmMetadataManager):
 
     def custom_path_query(self, and_predicates, or_predicates):
         """
@@ -55,7 +91,15 @@ class OpenKmFolderListManager(models.Manager):
         :param or_predicates: list of OR query arguments eg. ['Latin-America', 'EMEA']
         :returns queryset
         """
-        
+        if self._is_category_query(and_predicates) and or_predicates and self.has_path_segments():
+            return self.category_leaves(and_predicates[1], or_predicates)
+        return self.get_path_queryset(and_predicates, or_predicates)
+
+    def get_path_queryset(self, and_predicates, or_predicates):
+        """
+        As get_custom_queryset, always matching substrings of okm_path
+        :returns queryset
+        """
         if and_predicates:
             and_predicates_list = self._build_and_predicate_list(and_predicates)
             and_list = [Q(x) for x in and_predicates_list]
@@ -86,6 +130,35 @@ class OpenKmFolderListManager(models.Manager):
         except Exception, e:
             logging.debug(e)
 
+    def category_leaves(self, category, leaves):
+        """
+        Indexed equivalent of custom_path_query for the common case of
+        "category X with leaf in {a, b, c}".  Like custom_path_query it ignores case,
+        but leaves are matched by their whole name rather than as substrings of the path.
+        :param category: string, the top level category name eg. 'Region'
+        :param leaves: list of leaf folder names eg. ['Latin-America', 'EMEA']
+        :returns queryset
+        """
+        names = [utils.normalise_category_leaf(leaf) for leaf in leaves]
+        return super(OpenKmFolderListManager, self).get_query_set().filter(okm_name__in=names,
+                                                                           okm_category__iexact=category)
+
+    def has_path_segments(self):
+        """
+        False while rows saved before okm_category and okm_name existed have not had them
+        filled in, in which case category queries fall back to matching okm_path
+        """
+        return not self.get_query_set().filter(okm_path__isnull=False, okm_category__isnull=True).exists()
+
+    def category_leaf_uuids(self, category, leaves):
+        """
+        :returns a list of uuids for the given category and leaf names
+        """
+        return list(self.category_leaves(category, leaves).values_list('okm_uuid', flat=True))
+
+    def _is_category_query(self, and_predicates):
+        return bool(and_predicates) and len(and_predicates) == 2 and and_predicates[0] == 'categories'
+
     def _build_and_predicate_list(self, arguments):
         args = []
         for argument in arguments:
@@ -101,12 +174,26 @@ class OpenKmFolderListManager(models.Manager):
 
 class OpenKmFolderList(OpenKmMetadata):
     okm_has_childs = models.CharField(max_length=255, blank=True, null=True)
+    # materialised from okm_path so category lookups can use indexed equality
+    okm_category = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+    okm_name = models.CharField(max_length=255, blank=True, null=True, db_index=True)
 
     objects = OpenKmFolderListManager()
 
     def __unicode__(self):
         return "%s" % self.okm_path
 
+    def save(self, *args, **kwargs):
+        self.set_path_segments()
+        super(OpenKmFolderList, self).save(*args, **kwargs)
+
+    def set_path_segments(self):
+        """
+        Sets okm_category and okm_name from okm_path
+        eg. /okm:categories/Region/EMEA -> ('Region', 'emea')
+        """
+        self.okm_category, self.okm_name = utils.get_category_segments(self.okm_path)
+
     class Meta:
         abstract = True
         verbose_name = 'OpenKM Folder List'
@@ -135,6 +222,8 @@ class OpenKmFileField(models.FileField):
 class OpenKmDocument(OpenKmMetadata):
 
     okm_filename = models.CharField(max_length=255, blank=True, null=True)
+    # digests of what was last synced to OpenKM, see openkm.sync.SyncFingerprint
+    okm_sync_fingerprint = models.CharField(max_length=255, blank=True, null=True, editable=False)
     # file = OpenKmFileField(max_length=255, max_upload_size=104857600, upload_to='resources/%Y/%m/%d/', blank=True, null=True, help_text="Upload a file from your local machine")
 
     def upload_to_openkm(self, file_obj, taxonomy=[]):
@@ -181,17 +270,128 @@ class OpenKmDocument(OpenKmMetadata):
         return date.strftime('%Y%m%d%H%M%S')
 
 
+class OpenKMSyncCheckpoint(models.Model):
+    """
+    Records how far a named long running sync has got, so that it can be resumed
+    """
+    name = models.CharField(max_length=255, unique=True)
+    position = models.CharField(max_length=255, blank=True, null=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return "%s: %s" % (self.name, self.position)
+
+    @classmethod
+    def get(cls, name):
+        checkpoint, created = cls.objects.get_or_create(name=name)
+        return checkpoint
+
+    def advance(self, position):
+        self.position = position
+        self.save()
+
+    def reset(self):
+        self.advance(None)
+
+
+class OpenKMSyncJob(models.Model):
+    """
+    A document waiting to be synced by the openkm_worker command, see openkm.jobs.
+
+    There is at most one job per document and operation.  Enqueuing a document
+    that already has a pending job only postpones it by the debounce window, and
+    enqueuing one whose job is running sets requeue so that it runs again once
+    the current run finishes.
+    """
+    DJANGO_TO_OPENKM = 'django_to_openkm'
+    CUSTOM_DJANGO_TO_OPENKM = 'custom_django_to_openkm'
+    OPERATION_CHOICES = (
+        (DJANGO_TO_OPENKM, 'Django to OpenKM'),
+        (CUSTOM_DJANGO_TO_OPENKM, 'Django to OpenKM (custom web services)'),
+    )
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATE_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    content_type = models.ForeignKey('contenttypes.ContentType')
+    object_id = models.PositiveIntegerField()
+    operation = models.CharField(max_length=30, choices=OPERATION_CHOICES, default=DJANGO_TO_OPENKM)
+    # app_label.ModelName of the OpenKmFolderList class passed to the syncer
+    folderlist = models.CharField(max_length=255)
+    taxonomy = models.BooleanField(default=False)
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default=PENDING, db_index=True)
+    requeue = models.BooleanField(default=False)
+    run_after = models.DateTimeField(default=datetime.datetime.now, db_index=True)
+    # when the job last became pending, bounds how long debouncing can postpone it
+    pending_since = models.DateTimeField(default=datetime.datetime.now)
+    attempts = models.PositiveIntegerField(default=0)
+    claimed_by = models.CharField(max_length=255, blank=True, null=True)
+    claimed_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('content_type', 'object_id', 'operation')
+
+    def __unicode__(self):
+        return "%s %s.%s (%s)" % (self.operation, self.content_type_id, self.object_id, self.state)
+
+
 class OpenKMEvent(models.Model):
-    occured = models.DateTimeField()
+    CREATE = 'create'
+    UPDATE = 'update'
+    OPERATION_CHOICES = (
+        (CREATE, 'Create'),
+        (UPDATE, 'Update'),
+    )
+
+    occured = models.DateTimeField(db_index=True)
     recorded = models.DateTimeField(auto_now_add=True, null=True, blank=True)
     token = models.CharField(max_length=255, blank=True, null=True)
+    operation = models.CharField(max_length=20, choices=OPERATION_CHOICES, blank=True, null=True)
+    path = models.CharField(max_length=1000, blank=True, null=True)
+    size = models.IntegerField(blank=True, null=True)
+    checksum = models.CharField(max_length=40, blank=True, null=True)
+    # the full payload is only stored when OPENKM['configuration']['AuditPayload'] is True
     content = models.TextField(blank=True, null=True)
     extra = models.TextField(blank=True, null=True)
 
+    CONTENT_PREFIX = 'z1:'
+
     def save(self, *args, **kwargs):
-        # import ipdb; ipdb.set_trace()
-        if self.content:
-            self.content = pickle.dumps(self.content)
+        if self.content and not self.is_encoded(self.content):
+            self.content = self.encode_content(self.content)
         super(OpenKMEvent, self).save(*args, **kwargs)
 
+    @classmethod
+    def encode_content(cls, content):
+        """
+        Returns the payload as zlib compressed JSON, base64 encoded to fit the TextField.
+        SUDS objects are reduced to their non-empty fields
+        """
+        data = json.dumps(utils.suds_to_dict(content), separators=(',', ':'))
+        return cls.CONTENT_PREFIX + base64.b64encode(zlib.compress(data))
+
+    @classmethod
+    def is_encoded(cls, content):
+        return isinstance(content, basestring) and content.startswith(cls.CONTENT_PREFIX)
+
+    def get_content(self):
+        """
+        Returns the decoded payload.  Content stored in the legacy pickle format is
+        returned as is rather than unpickled
+        """
+        if not self.is_encoded(self.content):
+            return self.content
+        data = zlib.decompress(base64.b64decode(self.content[len(self.CONTENT_PREFIX):]))
+        return json.loads(data)
+
 
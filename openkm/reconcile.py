@@ -0,0 +1,260 @@
+"""
+Reconciliation of the OpenKM metadata stored on Django documents with OpenKM itself
+"""
+import os
+import time
+import logging
+import sqlite3
+import tempfile
+
+from django.conf import settings
+from django.db import transaction
+
+import client, facades, utils
+
+logger = logging.getLogger(__name__)
+
+# SQLite allows at most 999 parameters per statement
+SQLITE_MAX_PARAMETERS = 900
+
+# returned by Reconciler.lookup for documents that could not be looked up
+UNKNOWN = object()
+
+
+class OpenKmListing(object):
+    """
+    The uuid, path and version of every document found on OpenKM, held in a
+    temporary SQLite database so that memory use does not grow with the repository
+    """
+    def __init__(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite', prefix='openkm-reconcile-')
+        os.close(handle)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('CREATE TABLE documents (uuid TEXT PRIMARY KEY, path TEXT, version TEXT, '
+                                'matched INTEGER NOT NULL DEFAULT 0)')
+
+    def add(self, documents):
+        """ :param documents: list of document objects as returned by the web services """
+        rows = [(document.uuid, document.path, getattr(getattr(document, 'actualVersion', None), 'name', None))
+                for document in documents]
+        self.connection.executemany('INSERT OR REPLACE INTO documents (uuid, path, version) VALUES (?, ?, ?)', rows)
+        self.connection.commit()
+
+    def lookup(self, uuids):
+        """
+        Marks the uuids as matched
+        :returns a dict of { uuid : (path, version) } for the uuids found
+        """
+        found = {}
+        uuids = list(uuids)
+        for chunk in utils.chunks(uuids, SQLITE_MAX_PARAMETERS):
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(
+                'SELECT uuid, path, version FROM documents WHERE uuid IN (%s)' % placeholders, chunk)
+            found.update((uuid, (path, version)) for uuid, path, version in rows)
+            self.connection.execute('UPDATE documents SET matched = 1 WHERE uuid IN (%s)' % placeholders, chunk)
+        self.connection.commit()
+        return found
+
+    def count(self, matched=None):
+        if matched is None:
+            return self.connection.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+        return self.connection.execute('SELECT COUNT(*) FROM documents WHERE matched = ?', (int(matched),)).fetchone()[0]
+
+    def unmatched_paths(self, limit):
+        rows = self.connection.execute('SELECT path FROM documents WHERE matched = 0 ORDER BY path LIMIT ?', (limit,))
+        return [path for (path,) in rows]
+
+    def close(self):
+        self.connection.close()
+        os.remove(self.path)
+
+
+class ReconcileResult(object):
+    """
+    The Django documents found to disagree with OpenKM, as lists of pks, and the
+    number of documents on OpenKM that no Django document refers to
+    """
+    def __init__(self):
+        self.checked = 0
+        self.unsynced = []
+        self.missing = []
+        self.moved = []
+        self.stale = []
+        self.unknown = []
+        self.orphaned = 0
+        self.orphaned_paths = []
+        self.repaired = False
+        self.started = time.time()
+        self.finished = None
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def __unicode__(self):
+        return u"%s documents checked in %.1fs: %s missing, %s moved, %s stale, %s never synced, " \
+               u"%s unknown, %s on OpenKM only%s" % (self.checked, self.elapsed, len(self.missing),
+                                                     len(self.moved), len(self.stale), len(self.unsynced),
+                                                     len(self.unknown), self.orphaned,
+                                                     ' (repaired)' if self.repaired else '')
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class Reconciler(object):
+    """
+    Compares the okm_uuid, okm_path and okm_latest_version of every row of an
+    OpenKmDocument model with the documents found on OpenKM below a folder.
+
+    OpenKM is traversed with DirectoryListing.walk into an OpenKmListing, then the
+    rows are read chunk_size at a time and looked up by uuid, so neither side is
+    ever held in memory whole.  Rows are reported as:
+
+    - missing: the uuid is not on OpenKM
+    - moved: the document's path on OpenKM differs from okm_path
+    - stale: the document's version on OpenKM differs from okm_latest_version
+    - unknown: the document could not be looked up, eg. OpenKM was unavailable
+
+    With repair=True moved and stale rows are updated from OpenKM, and missing rows
+    have their OpenKM metadata cleared so that the next sync uploads them again.
+    Documents that look missing are first looked up individually by uuid, as they
+    may have been moved outside the folder traversed.  Only a PathNotFoundException
+    makes a document missing; unknown rows are never repaired.
+
+        result = Reconciler(Asset, workers=8).execute()
+    """
+    def __init__(self, document_class, path=None, workers=4, chunk_size=1000, repair=False, sample_size=100):
+        """
+        :param document_class: your OpenKmDocument model class
+        :param path: OpenKM folder to traverse, defaults to the UploadRoot
+        :param workers: number of concurrent folder listings and lookups
+        :param chunk_size: number of rows compared at a time
+        :param repair: update the rows that disagree with OpenKM
+        :param sample_size: number of paths of documents on OpenKM only to report
+        """
+        self.document_class = document_class
+        self.path = path or settings.OPENKM['configuration']['UploadRoot']
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.repair = repair
+        self.sample_size = sample_size
+
+    def execute(self):
+        """
+        :returns ReconcileResult
+        """
+        result = ReconcileResult()
+        listing = OpenKmListing()
+        try:
+            self.load(listing)
+            for chunk in self.get_chunks():
+                self.compare(chunk, listing, result)
+            result.orphaned = listing.count(matched=False)
+            result.orphaned_paths = listing.unmatched_paths(self.sample_size)
+        finally:
+            listing.close()
+        result.repaired = self.repair
+        result.finish()
+        logger.info('Reconciliation finished: %s', result)
+        return result
+
+    def load(self, listing):
+        for folder_path, documents in facades.DirectoryListing().walk(self.path, self.workers):
+            listing.add(documents)
+        logger.info('%s documents found on OpenKM below %s', listing.count(), self.path)
+
+    def get_chunks(self):
+        """ Yields lists of (pk, okm_uuid, okm_path, okm_latest_version) tuples, ordered by pk """
+        queryset = self.document_class._default_manager.order_by('pk').values_list(
+            'pk', 'okm_uuid', 'okm_path', 'okm_latest_version')
+        last_pk = None
+        while True:
+            chunk = queryset.filter(pk__gt=last_pk) if last_pk is not None else queryset
+            chunk = list(chunk[:self.chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            last_pk = chunk[-1][0]
+
+    def compare(self, rows, listing, result):
+        found = listing.lookup(uuid for pk, uuid, path, version in rows if uuid)
+        missing = [(pk, uuid) for pk, uuid, path, version in rows if uuid and uuid not in found]
+        # documents moved out of the traversed folder are still on OpenKM
+        unknown = set()
+        for uuid, location in zip([uuid for pk, uuid in missing], utils.concurrent_map(
+                self.lookup, [uuid for pk, uuid in missing], self.workers)):
+            if location is UNKNOWN:
+                unknown.add(uuid)
+            elif location is not None:
+                found[uuid] = location
+
+        moved, stale = {}, {}
+        for pk, uuid, path, version in rows:
+            result.checked += 1
+            if not uuid:
+                result.unsynced.append(pk)
+            elif uuid in unknown:
+                result.unknown.append(pk)
+            elif uuid not in found:
+                result.missing.append(pk)
+            else:
+                okm_path, okm_version = found[uuid]
+                if okm_path != path:
+                    result.moved.append(pk)
+                    moved[pk] = okm_path
+                if okm_version and okm_version != version:
+                    result.stale.append(pk)
+                    stale[pk] = okm_version
+
+        if self.repair:
+            missing = [pk for pk, uuid in missing if uuid not in found and uuid not in unknown]
+            self.apply_repairs(moved, stale, missing)
+
+    def locate(self, uuid):
+        """
+        :returns a tuple of (path, version) for the document with the given uuid, or None if it does not exist
+        :raises any error other than OpenKM's PathNotFoundException
+        """
+        document_client = utils.thread_local_instance(client.Document)
+        try:
+            path = document_client.get_path(uuid)
+            document = document_client.get_properties(path)
+        except Exception, e:
+            if not facades.is_path_not_found_exception(e):
+                raise
+            logger.debug('%s not found on OpenKM: %s', uuid, e)
+            return None
+        return document.path, getattr(getattr(document, 'actualVersion', None), 'name', None)
+
+    def lookup(self, uuid):
+        """ As locate, returning UNKNOWN if the document could not be looked up """
+        try:
+            return self.locate(uuid)
+        except Exception, e:
+            logger.warning('%s could not be looked up on OpenKM: %s', uuid, e)
+            return UNKNOWN
+
+    def apply_repairs(self, moved, stale, missing):
+        """
+        Writes the corrections with queryset updates, so that no save signals are fired
+        """
+        manager = self.document_class._default_manager
+        fields = set(field.name for field in self.document_class._meta.fields)
+        with transaction.commit_on_success():
+            for pk, path in moved.items():
+                values = dict(okm_path=path, okm_path_hash=utils.path_hash(path))
+                if 'okm_filename' in fields:
+                    values['okm_filename'] = path.split('/')[-1]
+                manager.filter(pk=pk).update(**values)
+            for pk, version in stale.items():
+                manager.filter(pk=pk).update(okm_latest_version=version)
+            if missing:
+                values = dict(okm_uuid=None, okm_path=None, okm_path_hash=None)
+                if 'okm_sync_fingerprint' in fields:
+                    values['okm_sync_fingerprint'] = None
+                manager.filter(pk__in=missing).update(**values)
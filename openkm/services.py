@@ -1,30 +1,167 @@
+import atexit
+import logging
+import Queue
+import threading
+import time
+
+from django.conf import settings
+
 from openkm import models
 
+logger = logging.getLogger(__name__)
+
+# queued by flush to stop the background thread once it has written its batch
+_STOP = object()
+
+
+class BufferedAuditSink(object):
+    """
+    Queues OpenKMEvent instances and writes them with bulk_create, either
+    from a background thread every flush_interval seconds or as soon as
+    batch_size events are waiting, so recording an event never blocks the
+    web service call it describes.
+    """
+    def __init__(self, batch_size=100, flush_interval=5.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = Queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._registered = False
+
+    def put(self, event):
+        self.queue.put(event)
+        self._ensure_started()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='openkm-audit')
+                self._thread.daemon = True
+                self._thread.start()
+                if not self._registered:
+                    atexit.register(self.flush)
+                    self._registered = True
+
+    def _run(self):
+        while True:
+            batch, stop = self._collect()
+            if batch:
+                self._write(batch)
+            if stop:
+                return
+
+    def _collect(self):
+        """
+        Blocks until an event arrives, then gathers a batch for up to flush_interval seconds
+        :returns a tuple of (batch, True if flush has asked the thread to stop)
+        """
+        batch = []
+        event = self.queue.get()
+        deadline = time.time() + self.flush_interval
+        while event is not _STOP:
+            batch.append(event)
+            remaining = deadline - time.time()
+            if len(batch) >= self.batch_size or remaining <= 0:
+                break
+            try:
+                event = self.queue.get(timeout=remaining)
+            except Queue.Empty:
+                break
+        return batch, event is _STOP
+
+    def _write(self, batch):
+        # bulk_create bypasses OpenKMEvent.save, so encode any payloads here
+        for event in batch:
+            if event.content and not event.is_encoded(event.content):
+                event.content = event.encode_content(event.content)
+        try:
+            models.OpenKMEvent.objects.bulk_create(batch, batch_size=self.batch_size)
+        except Exception, e:
+            logger.exception(e)
+
+    def flush(self):
+        """
+        Synchronously writes every event queued so far, including any the background
+        thread has already gathered into a batch.  The thread is stopped and started
+        again by the next put()
+        """
+        with self._lock:
+            if self._thread is not None:
+                self.queue.put(_STOP)
+                self._thread.join()
+                self._thread = None
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_audit_sink():
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                configuration = settings.OPENKM['configuration']
+                _sink = BufferedAuditSink(batch_size=configuration.get('AuditBatchSize', 100),
+                                          flush_interval=configuration.get('AuditFlushInterval', 5.0))
+    return _sink
+
 
 class OpenKMAuditService(object):
+    """
+    Records the web service calls that write documents to OpenKM.
+
+    Events hold a summary of the call (operation, path, size and sha1 of the
+    content).  Set OPENKM['configuration']['AuditPayload'] to True to store the
+    full payload as well, and 'AuditAsync' to False to write events synchronously.
+    """
 
-    def record_update(self, token, content, occured):
+    def record_update(self, token, content, occured, path=None, checksum=None, size=None):
         """
         token (string)
-        content (instance of document) as returned by 
-            openkm.client.Document.create_document_content_object
+        content (instance of documentData) as passed to
+            openkm.client.Document.update_document
         occured (datetime.datetime)
+        path (string) the document path
+        checksum, size (string, int) sha1 and size of any file content uploaded with the update
         """
-        return models.OpenKMEvent.objects.create(
-            token=token,
-            content=content,
-            occured=occured
-            )
+        return self.record(models.OpenKMEvent.UPDATE, token, content, occured, path, checksum, size)
 
-    def record_create(self, token, content, occured):
+    def record_create(self, token, content, occured, path=None, checksum=None, size=None):
         """
         token (string)
-        content (instance of document) as returned by 
-            openkm.client.Document.create_document_content_object
+        content (string) the encoded document content as passed to
+            openkm.client.Document.create_document
         occured (datetime.datetime)
+        path (string) the document path
+        checksum, size (string, int) sha1 and size of the file, as returned by
+            openkm.utils.encode_file_for_transport
         """
-        return models.OpenKMEvent.objects.create(
-            token=token,
-            content=content,
-            occured=occured
-            )
\ No newline at end of file
+        return self.record(models.OpenKMEvent.CREATE, token, content, occured, path, checksum, size)
+
+    def record(self, operation, token, content, occured, path=None, checksum=None, size=None):
+        event = self.build_event(operation, token, content, occured, path, checksum, size)
+        if settings.OPENKM['configuration'].get('AuditAsync', True):
+            get_audit_sink().put(event)
+        else:
+            event.save()
+        return event
+
+    def build_event(self, operation, token, content, occured, path=None, checksum=None, size=None):
+        # the size and sha1 describe the file itself, not its base64 encoding
+        event = models.OpenKMEvent(operation=operation, token=token, occured=occured, path=path,
+                                   checksum=checksum, size=size)
+        if content and settings.OPENKM['configuration'].get('AuditPayload', False):
+            event.content = content
+        return event
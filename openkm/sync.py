@@ -1,3 +1,6 @@
+import collections
+import hashlib
+import json
 import logging
 import re
 logger = logging.getLogger( __name__ )
@@ -8,7 +11,7 @@ from django.db import transaction
 
 from suds import WebFault
 
-import client, facades, utils, sync
+import cache, client, facades, index, utils, sync
 
 
 class SyncKeywords(object):
@@ -39,13 +42,40 @@ class SyncKeywords(object):
         :param path: OpenKM node path of document
         :param expected_keywords: list
         """
-        openkm_keywords = self.keyword.get_for_document(path)
-        diff = set(expected_keywords).difference(set(openkm_keywords))
+        openkm_keywords = self.keyword.get_for_document(path) or []
+        diff = self.normalise_keywords(expected_keywords).difference(set(openkm_keywords))
+        return not diff
 
-        if diff == 0:
-            return True
-        else:
-            return False
+    def normalise_keywords(self, keywords):
+        """ :returns a set of the stripped, non-empty keywords """
+        return set(keyword.strip() for keyword in keywords if keyword and keyword.strip())
+
+    def get_keyword_delta(self, current_keywords, keywords):
+        """
+        :param current_keywords: list of the keywords OpenKM has for the document
+        :param keywords: list of the keywords the document should have
+        :returns a tuple of sets (keywords to add, keywords to remove)
+        """
+        current = self.normalise_keywords(current_keywords or [])
+        desired = self.normalise_keywords(keywords)
+        return desired - current, current - desired
+
+    def sync_keywords(self, path, keywords, current_keywords=None):
+        """
+        Adds and removes only the keywords that differ from those already on OpenKM,
+        making the calls concurrently
+        :param path: string  The document path on OpenKM
+        :param keywords: list The keywords to be associated with a document
+        :param current_keywords: list The keywords currently on OpenKM, eg. from a document
+        already fetched with get_properties.  Fetched if not given.
+        :returns a tuple of sets (keywords added, keywords removed)
+        """
+        if current_keywords is None:
+            current_keywords = self.keyword.get_for_document(path)
+        return apply_changes(
+            lambda keyword: utils.thread_local_instance(client.Property).add_keyword(path, keyword),
+            lambda keyword: utils.thread_local_instance(client.Property).remove_keyword(path, keyword),
+            self.normalise_keywords(current_keywords or []), self.normalise_keywords(keywords))
 
     def single_document_django_to_helix(self, document, openkm_document):
         """
@@ -115,25 +145,67 @@ class SyncCategories(object):
         return self.category.folder.get_children(parent_path)
 
     def django_to_openkm(self):
+        """
+        :returns a dict of { category name : counts } as returned by create_categories_from_django_model
+        """
+        results = {}
         for django_model_class, openkm_model_name in self.MODEL_CATEGORY_MAP.items():
-            self.create_categories_from_django_model(django_model_class, openkm_model_name)
+            results[openkm_model_name] = self.create_categories_from_django_model(django_model_class, openkm_model_name)
+        return results
 
-    def create_categories_from_django_model(self, model_class, category_name):
+    def create_categories_from_django_model(self, model_class, category_name, workers=None):
         """
         Creates child sub-categories on OpenKM in a parent folder.
-        The parent category should already exist.
+        The parent category should already exist.  Its children are listed once and
+        only the missing categories are created, concurrently.
         :param model_class: model class object
         :param category_name: string (name of the Category on OpenKM)
+        :param workers: number of concurrent calls, defaults to get_concurrency()
+        :returns a collections.Counter of created, skipped and failed categories
         @todo confirm the replace char
         """
-        objects = model_class.objects.all()
+        parent_path = '/okm:categories/%s' % category_name
+        existing = self.get_child_category_names(parent_path)
+        names = set(object.__unicode__().replace('/', '--') for object in model_class.objects.all().iterator())
+        missing = [name for name in names if name not in existing]
 
-        for object in objects:
+        def create(name):
+            path = self.category.construct_valid_path_string(parent_path, name)
             try:
-                self.category.create('/okm:categories/%s/%s' % (category_name,\
-                                                                object.__unicode__().replace('/','--')))
-            except:
-                logger.info("%s creation failed" % object.__unicode__().replace('/',''))
+                utils.thread_local_instance(facades.Category).create(path)
+                return 'created'
+            except Exception, e:
+                if facades.is_item_exists_exception(e):
+                    return 'skipped'
+                logger.info("%s creation failed: %s" % (path, e))
+                return 'failed'
+
+        counts = collections.Counter(created=0, skipped=len(names) - len(missing), failed=0)
+        counts.update(utils.concurrent_map(create, missing, workers or get_concurrency()))
+        logger.info("%s categories: %s created, %s skipped, %s failed", category_name,
+                    counts['created'], counts['skipped'], counts['failed'])
+        return counts
+
+    def get_child_category_names(self, parent_path):
+        """
+        :returns a set of the names of the categories directly below parent_path
+        """
+        children = self.get_child_categories(parent_path)
+        return set(child.path.rsplit('/', 1)[-1] for child in (getattr(children, 'item', None) or []))
+
+    def sync_document_categories(self, path, category_uuids, current_uuids):
+        """
+        Adds and removes only the categories that differ from those already on the document,
+        making the calls concurrently
+        :param path: string  The document path on OpenKM
+        :param category_uuids: list of the category uuids the document should have
+        :param current_uuids: list of the category uuids the document has on OpenKM
+        :returns a tuple of sets (uuids added, uuids removed)
+        """
+        return apply_changes(
+            lambda uuid: utils.thread_local_instance(client.Property).add_category(path, uuid),
+            lambda uuid: utils.thread_local_instance(client.Property).remove_category(path, uuid),
+            set(current_uuids), set(category_uuids))
 
     def get_objects_from_m2m_model(self, document, related_model_class):
         """
@@ -174,26 +246,14 @@ class SyncProperties(object):
 
     def prepare_properties_dict(self, map, document):
         """
-        @todo pass getter functions in to get the values
+        Fills map with the document's values for each property in the outbound table, see PropertyPlan
+        :param map: dict of { property group : dict }, usually a collections.defaultdict(dict)
         :param document: Django model object instance
         :returns dict
         """
-        map['okg:customProperties']['okp:customProperties.title'] = [xml_clean(document.name)]
-        map['okg:customProperties']['okp:customProperties.description'] = [xml_clean(document.description)]
-        map['okg:customProperties']['okp:customProperties.languages'] = [xml_clean(self.get_language(document))]
-        map['okg:customProperties']['okp:customProperties.contentOwner'] = [xml_clean(self.get_content_owner(document))]
-        map['okg:customProperties']['okp:customProperties.expirationDate'] = [document.okm_date_string(document.expire)]
-        map['okg:customProperties']['okp:customProperties.public'] = [self.is_public(document)]
-
-        map['okg:salesProperties']['okp:salesProperties.assetType'] = [xml_clean(self.get_asset_type(document))]
-
-        # These will only exist if the user has the correct permissions to add them to the document in the first place
-        map['okg:gsaProperties']['okp:gsaProperties.publisherNotes'] = [document.notes]
-        map['okg:gsaProperties']['okp:gsaProperties.publishNow'] = [document.publish_now]
-        map['okg:gsaProperties']['okp:gsaProperties.gsaPublishedStatus'] = [self.get_published_status(document)]
-        map['okg:gsaProperties']['okp:gsaProperties.startDate'] = [document.okm_date_string(document.publish)]
-        map['okg:gsaProperties']['okp:gsaProperties.expirationDate'] = [document.okm_date_string(document.expire)]
-
+        for group_name, getters in get_property_plan().outbound.items():
+            for property_name, getter in getters.items():
+                map[group_name][property_name] = [getter(self, document)]
         return map
 
     def is_public(self, document):
@@ -237,74 +297,134 @@ class SyncProperties(object):
         A dict with property group names as keys, the value for each property group
         should be a dict containing its properties and values
         {'property group name':
-            { property name : values, ... }
+            { property name : value or list of values, ... }
         :returns a list groupProperties objects each populated with property names and values
         """
+        document = utils.thread_local_instance(client.Document)
         property_groups = []
         for property_group in properties_dict:
-            document = client.Document()
             property_group_obj = document.create_group_properties_object()
             property_group_obj.groupName = property_group
             for property_name, value in properties_dict[property_group].items():
                 property_obj = document.create_group_property_object()
                 property_obj.name = property_name
-                property_obj.values = [value]
+                property_obj.values = value if isinstance(value, list) else [value]
                 property_group_obj.properties.append(property_obj)
             property_groups.append(property_group_obj)
 
         return property_groups
 
+    def get_properties_dict(self, document):
+        """
+        Returns the prepared { property group : { property name : values } } dict for a document,
+        built in a fresh dict rather than in settings.OPENKM['properties']
+        """
+        properties_dict = self.prepare_properties_dict(collections.defaultdict(dict), document)
+        return dict(properties_dict)
+
+    def get_optional_groups(self):
+        """
+        The property groups only written to documents that already have them, as only users
+        with the right permissions can add them: OPENKM['configuration']['OptionalPropertyGroups']
+        """
+        return settings.OPENKM['configuration'].get('OptionalPropertyGroups', ('okg:gsaProperties',))
+
+    def django_to_openkm(self, document):
+        """
+        Writes the document's properties to OpenKM, sending only the values that have changed.
+        Missing property groups are added, other than optional groups, which are skipped.
+        A group that can't be added is logged and skipped, and the other groups still written.
+        :returns True if every group was written (or skipped as optional)
+        """
+        existing = self.property.get_group_names(document.okm_path)
+        optional = self.get_optional_groups()
+        written = True
+        for group_name, properties in self.get_properties_dict(document).items():
+            has_group = group_name in existing
+            if not has_group and group_name in optional:
+                logger.debug('%s does not have the optional group %s', document.okm_path, group_name)
+                continue
+            new_values = dict((name, {'value': values}) for name, values in properties.items())
+            try:
+                self.property.sync_group(document.okm_path, group_name, new_values, has_group=has_group)
+            except Exception, e:
+                if has_group:
+                    raise
+                logger.warning('%s could not be added to %s: %s', group_name, document.okm_path, e)
+                written = False
+        return written
+
     def django_to_openkm_improved(self, document):
-        #import ipdb; ipdb.set_trace()
-        map = settings.OPENKM['properties']
-        properties_dict = self.prepare_properties_dict(map, document)
+        properties_dict = self.get_properties_dict(document)
         return self.populate_property_group(properties_dict)
 
-    def openkm_to_django(self, document):
-        self.PROPERTY_GROUP_MAP = settings.OPENKM['properties']
+    def openkm_to_django(self, document, save=True):
+        """
+        :param save: save the document afterwards
+        """
+        plan = get_property_plan()
         document_property_groups = self.property.get_property_groups_for_document(document.okm_path)
 
         if document_property_groups:
             for property_group in document_property_groups[0]:
                 if hasattr(property_group, 'name') and property_group.name != 'okg:gsaProperties':
+                    group_plan = plan.get(property_group.name)
+                    if group_plan is None:
+                        logger.debug('%s not found in OPENKM[\'properties\']', property_group.name)
+                        continue
                     document_properties = self.property.get_document_properties_for_group(document.okm_path, property_group.name)
-                    try:
-                        property_map = self.PROPERTY_GROUP_MAP[property_group.name]
-                        document = self.set_attributes(property_map, document_properties[0], document)
-                    except KeyError, e:
-                        print e
-            document.save()
+                    document = self.set_attributes(group_plan, document_properties[0], document)
+            if save:
+                document.save()
 
     def set_attributes(self, property_map, document_properties, document):
+        """
+        :param property_map: dict of { property name : PropertyMapping } for the group, see PropertyPlan
+        :param document_properties: list of form elements as returned by OpenKM
+        :param document: Django model object instance
+        """
         for document_property in document_properties:
-            if hasattr(document_property, 'name') and 'okp:gsaProperties' not in document_property.name:
-                if property_map.get(document_property.name, None):
-                    meta = property_map.get(document_property.name, None)
-                    if 'choices' in meta:
-                        option = self.get_option(document_property.options)
-                        if option and meta['choices']:
-                            value = utils.find_key(dict(meta['choices']), option.label)
-                            setattr(document, meta['attribute'], value)
-                        elif option and not meta['choices']:
-                            if meta['attribute'] == 'type':
-                                if not hasattr(document, 'type') or not document.type:
-                                    document.set_default_type()
-                                document.set_type(option.label)
-                                document.save()
-                            else:
-                                # sorry this is a horrible special case
-                                # will come back and refactor this out soon
-                                if meta['attribute'] == 'languages':
-                                    try:
-                                        self.set_language(document, option)
-                                    except Exception, e:
-                                        print e
-                                else:
-                                    setattr(document, meta['attribute'], option.value)
-                    else:
-                        setattr(document, meta['attribute'], document_property.value)
+            mapping = property_map.get(getattr(document_property, 'name', None))
+            if mapping is not None:
+                self.SETTERS[mapping.kind](self, mapping, document, document_property)
         return document
 
+    def _set_value(self, mapping, document, document_property):
+        setattr(document, mapping.attribute, document_property.value)
+
+    def _set_choice(self, mapping, document, document_property):
+        option = self.get_option(document_property.options)
+        if option:
+            setattr(document, mapping.attribute, mapping.from_openkm(option.label))
+
+    def _set_option(self, mapping, document, document_property):
+        option = self.get_option(document_property.options)
+        if option:
+            setattr(document, mapping.attribute, option.value)
+
+    def _set_type(self, mapping, document, document_property):
+        option = self.get_option(document_property.options)
+        if option:
+            if not hasattr(document, 'type') or not document.type:
+                document.set_default_type()
+            document.set_type(option.label)
+
+    def _set_language(self, mapping, document, document_property):
+        option = self.get_option(document_property.options)
+        if option:
+            try:
+                self.set_language(document, option)
+            except Exception, e:
+                logger.debug(e)
+
+    SETTERS = {
+        'value': _set_value,
+        'choice': _set_choice,
+        'option': _set_option,
+        'type': _set_type,
+        'language': _set_language,
+    }
+
     def set_language(self, document, option):
         language_model_class = document.get_related_model()
         document.language = language_model_class.objects.get(language=option.value)
@@ -316,33 +436,156 @@ class SyncProperties(object):
 
     def populate_property_group_map(self, map, document):
         """
-        Updates the settings dict with values.
-        @todo this restricts the settings. abstract to more generic
+        Updates the settings dict with values, for the properties it has an outbound getter for
         """
-        map['okg:customProperties']['okp:customProperties.title'].update({'value': document.name})
-        map['okg:customProperties']['okp:customProperties.description'].update({'value': document.description})
+        for group_name, getters in get_property_plan().outbound.items():
+            for property_name, getter in getters.items():
+                if property_name in map.get(group_name, {}):
+                    map[group_name][property_name].update({'value': getter(self, document)})
+        return map
+
+    def _get_title(self, document):
+        return xml_clean(document.name)
+
+    def _get_description(self, document):
+        return xml_clean(document.description)
+
+    def _get_languages(self, document):
+        return xml_clean(self.get_language(document))
+
+    def _get_content_owner(self, document):
+        return xml_clean(self.get_content_owner(document))
+
+    def _get_asset_type(self, document):
+        return xml_clean(self.get_asset_type(document))
+
+    def _get_notes(self, document):
+        return document.notes
+
+    def _get_publish_now(self, document):
+        return document.publish_now
+
+    def _get_start_date(self, document):
+        return document.okm_date_string(document.publish)
 
-        # must set to english languages not supported in OpenKM
-        if document.language.language in ('ro', 'hr') or not document.language:
-            language = 'en'
+    def _get_expiration_date(self, document):
+        return document.okm_date_string(document.expire)
+
+    # (property group, property name, getter) for the values sent to OpenKM,
+    # settings.OPENKM['properties'] can add to or override these, see PropertyPlan
+    GETTERS = (
+        ('okg:customProperties', 'okp:customProperties.title', _get_title),
+        ('okg:customProperties', 'okp:customProperties.description', _get_description),
+        ('okg:customProperties', 'okp:customProperties.languages', _get_languages),
+        ('okg:customProperties', 'okp:customProperties.contentOwner', _get_content_owner),
+        ('okg:customProperties', 'okp:customProperties.expirationDate', _get_expiration_date),
+        ('okg:customProperties', 'okp:customProperties.public', is_public),
+        ('okg:salesProperties', 'okp:salesProperties.assetType', _get_asset_type),
+        # These will only exist if the user has the correct permissions to add them to the document in the first place
+        ('okg:gsaProperties', 'okp:gsaProperties.publisherNotes', _get_notes),
+        ('okg:gsaProperties', 'okp:gsaProperties.publishNow', _get_publish_now),
+        ('okg:gsaProperties', 'okp:gsaProperties.gsaPublishedStatus', get_published_status),
+        ('okg:gsaProperties', 'okp:gsaProperties.startDate', _get_start_date),
+        ('okg:gsaProperties', 'okp:gsaProperties.expirationDate', _get_expiration_date),
+    )
+
+
+class PropertyMapping(object):
+    """
+    A single entry of settings.OPENKM['properties'] compiled for fast lookups, both
+    when reading properties back from OpenKM and when sending values to it
+    """
+    __slots__ = ('name', 'attribute', 'kind', 'from_openkm_map', 'to_openkm_map')
+
+    def __init__(self, name, meta):
+        self.name = name
+        self.attribute = meta['attribute']
+        choices = meta.get('choices')
+        self.from_openkm_map = dict((label, key) for key, label in reversed(list(choices))) if choices else {}
+        self.to_openkm_map = dict(choices) if choices else {}
+        if 'choices' not in meta:
+            self.kind = 'value'
+        elif choices:
+            self.kind = 'choice'
+        elif self.attribute == 'type':
+            self.kind = 'type'
+        elif self.attribute == 'languages':
+            # sorry this is a horrible special case
+            self.kind = 'language'
         else:
-            language = document.language.language
-        map['okg:customProperties']['okp:customProperties.languages'].update({'value': language})
+            self.kind = 'option'
+
+    def from_openkm(self, label):
+        """ :returns the Django choice key for an OpenKM option label, or False if there is none """
+        return self.from_openkm_map.get(label, False)
+
+    def to_openkm(self, sync_properties, document):
+        """ :returns the value to send to OpenKM, used for properties SyncProperties.GETTERS doesn't cover """
+        if self.kind == 'type':
+            return sync_properties._get_asset_type(document)
+        if self.kind == 'language':
+            return sync_properties._get_languages(document)
+        value = getattr(document, self.attribute, None)
+        if self.kind == 'choice':
+            return self.to_openkm_map.get(value, value)
+        if self.kind == 'value':
+            return xml_clean(unicode(value)) if value is not None else ''
+        return value
+
+
+def method_getter(method_name):
+    """ :returns an outbound getter calling the named SyncProperties method with the document """
+    def getter(sync_properties, document):
+        return getattr(sync_properties, method_name)(document)
+    return getter
+
+
+class PropertyPlan(object):
+    """
+    settings.OPENKM['properties'] compiled once into
+    groups: { property group : { property name : PropertyMapping } } for reading values back from OpenKM.
+    Properties of the okg:gsaProperties group are never synced back to Django so are left out.
+    outbound: { property group : { property name : getter(sync_properties, document) } } for the values
+    sent to OpenKM, starting from getters (SyncProperties.GETTERS). A settings entry with a 'getter'
+    (the name of a SyncProperties method) overrides the default, other entries not in getters are
+    read from the document's attribute.
+    """
+    def __init__(self, properties, getters=()):
+        self.groups = {}
+        for group_name, local_metadata in properties.items():
+            self.groups[group_name] = dict(
+                (name, PropertyMapping(name, meta)) for name, meta in local_metadata.items()
+                if 'okp:gsaProperties' not in name and isinstance(meta, dict))
+
+        self.outbound = {}
+        for group_name, name, getter in getters:
+            self.outbound.setdefault(group_name, {})[name] = getter
+        for group_name, local_metadata in properties.items():
+            for name, meta in local_metadata.items():
+                if not isinstance(meta, dict):
+                    continue
+                group = self.outbound.setdefault(group_name, {})
+                if 'getter' in meta:
+                    group[name] = method_getter(meta['getter'])
+                elif name not in group:
+                    group[name] = PropertyMapping(name, meta).to_openkm
 
+    def get(self, group_name):
+        return self.groups.get(group_name)
 
-        parts = document.type.name.split()
-        parts[0] = parts[0].lower()
-        asset_type = ''.join(parts)
-        map['okg:salesProperties']['okp:salesProperties.assetType'].update({'value': asset_type})
 
-        # published status has two values that GSA should set
-        gsaPublishedStatus = 'Not Published'
-        if document.is_published:
-            gsaPublishedStatus = 'Published'
-        map['okg:gsaProperties']['okp:gsaProperties.gsaPublishedStatus'].update({'value': gsaPublishedStatus})
-        map['okg:gsaProperties']['okp:gsaProperties.startDate'].update({'value': document.okm_date_string(document.publish)})
-        map['okg:gsaProperties']['okp:gsaProperties.expirationDate'].update({'value': document.okm_date_string(document.expire)})
-        return map
+_property_plan = None
+
+
+def get_property_plan():
+    global _property_plan
+    if _property_plan is None:
+        _property_plan = PropertyPlan(settings.OPENKM['properties'], SyncProperties.GETTERS)
+    return _property_plan
+
+
+class SyncFolderListException(Exception):
+    pass
 
 
 class SyncFolderList(object):
@@ -352,6 +595,9 @@ class SyncFolderList(object):
     categories
     """
     DIRECTORY_SEPARATOR = "/"
+    BATCH_SIZE = 500
+    FOLDER_FIELDS = ('okm_author', 'okm_has_childs', 'okm_path', 'okm_permissions', 'okm_subscribed',
+                     'okm_path_hash', 'okm_category', 'okm_name')
 
     def __init__(self):
         self.category = facades.Category()
@@ -360,27 +606,95 @@ class SyncFolderList(object):
 
     def update_categories(self, klass):
         """
+        Brings the local folder list in line with the categories on OpenKM.
+        Rows are matched on okm_uuid, so only new, changed and removed folders
+        are written, and the whole sync is committed as a single transaction.
+        Raises SyncFolderListException, leaving the folder list untouched, if any
+        folder returned by OpenKM could not be read.
         :param klass: OpenKMFolderlist class object
+        :returns dict of created, updated and deleted counts
         """
-        klass.objects.all().delete()
         document = client.Document()
         categories = document.get_categories()
-        
+
+        incoming = {}
+        failed = 0
         for folder in categories:
             try:
-                folder_obj = klass.objects.create(okm_uuid=folder.uuid)
-                folder_obj.okm_author = folder.author
-                #folder_obj.okm_created = folder.created
-                folder_obj.okm_has_childs = folder.hasChildren
-                folder_obj.okm_path = utils.strip_runs_of_whitespace(folder.path)
-                folder_obj.okm_permissions = folder.permissions
-                folder_obj.okm_subscribed = folder.subscribed
-                folder_obj.save()
+                incoming[folder.uuid] = self.get_folder_values(folder)
             except Exception, e:
                 logger.exception(e)
+                failed += 1
+        # a folder that could not be read would otherwise look deleted
+        if failed:
+            raise SyncFolderListException('%s of %s folders could not be read, the local folder list was not changed'
+                                          % (failed, len(categories)))
+
+        with transaction.commit_on_success():
+            stats = self.apply_folder_values(klass, incoming)
+        cache.refresh_category_index(klass)
+
+        logger.info('%s folders returned from DMS', len(categories))
+        logger.info('%(created)s created, %(updated)s updated, %(deleted)s deleted in local folder list', stats)
+        return stats
+
+    def get_folder_values(self, folder):
+        """
+        Returns the folder list field values for a folder, as they would be read back from the database
+        :param folder: folder object as returned by OpenKM
+        :returns dict
+        """
+        path = utils.strip_runs_of_whitespace(folder.path)
+        category, name = utils.get_category_segments(path)
+        return {
+            'okm_author': self._as_field_value(folder.author),
+            'okm_has_childs': self._as_field_value(folder.hasChildren),
+            'okm_path': path,
+            'okm_path_hash': utils.path_hash(path),
+            'okm_permissions': self._as_field_value(folder.permissions),
+            'okm_subscribed': self._as_field_value(folder.subscribed),
+            'okm_category': category,
+            'okm_name': name,
+        }
+
+    def _as_field_value(self, value):
+        return unicode(value) if value is not None else None
+
+    def apply_folder_values(self, klass, incoming):
+        """
+        Diffs the incoming folders against the stored rows and writes only the difference.
+        Rows are deleted when their uuid is not incoming, or duplicates another row.
+        Changed rows are written with an update() each, Django 1.5 having no bulk update.
+        :param klass: OpenKMFolderlist class object
+        :param incoming: dict of { okm_uuid : field values } for every folder listed by OpenKM
+        :returns dict of created, updated and deleted counts
+        """
+        existing = {}
+        stale_pks = []
+        for row in klass.objects.values('pk', 'okm_uuid', *self.FOLDER_FIELDS):
+            if row['okm_uuid'] in existing or row['okm_uuid'] not in incoming:
+                stale_pks.append(row['pk'])
+            else:
+                existing[row['okm_uuid']] = row
+
+        new_objects = []
+        updated = 0
+        for uuid, values in incoming.items():
+            row = existing.get(uuid)
+            if row is None:
+                new_objects.append(klass(okm_uuid=uuid, **values))
+                continue
+            changed = dict((field, value) for field, value in values.items() if row[field] != value)
+            if changed:
+                klass.objects.filter(pk=row['pk']).update(**changed)
+                updated += 1
+
+        klass.objects.bulk_create(new_objects, batch_size=self.BATCH_SIZE)
 
-        print('%s folders returned from DMS' % len(categories))
-        print('%s folders now in local folder list' % klass.objects.count())
+        for i in xrange(0, len(stale_pks), self.BATCH_SIZE):
+            klass.objects.filter(pk__in=stale_pks[i:i + self.BATCH_SIZE]).delete()
+
+        return {'created': len(new_objects), 'updated': updated, 'deleted': len(stale_pks)}
 
     def get_list_of_root_paths(self):
         return [self.category.get_category_root().path]
@@ -421,6 +735,55 @@ class SyncDocumentException(Exception):
     pass
 
 
+class SyncFingerprint(object):
+    """
+    Digests of each section of a document as last synced to OpenKM, so that
+    unchanged sections (or whole documents) can be skipped.  Stored on the
+    document as okm_sync_fingerprint.
+    """
+    SECTIONS = ('content', 'keywords', 'categories', 'properties')
+
+    def __init__(self, **digests):
+        self.digests = dict((section, digests.get(section)) for section in self.SECTIONS)
+
+    @classmethod
+    def for_values(cls, **values):
+        """ :param values: { section : JSON serialisable value } """
+        return cls(**dict((section, cls.digest(value)) for section, value in values.items()))
+
+    @classmethod
+    def parse(cls, value):
+        """ Reads a fingerprint from its stored form, eg. 'content=ab12..;keywords=cd34..' """
+        digests = {}
+        for part in (value or '').split(';'):
+            if '=' in part:
+                section, digest = part.split('=', 1)
+                digests[str(section)] = digest
+        return cls(**digests)
+
+    @staticmethod
+    def digest(value):
+        return hashlib.sha1(json.dumps(value, sort_keys=True, default=unicode)).hexdigest()[:16]
+
+    def changed_sections(self, previous):
+        """ :returns the set of sections whose digest differs from (or is missing in) the previous fingerprint """
+        return set(section for section in self.SECTIONS
+                   if not self.digests[section] or self.digests[section] != previous.digests[section])
+
+    def keep(self, previous, sections):
+        """
+        :returns a copy of this fingerprint with the digests of sections taken from previous,
+        for sections that were not written so still count as changed next time
+        """
+        digests = dict(self.digests)
+        digests.update((section, previous.digests[section]) for section in sections)
+        return SyncFingerprint(**digests)
+
+    def __unicode__(self):
+        return u';'.join(u'%s=%s' % (section, self.digests[section]) for section in self.SECTIONS
+                         if self.digests[section])
+
+
 class SyncDocument(object):
     """
     Syncs a document object to OpenKM
@@ -436,10 +799,23 @@ class SyncDocument(object):
         self.category = facades.Category()
         self.upload_root = self.get_upload_root()
         self.property = facades.Property()
+        self.sync_properties = SyncProperties()
 
     def get_upload_root(self):
         return settings.OPENKM['configuration']['UploadRoot']
 
+    def update_index(self, document):
+        """
+        Re-indexes the document in the MetadataIndex, if it is enabled, after it has been written to OpenKM
+        """
+        metadata_index = index.get_metadata_index()
+        if metadata_index is None or not document.okm_path:
+            return
+        try:
+            metadata_index.update_documents([self.document.get_properties(document.okm_path)])
+        except Exception, e:
+            logger.exception('Indexing %s failed: %s', document.okm_path, e)
+
 
 class DjangoToOpenKm(SyncDocument):
 
@@ -449,20 +825,105 @@ class DjangoToOpenKm(SyncDocument):
         :param document: a document object
         :param document_class: a class object.  This should be your Django model which extends the OpenKmDocument
         abstract base class
+        :returns boolean: True on success, False on fail
         """
         try:
-            logger.debug(document)
-            if not document.okm_uuid and document.file:
-                if taxonomy:
-                    taxonomy = self.build_taxonomy(document)
-                okm_document = self.document_manager.create(document.file, taxonomy)
-                document.set_model_fields(okm_document)
-                document.save()
-            self.keywords(document)
-            self.categories(document, folderlist_document_class)
-            self.properties(document)
+            self.run(document, folderlist_document_class, taxonomy)
+            return True
         except Exception, e:
             logger.debug(e)
+            return False
+
+    def run(self, document, folderlist_document_class, taxonomy=False):
+        """
+        As execute(), but raises any exception encountered.
+        Sections that have not changed since the last sync are skipped, and sections
+        that could not be written are left to count as changed on the next run.
+        The content of documents already on OpenKM is not uploaded again.
+        """
+        logger.debug(document)
+        if not document.okm_uuid and document.file:
+            if taxonomy:
+                taxonomy = self.build_taxonomy(document)
+            okm_document = self.document_manager.create(document.file, taxonomy)
+            document.set_model_fields(okm_document)
+            document.save()
+
+        fingerprint = self.get_fingerprint(document, folderlist_document_class)
+        previous = SyncFingerprint.parse(getattr(document, 'okm_sync_fingerprint', None))
+        changed = fingerprint.changed_sections(previous)
+        okm_document = None
+        if changed & set(['keywords', 'categories']):
+            # one fetch gives the current keywords and categories to diff against
+            okm_document = self.document.get_properties(document.okm_path)
+        unwritten = set()
+        if 'keywords' in changed:
+            self.keywords(document, okm_document)
+        if 'categories' in changed:
+            self.categories(document, folderlist_document_class, okm_document=okm_document)
+        if 'properties' in changed and not self.properties(document):
+            unwritten.add('properties')
+        self.save_fingerprint(document, fingerprint.keep(previous, unwritten))
+        if changed:
+            self.update_index(document)
+
+    def get_fingerprint(self, document, openkm_folderlist_class):
+        """
+        Fingerprints the values that would be written to OpenKM for a document.
+        This makes no web service calls.
+        """
+        return SyncFingerprint.for_values(
+            content=self.get_content_fingerprint(getattr(document, 'file', None)),
+            keywords=sorted(tag.strip() for tag in self.sync_keywords.get_tags_from_document(document)),
+            categories=sorted(self.get_category_uuids(document, openkm_folderlist_class)),
+            properties=self.sync_properties.get_properties_dict(document),
+        )
+
+    def get_content_fingerprint(self, file_obj):
+        """
+        Identifies the content of a file by its name, size and modification time, as
+        reported by its storage, so that a file replaced under the same name counts as
+        changed.  Storages that can't report a modification time have the content hashed.
+        A file missing from storage is identified by its name alone.
+        """
+        if not file_obj:
+            return None
+        storage = file_obj.storage
+        try:
+            try:
+                return [file_obj.name, storage.size(file_obj.name), storage.modified_time(file_obj.name).isoformat()]
+            except NotImplementedError:
+                # read through a separate handle, leaving file_obj positioned for the upload
+                content = storage.open(file_obj.name)
+                try:
+                    checksum = hashlib.sha1()
+                    for chunk in content.chunks():
+                        checksum.update(chunk)
+                finally:
+                    content.close()
+                return [file_obj.name, checksum.hexdigest()]
+        except (OSError, IOError), e:
+            logger.warning('Could not read %s from storage: %s', file_obj.name, e)
+            return file_obj.name
+
+    def get_changed_sections(self, document, fingerprint):
+        previous = SyncFingerprint.parse(getattr(document, 'okm_sync_fingerprint', None))
+        return fingerprint.changed_sections(previous)
+
+    def is_unchanged(self, document, openkm_folderlist_class):
+        """ True if the document exists on OpenKM and nothing has changed since it was last synced """
+        fingerprint = self.get_fingerprint(document, openkm_folderlist_class)
+        return bool(document.okm_uuid) and not self.get_changed_sections(document, fingerprint)
+
+    def save_fingerprint(self, document, fingerprint):
+        """
+        Stores the fingerprint with an update() rather than save(), so that
+        recording a sync does not fire the model's save signals
+        """
+        if not hasattr(document, 'okm_sync_fingerprint'):
+            return
+        document.okm_sync_fingerprint = unicode(fingerprint)
+        type(document)._default_manager.filter(pk=document.pk).update(okm_sync_fingerprint=document.okm_sync_fingerprint)
 
     def improved_execute(self, document, openkm_folderlist_class, taxonomy=False):
         CustomDjangoToOpenKM(asset=document).execute(openkm_folderlist_class, taxonomy=False)
@@ -504,51 +965,50 @@ class DjangoToOpenKm(SyncDocument):
         taxonomy = [region, year, team]
         return taxonomy
 
-    def keywords(self, document):
+    def keywords(self, document, okm_document=None):
         """
         TAGS -> KEYWORDS
-        Writes the tags to OpenKM as keywords and confirms that they have been added
+        Adds and removes keywords on OpenKM so that they match the document's tags
+        :param okm_document: the OpenKM document as returned by get_properties, if already fetched
         :returns boolean:  True on success, False on fail
         """
         tags = self.sync_keywords.get_tags_from_document(document)
-#        logger.info("[GSA] Tags: %s", tags)
-        self.sync_keywords.write_keywords_to_openkm_document(document.okm_path, tags)
-        print("[GSA] Tags: %s", tags)
-        return self.sync_keywords.confirm_keywords_written_to_openkm(document.okm_path, tags)
+        current_keywords = None
+        if okm_document is not None:
+            current_keywords = getattr(okm_document, 'keywords', None) or []
+        added, removed = self.sync_keywords.sync_keywords(document.okm_path, tags, current_keywords)
+        logger.debug("Keywords added %s, removed %s on %s", added, removed, document.okm_path)
+        return True
 
     def get_category_uuids(self, document, openkm_folderlist_class):
+        category_index = cache.get_category_index(openkm_folderlist_class)
         category_uuids = []
         for related_model_class in settings.OPENKM['categories'].keys():
-            # prepare the lists of AND and OR predicates for the query
             mapped_category_name = self.category_map(related_model_class.__name__)
             if not mapped_category_name:
-                print 'Category not found'
+                logger.debug('No OpenKM category for %s', related_model_class.__name__)
                 continue
-            and_predicates = ['categories', mapped_category_name]
             fields = self.sync_categories.get_objects_from_m2m_model(document, related_model_class)
-            or_predicates = [field.__unicode__() for field in fields]
-            category_uuids += openkm_folderlist_class.objects.custom_path_query(and_predicates, or_predicates)
+            names = [field.__unicode__() for field in fields]
+            category_uuids += category_index.leaf_uuids(mapped_category_name, names)
         return category_uuids
 
     def get_categories(self, document, openkm_folderlist_class):
         """
-        Returns a queryset of the OpenKMFolderlist objects that match the categories of the document,
+        Returns a list of the OpenKMFolderlist records that match the categories of the document,
         where the mapping comes from OPENKM settings dict
         """
+        category_index = cache.get_category_index(openkm_folderlist_class)
         categories = []
         for related_model_class in settings.OPENKM['categories'].keys():
             try:
                 mapped_category_name = self.category_map(related_model_class.__name__)
                 if not mapped_category_name:
-                    print 'Category not found'
+                    logger.debug('No OpenKM category for %s', related_model_class.__name__)
                     continue
-                and_predicates = ['categories', mapped_category_name]
                 fields = self.sync_categories.get_objects_from_m2m_model(document, related_model_class)
-                or_predicates = [self._normalise_string(field.__unicode__()) for field in fields]
-                categories_temp = openkm_folderlist_class.objects.get_custom_queryset(and_predicates, or_predicates)
-                if not categories_temp:
-                    categories_temp = [] 
-                categories += categories_temp
+                names = [self._normalise_string(field.__unicode__()) for field in fields]
+                categories += category_index.leaves(mapped_category_name, names)
             except Exception, e:
                 logger.debug(e)
         return categories
@@ -563,25 +1023,35 @@ class DjangoToOpenKm(SyncDocument):
             _str = _str.replace(char, '')
         return _str
 
-    def categories(self, document, openkm_folderlist_class, update_individually=True):
+    def categories(self, document, openkm_folderlist_class, update_individually=True, okm_document=None):
         """
-        Using the MODEL_CATEGORY_MAP gets all the associated objects for each m2m relationship and adds
-        them as categories to the given document on OpenKM
+        Using the MODEL_CATEGORY_MAP gets all the associated objects for each m2m relationship and
+        makes the categories of the given document on OpenKM match them, adding and removing only
+        the categories that differ
         :param document_class: a class object.  This should be your Django model which extends the OpenKmDocument
         abstract base class
+        :param okm_document: the OpenKM document as returned by get_properties, if already fetched
         """
         category_uuids = self.get_category_uuids(document, openkm_folderlist_class)
 
         if update_individually:
-            # add the categories to the document
-            for category_uuid in category_uuids:
-                logger.info("Adding category [%s] to %s" % (category_uuid, document.okm_path))
-                self.category.add_to_node(document.okm_path, category_uuid)
-
+            if okm_document is None:
+                okm_document = self.document.get_properties(document.okm_path)
+            # leave alone any categories outside those mapped from Django models
+            managed = self.get_managed_category_names()
+            current_uuids = [category.uuid for category in getattr(okm_document, 'categories', None) or []
+                             if utils.get_category_segments(category.path)[0] in managed]
+            added, removed = self.sync_categories.sync_document_categories(document.okm_path, category_uuids,
+                                                                           current_uuids)
+            logger.info("Categories added %s, removed %s on %s", added, removed, document.okm_path)
+
+    def get_managed_category_names(self):
+        """ :returns the set of top level category names that are synced from Django models """
+        return set(self.map.get(klass.__name__) for klass in settings.OPENKM['categories'].keys()) - set([None])
 
     def properties(self, document):
-        sync_properties = SyncProperties()
-        sync_properties.django_to_openkm(document)
+        """ :returns True if every property group was written """
+        return self.sync_properties.django_to_openkm(document)
 
     map = {
         'Industry': 'Industries',
@@ -596,7 +1066,7 @@ class DjangoToOpenKm(SyncDocument):
         try:
             return self.map[model_class_name]
         except KeyError:
-            print model_class_name, ' not found'
+            logger.debug('%s not found in the category map', model_class_name)
             return False
 
 
@@ -610,8 +1080,8 @@ class CustomDjangoToOpenKM(DjangoToOpenKm):
         :param asset: Django model object instance that inherits from OpenKMDocument
         """
         self.asset = asset
-        self.document_client = client.Document()
         super(CustomDjangoToOpenKM, self).__init__(*args, **kwargs)
+        self.document_client = self.document
 
     def get_data(self):
         return self.document_client.create_document_data_object()
@@ -641,53 +1111,81 @@ class CustomDjangoToOpenKM(DjangoToOpenKm):
 
         if self.asset.is_linked_asset():
             source_path = self.asset.get_dms_source_path()
-            categories += openkm_folderlist_class.objects.filter(okm_path=source_path)
+            categories += cache.get_category_index(openkm_folderlist_class).get_by_path(source_path)
         return [self.document_client.create_category_folder_object(c.okm_path) for c in categories]
 
     def add_properties(self):
-        sync_properties = SyncProperties()
-        return sync_properties.django_to_openkm_improved(self.asset)
+        return self.sync_properties.django_to_openkm_improved(self.asset)
 
     def create(self, data):
         """
         If this is a link, then create the link file and attach it to the asset object
         """
-        content = facades.DocumentManager().convert_file_content_to_binary_for_transport(self.asset.file)
-        okm_document = self.document_client.create_document(content, data)
+        content, checksum, size = utils.encode_file_for_transport(self.asset.file)
+        okm_document = self.document_client.create_document(content, data, checksum=checksum, size=size)
         return okm_document
 
-    def update(self, data):
+    def is_protected(self):
+        """ True for assets that are never updated on OpenKM, those from CMI """
+        return self.asset.source == self.asset.CMI # direct request from Will to not update CMI
+
+    def update(self, data, upload_content=True):
         """
-        Updates an existing document: metadata and content
+        Updates an existing document: metadata and content.  Protected assets are left as they are.
+        :param upload_content: set to False to leave the content on OpenKM as it is
+        :returns boolean: True on success, False on fail
         """
-        if self.asset.source != self.asset.CMI: # direct request from Will to not update CMI
+        if not self.is_protected():
             doc_path = self.asset.okm_path
             
             try:
-                content = facades.DocumentManager().convert_file_content_to_binary_for_transport(self.asset.file)
-                self.document_client.set_content(doc_path=doc_path, content=content)
-                self.document_client.update_document(data)
+                checksum = size = None
+                if upload_content:
+                    content, checksum, size = utils.encode_file_for_transport(self.asset.file)
+                    self.document_client.set_content(doc_path=doc_path, content=content)
+                self.document_client.update_document(data, checksum=checksum, size=size)
             except Exception, e:
                 logger.exception(e)
+                return False
+        return True
 
-    def get_or_create(self, data):
-        okm_document = self.update(data) if self.asset.okm_uuid else self.create(data)
+    def get_or_create(self, data, upload_content=True):
+        """
+        :returns boolean: True on success, False on fail
+        """
+        if self.asset.okm_uuid:
+            return self.update(data, upload_content)
+        okm_document = self.create(data)
         if okm_document:
             self.asset.set_model_fields(okm_document)
             self.asset.save()
+        return bool(okm_document)
 
     def execute(self, folderlist_document_class, taxonomy=None):
         """
         Uploads a document in a single web service call.
         Important -- This relies on a modified OpenKM instance, use
-        execute() if you are using standard OpenKM
+        execute() if you are using standard OpenKM.
+        Nothing is sent if the asset has not changed since it was last synced, and
+        the content is only uploaded again if the file has changed.  Protected assets
+        already on OpenKM are not written, so their fingerprint is not recorded either.
+        :returns boolean: True on success, False on fail
         """
+        fingerprint = self.get_fingerprint(self.asset, folderlist_document_class)
+        changed = self.get_changed_sections(self.asset, fingerprint)
+        if self.asset.okm_uuid and (not changed or self.is_protected()):
+            return True
+
         data = self.get_data()
         data.document.path = self.asset.okm_path if self.asset.okm_path else self.build_path(taxonomy=taxonomy)
         data.document.keywords = [xml_clean(tag) for tag in self.asset.tags.split(',')]
         data.document.categories = self.add_categories(folderlist_document_class)
         data.properties = self.add_properties()
-        self.get_or_create(data)
+        if not self.get_or_create(data, upload_content='content' in changed):
+            return False
+        self.save_fingerprint(self.asset, fingerprint)
+        self.update_index(self.asset)
+        return True
 
     def fetch_preview(self, format, version=None):
         '''
@@ -703,14 +1201,16 @@ class OpenKmToDjango(SyncDocument):
         :param document: A Django model object instance of your Document object
         :param okm_document: An OKM Document object as returned by a webservice
         '''
-        self.keywords(document, okm_document)
-        self.properties(document)
+        self.keywords(document, okm_document, save=False)
+        self.properties(document, save=False)
+        document.save()
         self.categories(document, okm_document)
 
-    def keywords(self, document, okm_document):
+    def keywords(self, document, okm_document, save=True):
         '''
         :param document: a Django model instance for your document
         :param okm_document: an OpenKM Document instance
+        :param save: save the document afterwards
         '''
         if hasattr(okm_document, 'keywords') and okm_document.keywords:
             formatted_keywords = [unicode(keyword) for keyword in okm_document.keywords]
@@ -718,59 +1218,71 @@ class OpenKmToDjango(SyncDocument):
             document.tags = ', '.join(keywords)
         else:
             document.tags = ''
-        document.save()
-        print 'GSA tags: %s' % document.tags
-
+        if save:
+            document.save()
+        logger.debug('GSA tags: %s', document.tags)
 
-    def categories(self, document, okm_document):
+    @classmethod
+    def get_category_bin(cls, okm_document):
         '''
-        :param document: a Django model instance for your document
+        Sorts the categories of an OpenKM document by the related class they map to.
+        A classmethod, so callers such as bulk imports need no web service clients
         :param okm_document: an OpenKM Document instance
+        :returns dict { related class : list of object names }
         '''
         category_bin = {}
+        for category in getattr(okm_document, 'categories', None) or []:
+            try:
+                category_name, object_name = utils.get_category_from_path(category.path) # find the category
 
-        # add the categories from OpenKM to the dict
-        if hasattr(okm_document, 'categories'):
-            for category in okm_document.categories:
-                try:
-                    category_name, object_name = utils.get_category_from_path(category.path) # find the category
+                # use the map to translate the OKM category name to the Django model name
+                model_name = utils.find_key(SyncCategories.map, category_name)
+
+                category_bin = cls.add_category_to_dict(model_name, object_name, category_bin)
+            except ValueError, e:
+                logger.debug(e)
+
+        for related_class, values in category_bin.items():
+            # special case for Tasks. this would be better as one to one, but need to maps to the unicode val
+            if related_class.__name__ == 'Task':
+                category_bin[related_class] = [cls.sanitize_task_description(value) for value in values]
+        return category_bin
 
-                    # use the map to translate the OKM category name to the Django model name
-                    sync_categories = SyncCategories()
-                    model_name = utils.find_key(sync_categories.map, category_name)
+    @classmethod
+    def get_related_objects(cls, related_class, names):
+        '''
+        :returns dict { name : object } of the objects of related_class with the given names, in one query
+        '''
+        return dict((obj.name, obj) for obj in related_class.objects.filter(name__in=set(names)))
 
-                    category_bin = self.add_category_to_dict(model_name, object_name, category_bin)
-                except ValueError, e:
-                    logger.debug(e)
+    def categories(self, document, okm_document):
+        '''
+        :param document: a Django model instance for your document
+        :param okm_document: an OpenKM Document instance
+        '''
+        if not hasattr(okm_document, 'categories'):
+            return
 
-            print 'Category bin: ', category_bin
+        category_bin = self.get_category_bin(okm_document)
+        logger.debug('Category bin: %s', category_bin)
 
-            for related_class, values in category_bin.items():
-                try:
-                    # get the related manager for the class
-                    _set = getattr(document, "%s" % related_class.__name__.lower()) # get the m2m manager
-                    _set.clear() # remove the current objects
-
-                    # special case for Tasks. this would be better as one to one, but need to maps to the unicode val
-                    if related_class.__name__ == 'Task':
-                        values = [self.sanitize_task_description(value) for value in values]
-
-                    # get the objects and add them to the model
-                    objects = [related_class.objects.get(name=value) for value in values]
-                    [_set.add(obj) for obj in objects]
-                except AttributeError, e:
-                    print e
-                    logger.debug(e)
-                except Exception, e:
-                    print e
-                    logger.debug(e)
-
-
-    def sanitize_task_description(self, task):
+        for related_class, values in category_bin.items():
+            try:
+                # get the related manager for the class
+                _set = getattr(document, "%s" % related_class.__name__.lower()) # get the m2m manager
+                objects = self.get_related_objects(related_class, values)
+                _set.clear() # remove the current objects
+                _set.add(*objects.values())
+            except Exception, e:
+                logger.exception(e)
+
+    @classmethod
+    def sanitize_task_description(cls, task):
         p = re.compile('\[\w{0,4}\] [\d.: ]{0,9}')
         return p.sub('',task)
 
-    def add_category_to_dict(self, category_name, object_name, category_bin):
+    @classmethod
+    def add_category_to_dict(cls, category_name, object_name, category_bin):
         """
         { related class to the document : list of values }
         e.g. { Region: ['EMEA', 'Latin America'] }
@@ -796,9 +1308,29 @@ class OpenKmToDjango(SyncDocument):
             category_bin[related_class].append(object_name)
         return category_bin
 
-    def properties(self, document):
-        sync_properties = SyncProperties()
-        sync_properties.openkm_to_django(document)
+    def properties(self, document, save=True):
+        self.sync_properties.openkm_to_django(document, save=save)
+
+
+def get_concurrency():
+    """ The number of web service calls made at once for a single document """
+    return settings.OPENKM['configuration'].get('Concurrency', 4)
+
+
+def apply_changes(add, remove, current, desired):
+    """
+    Makes current match desired, calling add for each missing item and remove for
+    each surplus one, get_concurrency() calls at a time
+    :param add: callable taking an item
+    :param remove: callable taking an item
+    :param current: set of the items there are
+    :param desired: set of the items there should be
+    :returns a tuple of sets (items added, items removed)
+    """
+    to_add, to_remove = desired - current, current - desired
+    changes = [(add, item) for item in to_add] + [(remove, item) for item in to_remove]
+    utils.concurrent_map(lambda change: change[0](change[1]), changes, get_concurrency())
+    return to_add, to_remove
 
 
 def xml_clean(value):
@@ -1,11 +1,103 @@
+import os
+import Queue
+import shutil
+import hashlib
 import datetime
+import sqlite3
+import tempfile
+import threading
+import unittest
+import StringIO
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.conf import settings
+from django.db import models as django_models
+from django.db.models.signals import post_save
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.cache import cache as django_cache
+from django.core.paginator import Paginator
 
 import suds
 
-import client, facades, models, sync, utils
+import bulk, cache, client, exceptions, facades, feed, index, jobs, models, reconcile, services, sync, transfer, utils
+from management.commands import openkm_path_hashes
+
+
+class TestFolderList(models.OpenKmFolderList):
+    """ A concrete folder list, for tests that need a table """
+    class Meta:
+        app_label = 'openkm'
+
+
+class TestRegion(django_models.Model):
+    """ A model mapped to an OpenKM category, see TEST_CATEGORIES """
+    name = django_models.CharField(max_length=100)
+
+    class Meta:
+        app_label = 'openkm'
+
+    def __unicode__(self):
+        return self.name
+
+
+class TestDocument(models.OpenKmDocument):
+    """ A concrete document, for tests that need a table """
+    file = django_models.FileField(upload_to='openkm-tests', blank=True, null=True)
+    testregion = django_models.ManyToManyField(TestRegion, blank=True)
+
+    class Meta:
+        app_label = 'openkm'
+
+
+def make_node(path, uuid=None, version=None, keywords=(), categories=(), **fields):
+    """
+    A folder or document as returned by the web services.  Categories are given as
+    paths, and fields sets any other attributes, eg. mimeType
+    """
+    node = suds.sudsobject.Object()
+    node.uuid, node.path = uuid, path
+    node.author, node.hasChildren, node.permissions, node.subscribed = None, False, 15, False
+    node.actualVersion = suds.sudsobject.Object()
+    node.actualVersion.name = version
+    node.keywords = list(keywords)
+    node.categories = [make_node(category_path) for category_path in categories]
+    for name, value in fields.items():
+        setattr(node, name, value)
+    return node
+
+
+def fake_client(**methods):
+    """
+    A stand in for a web service client class.  Each method answers with the function given
+    for it, or None if None is given.  Every call is recorded in the calls list the instances
+    share, as (method name, arguments..., keyword arguments if any), and every instance in instances
+    """
+    calls, instances = [], []
+
+    def make_method(name, function):
+        def method(self, *args, **kwargs):
+            calls.append((name,) + args + ((kwargs,) if kwargs else ()))
+            if function is not None:
+                return function(*args, **kwargs)
+        return method
+
+    attributes = dict((name, make_method(name, function)) for name, function in methods.items())
+    attributes['__init__'] = lambda self: instances.append(self)
+    attributes['calls'], attributes['instances'] = calls, instances
+    attributes['called'] = lambda self, name: [call[1:] for call in calls if call[0] == name]
+    return type('FakeClient', (object,), attributes)
+
+
+class PatchMixin(object):
+    """ Replaces attributes for the length of a test, restoring them with addCleanup """
+
+    def patch(self, obj, name, value):
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+        return value
 
 
 class ClientTest(TestCase):
@@ -308,10 +400,30 @@ class SyncKeywordsTest(TestCase):
     def test_write_keywords_to_openkm_document(self):
         self.sync_keywords.write_keywords_to_openkm_document(self.path, self.tags)
 
+    def test_sync_keywords(self):
+        self.sync_keywords.sync_keywords(self.path, self.tags)
+        self.assertTrue(self.sync_keywords.confirm_keywords_written_to_openkm(self.path, self.tags))
+
     def tearDown(self):
         delete_test_document_on_openkm()
 
 
+class KeywordDeltaTest(TestCase):
+
+    def setUp(self):
+        # the delta is worked out without the keyword web service client
+        self.sync_keywords = sync.SyncKeywords.__new__(sync.SyncKeywords)
+
+    def test_get_keyword_delta(self):
+        to_add, to_remove = self.sync_keywords.get_keyword_delta(['One', 'Old'], [u'One', u' Two', u''])
+        self.assertEqual(to_add, set([u'Two']))
+        self.assertEqual(to_remove, set(['Old']))
+
+    def test_no_current_keywords(self):
+        to_add, to_remove = self.sync_keywords.get_keyword_delta(None, [u'One'])
+        self.assertEqual((to_add, to_remove), (set([u'One']), set()))
+
+
 class CategoryTest(TestCase):
 
     def setUp(self):
@@ -435,6 +547,660 @@ class SyncFolderListTest(TestCase):
         self.assertTrue(isinstance(paths, list), msg="Expected return value to be a list")
 
 
+def get_offline_folder_list():
+    """ A SyncFolderList without web service clients, for the methods that don't call OpenKM """
+    return sync.SyncFolderList.__new__(sync.SyncFolderList)
+
+
+def update_categories(test, folders):
+    """ Runs SyncFolderList.update_categories on TestFolderList with folders as OpenKM's categories """
+    test.patch(sync.client, 'Document', fake_client(get_categories=lambda: folders))
+    return get_offline_folder_list().update_categories(TestFolderList)
+
+
+class FolderValuesTest(PatchMixin, TestCase):
+    """ The folder list diff, which makes no web service calls """
+
+    def setUp(self):
+        self.folder_list = get_offline_folder_list()
+        self.kept = TestFolderList.objects.create(okm_uuid='kept', okm_path='/okm:categories/Region/EMEA')
+        self.changed = TestFolderList.objects.create(okm_uuid='changed', okm_path='/okm:categories/Region/APAC')
+        self.removed = TestFolderList.objects.create(okm_uuid='removed', okm_path='/okm:categories/Region/Old')
+
+    def values(self, path):
+        return self.folder_list.get_folder_values(make_node(path))
+
+    def test_created_updated_deleted(self):
+        incoming = {
+            'kept': self.values(self.kept.okm_path),
+            'changed': self.values('/okm:categories/Region/Asia Pacific'),
+            'new': self.values('/okm:categories/Region/Latin America'),
+        }
+        TestFolderList.objects.filter(pk=self.kept.pk).update(**incoming['kept'])
+        stats = self.folder_list.apply_folder_values(TestFolderList, incoming)
+        self.assertEqual(stats, {'created': 1, 'updated': 1, 'deleted': 1})
+        self.assertEqual(TestFolderList.objects.get(okm_uuid='changed').okm_name, 'asia pacific')
+        self.assertEqual(TestFolderList.objects.get(okm_uuid='new').okm_category, 'Region')
+        self.assertFalse(TestFolderList.objects.filter(okm_uuid='removed').exists())
+
+    def test_duplicate_rows_are_deleted(self):
+        TestFolderList.objects.create(okm_uuid='kept', okm_path=self.kept.okm_path)
+        incoming = dict((row.okm_uuid, self.values(row.okm_path)) for row in (self.kept, self.changed, self.removed))
+        self.folder_list.apply_folder_values(TestFolderList, incoming)
+        self.assertEqual(TestFolderList.objects.filter(okm_uuid='kept').count(), 1)
+        self.assertEqual(TestFolderList.objects.count(), 3)
+
+    def test_unreadable_folder_aborts_the_sync(self):
+        unreadable = suds.sudsobject.Object()
+        unreadable.uuid = 'changed'
+        self.assertRaises(sync.SyncFolderListException, update_categories, self,
+                          [make_node(self.kept.okm_path, 'kept'), unreadable])
+        self.assertEqual(TestFolderList.objects.count(), 3)
+
+
+class CategoryIndexTest(PatchMixin, TestCase):
+
+    def setUp(self):
+        self.index = cache.get_category_index(TestFolderList)
+        self.index.invalidate()
+        self.emea = TestFolderList.objects.create(okm_uuid='emea', okm_path='/okm:categories/Region/EMEA')
+        TestFolderList.objects.create(okm_uuid='apac', okm_path='/okm:categories/Region/APAC')
+
+    def test_leaf_uuids(self):
+        self.assertEqual(self.index.leaf_uuids('Region', ['emea', ' EMEA']), ['emea'])
+        self.assertEqual(self.index.leaf_uuids('Industry', ['EMEA']), [])
+
+    def test_get_by_path(self):
+        self.assertEqual([record.okm_uuid for record in self.index.get_by_path(self.emea.okm_path)], ['emea'])
+
+    def test_saving_a_row_invalidates(self):
+        self.index.leaf_uuids('Region', ['EMEA'])
+        TestFolderList.objects.create(okm_uuid='latam', okm_path='/okm:categories/Region/Latin America')
+        self.assertEqual(self.index.leaf_uuids('Region', ['Latin  America']), ['latam'])
+
+    def test_rebuilt_after_update_categories(self):
+        self.index.leaf_uuids('Region', ['EMEA'])
+        update_categories(self, [make_node('/okm:categories/Region/NA', 'na')])
+        self.assertEqual(self.index.leaf_uuids('Region', ['EMEA', 'NA']), ['na'])
+
+
+class FakeSyncer(object):
+    """ Stands in for DjangoToOpenKm, failing for the given pks """
+    def __init__(self, failing):
+        self.failing = failing
+        self.synced = []
+
+    def is_unchanged(self, document, folderlist_class):
+        return False
+
+    def run(self, document, folderlist_class, taxonomy=False):
+        if document.pk in self.failing:
+            raise Exception('Sync failed')
+        self.synced.append(document.pk)
+
+
+class OfflineBulkDjangoToOpenKm(bulk.BulkDjangoToOpenKm):
+
+    def __init__(self, syncer, *args, **kwargs):
+        super(OfflineBulkDjangoToOpenKm, self).__init__(*args, **kwargs)
+        self.syncer = syncer
+
+    def prefetch(self, queryset):
+        return queryset
+
+    def get_syncer(self):
+        return self.syncer
+
+
+class BulkCheckpointTest(PatchMixin, TestCase):
+
+    def setUp(self):
+        self.pks = [TestDocument.objects.create().pk for i in range(6)]
+        self.documents = TestDocument.objects.all()
+
+    def execute(self, failing, resume=False):
+        syncer = FakeSyncer(failing)
+        bulk_sync = OfflineBulkDjangoToOpenKm(syncer, TestFolderList, workers=2, chunk_size=2, checkpoint='tests')
+        return syncer, bulk_sync.execute(self.documents, resume=resume)
+
+    def test_checkpoint_is_held_before_the_first_failure(self):
+        syncer, result = self.execute(failing=[self.pks[2], self.pks[4]])
+        self.assertEqual(sorted(result.failed), [self.pks[2], self.pks[4]])
+        self.assertEqual(models.OpenKMSyncCheckpoint.get('tests').position, str(self.pks[1]))
+
+    def test_resume_retries_failures(self):
+        self.execute(failing=[self.pks[2]])
+        syncer, result = self.execute(failing=[], resume=True)
+        self.assertEqual(sorted(syncer.synced), self.pks[2:])
+        self.assertEqual(models.OpenKMSyncCheckpoint.get('tests').position, None)
+
+    def test_worker_connections_are_closed(self):
+        closed = []
+
+        class Connection(object):
+            def close(self):
+                closed.append(threading.current_thread().ident)
+        self.patch(bulk, 'connection', Connection())
+        self.execute(failing=[])
+        self.assertEqual(len(set(closed)), 2)
+        self.assertFalse(threading.current_thread().ident in closed)
+
+
+TEST_CATEGORIES = dict(settings.OPENKM, categories={TestRegion: 'Region'})
+
+
+class FakeSyncProperties(object):
+    """ Stands in for SyncProperties, recording the calls that would read or write properties on OpenKM """
+    def __init__(self, properties=None):
+        self.calls = []
+        self.properties = properties or {}
+        self.written = True
+
+    def openkm_to_django(self, document, save=True):
+        self.calls.append((document.pk, save))
+
+    def get_properties_dict(self, document):
+        return self.properties
+
+    def django_to_openkm(self, document):
+        self.calls.append(('django_to_openkm', document.pk))
+        return self.written
+
+    def django_to_openkm_improved(self, document):
+        return []
+
+
+class OfflineOpenKmToDjango(sync.OpenKmToDjango):
+
+    def __init__(self):
+        self.sync_properties = FakeSyncProperties()
+
+
+class FailingOpenKmToDjango(OfflineOpenKmToDjango):
+
+    def properties(self, document, save=True):
+        raise Exception('Properties could not be read')
+
+
+@override_settings(OPENKM=TEST_CATEGORIES)
+class OpenKmToDjangoTest(TestCase):
+
+    def setUp(self):
+        self.emea = TestRegion.objects.create(name='EMEA')
+        self.apac = TestRegion.objects.create(name='APAC')
+        self.document = TestDocument.objects.create()
+        self.okm_document = make_node('/okm:root/Uploads/a.pdf', keywords=['one', 'two'], categories=[
+            '/okm:categories/Region/EMEA', '/okm:categories/Region/APAC', '/okm:categories/Unmapped/Other'])
+        self.importer = OfflineOpenKmToDjango()
+
+    def test_get_category_bin(self):
+        category_bin = sync.OpenKmToDjango.get_category_bin(self.okm_document)
+        self.assertEqual(category_bin.keys(), [TestRegion])
+        self.assertEqual(sorted(category_bin[TestRegion]), ['APAC', 'EMEA'])
+
+    def test_get_related_objects(self):
+        objects = sync.OpenKmToDjango.get_related_objects(TestRegion, ['EMEA', 'EMEA', 'Unknown'])
+        self.assertEqual(objects, {'EMEA': self.emea})
+
+    def test_execute_saves_once(self):
+        saves = []
+
+        def record_save(sender, instance, **kwargs):
+            saves.append(instance.pk)
+        post_save.connect(record_save, sender=TestDocument)
+        try:
+            self.importer.execute(self.document, self.okm_document)
+        finally:
+            post_save.disconnect(record_save, sender=TestDocument)
+        self.assertEqual(saves, [self.document.pk])
+        self.assertEqual(self.importer.sync_properties.calls, [(self.document.pk, False)])
+        self.assertEqual(self.document.tags, 'one, two')
+        self.assertEqual(set(self.document.testregion.all()), set([self.emea, self.apac]))
+
+
+@override_settings(OPENKM=TEST_CATEGORIES)
+class BulkOpenKmToDjangoTest(PatchMixin, TestCase):
+
+    def setUp(self):
+        self.emea = TestRegion.objects.create(name='EMEA')
+        self.apac = TestRegion.objects.create(name='APAC')
+        self.patch(sync, 'OpenKmToDjango', OfflineOpenKmToDjango)
+
+    def test_categories_are_written_in_bulk(self):
+        documents = [TestDocument.objects.create() for i in range(3)]
+        documents[0].testregion.add(self.apac)
+        okm_documents = [make_node('/okm:root/Uploads/%s.pdf' % i, categories=['/okm:categories/Region/EMEA'])
+                         for i in range(3)]
+        # two queries to save each document, then one to look up the regions and one each to
+        # delete and insert the through rows, however many documents there are
+        with self.assertNumQueries(3 * 2 + 3):
+            result = bulk.BulkOpenKmToDjango(workers=2).execute(zip(documents, okm_documents))
+        self.assertEqual(sorted(result.succeeded), [document.pk for document in documents])
+        for document in documents:
+            self.assertEqual(list(document.testregion.all()), [self.emea])
+
+    def test_categories_need_no_importer(self):
+        document = TestDocument.objects.create()
+        utils._thread_local.__dict__.get('instances', {}).pop(OfflineOpenKmToDjango, None)
+        bulk.BulkOpenKmToDjango(workers=1).write_categories(
+            [(document, make_node('/okm:root/a.pdf', categories=['/okm:categories/Region/EMEA']))])
+        self.assertEqual(list(document.testregion.all()), [self.emea])
+        self.assertFalse(OfflineOpenKmToDjango in utils._thread_local.__dict__.get('instances', {}))
+
+    def test_documents_that_fail_to_read_are_not_saved(self):
+        document = TestDocument.objects.create()
+        self.patch(sync, 'OpenKmToDjango', FailingOpenKmToDjango)
+        with self.assertNumQueries(0):
+            result = bulk.BulkOpenKmToDjango(workers=1).execute([(document, make_node('/okm:root/a.pdf'))])
+        self.assertEqual(result.failed.keys(), [document.pk])
+        self.assertEqual(result.succeeded, [])
+
+
+def find_paginated(documents, offset, limit):
+    """ A page of documents as returned by Search.find_paginated """
+    result_set = suds.sudsobject.Object()
+    result_set.total = len(documents)
+    result_set.results = []
+    for document in documents[offset:offset + limit]:
+        result = suds.sudsobject.Object()
+        result.document, result.score = document, 1
+        result_set.results.append(result)
+    return result_set
+
+
+def make_form_element(name, value=None, options=None):
+    """ A property as returned by PropertyGroup.get_properties, a select if options are given """
+    element = suds.sudsobject.Object()
+    element.name, element.label = name, name.split('.')[-1]
+    if options is None:
+        element.value = value
+    else:
+        element.options = []
+        for option_value in options:
+            option = suds.sudsobject.Object()
+            option.label, option.value, option.selected = option_value.upper(), option_value, option_value == value
+            element.options.append(option)
+    return element
+
+
+class FakePropertyGroup(object):
+    """ Stands in for client.PropertyGroup, the document having the groups in properties """
+    def __init__(self, properties, forbidden=()):
+        self.properties = properties
+        self.forbidden = forbidden
+        self.calls = []
+
+    def get_groups(self, path):
+        self.calls.append(('get_groups',))
+        groups = []
+        for name in self.properties:
+            group = suds.sudsobject.Object()
+            group.name = name
+            groups.append(group)
+        return [groups]
+
+    def add_group(self, path, group_name):
+        self.calls.append(('add_group', group_name))
+        if group_name in self.forbidden:
+            raise exceptions.AccessDeniedException(group_name)
+        self.properties[group_name] = [make_form_element(group_name.replace('okg:', 'okp:') + '.type')]
+
+    def get_properties(self, path, group_name):
+        self.calls.append(('get_properties', group_name))
+        properties = suds.sudsobject.Object()
+        properties.item = self.properties[group_name]
+        return properties
+
+    def set_properties(self, path, group_name, properties):
+        self.calls.append(('set_properties', group_name, sorted(element.name for element in properties.item)))
+
+
+class PropertiesToOpenKmTest(TestCase):
+    """ SyncProperties.django_to_openkm, with the web services faked """
+
+    def setUp(self):
+        self.property_group = FakePropertyGroup({'okg:custom': [
+            make_form_element('okp:custom.title', 'Old title'),
+            make_form_element('okp:custom.languages', 'en', options=['en', 'de', 'fr']),
+        ]})
+        self.sync_properties = sync.SyncProperties.__new__(sync.SyncProperties)
+        self.sync_properties.property = facades.Property.__new__(facades.Property)
+        self.sync_properties.property.property_group = self.property_group
+        self.document = TestDocument(okm_path='/okm:root/Uploads/a.pdf')
+
+    def sync(self, properties):
+        self.sync_properties.get_properties_dict = lambda document: properties
+        return self.sync_properties.django_to_openkm(self.document)
+
+    def test_only_changed_values_are_sent(self):
+        self.assertTrue(self.sync({'okg:custom': {'okp:custom.title': ['Old title'],
+                                                  'okp:custom.languages': ['en', 'de']}}))
+        self.assertEqual(self.property_group.calls, [
+            ('get_groups',), ('get_properties', 'okg:custom'),
+            ('set_properties', 'okg:custom', ['okp:custom.languages'])])
+        options = self.property_group.properties['okg:custom'][1].options
+        self.assertEqual([option.value for option in options if option.selected], ['en', 'de'])
+
+    def test_unchanged_group_is_not_written(self):
+        self.assertTrue(self.sync({'okg:custom': {'okp:custom.title': ['Old title'], 'okp:custom.languages': ['EN']}}))
+        self.assertEqual(self.property_group.calls, [('get_groups',), ('get_properties', 'okg:custom')])
+
+    def test_missing_groups(self):
+        self.property_group.forbidden = ['okg:restricted']
+        written = self.sync({
+            'okg:sales': {'okp:sales.type': ['brochure']},
+            'okg:restricted': {'okp:restricted.type': ['secret']},
+            'okg:gsaProperties': {'okp:gsaProperties.startDate': ['2014-01-01']},
+            'okg:custom': {'okp:custom.title': ['New title']},
+        })
+        # the forbidden group is skipped, the others are still written
+        self.assertFalse(written)
+        calls = self.property_group.calls
+        self.assertEqual(calls.count(('get_groups',)), 1)
+        self.assertTrue(('add_group', 'okg:restricted') in calls)
+        self.assertTrue(('set_properties', 'okg:sales', ['okp:sales.type']) in calls)
+        self.assertTrue(('set_properties', 'okg:custom', ['okp:custom.title']) in calls)
+        # optional groups are never added
+        self.assertFalse([call for call in calls if 'okg:gsaProperties' in call])
+
+    def test_error_in_existing_group_is_raised(self):
+        self.property_group.get_properties = lambda path, group_name: 1 / 0
+        self.assertRaises(ZeroDivisionError, self.sync, {'okg:custom': {'okp:custom.title': ['New title']}})
+
+
+@override_settings(OPENKM=TEST_CATEGORIES)
+class DjangoToOpenKmRunTest(PatchMixin, TestCase):
+    """ DjangoToOpenKm.run end to end, with the web services faked """
+
+    def setUp(self):
+        cache.get_category_index(TestFolderList).invalidate()
+        TestFolderList.objects.create(okm_uuid='emea', okm_path='/okm:categories/Region/EMEA')
+        self.document = TestDocument.objects.create(okm_uuid='uuid-1', okm_path='/okm:root/Uploads/a.pdf')
+        self.document.testregion.add(TestRegion.objects.create(name='EMEA'))
+        self.document.tags = 'one, two'
+        self.syncer = self.make_syncer(sync.DjangoToOpenKm)
+        self.property = self.patch(sync.client, 'Property', fake_client(
+            add_keyword=None, remove_keyword=None, add_category=None, remove_category=None))
+
+    def make_syncer(self, klass):
+        syncer = klass.__new__(klass)
+        okm_document = make_node('/okm:root/Uploads/a.pdf', keywords=['one', 'old'])
+        syncer.document = fake_client(get_properties=lambda path: okm_document,
+                                      create_document_data_object=lambda: make_node(None, document=make_node(None)),
+                                      create_category_folder_object=make_node,
+                                      set_content=None, update_document=None)()
+        syncer.sync_keywords = sync.SyncKeywords.__new__(sync.SyncKeywords)
+        syncer.sync_categories = sync.SyncCategories.__new__(sync.SyncCategories)
+        syncer.sync_properties = FakeSyncProperties({'okg:custom': {'okp:custom.title': ['Report']}})
+        syncer.map = {'TestRegion': 'Region'}
+        return syncer
+
+    def run_sync(self):
+        del self.property.calls[:]
+        self.syncer.sync_properties.calls = []
+        self.syncer.run(self.document, TestFolderList)
+        # (method, keyword or category uuid)
+        return sorted((call[0], call[-1]) for call in self.property.calls), self.syncer.sync_properties.calls
+
+    def get_fetched(self, syncer):
+        return len(syncer.document.called('get_properties'))
+
+    def get_written(self, syncer):
+        return [(call[0], call[1].document.path if call[0] == 'update_document' else call[-1]['doc_path'])
+                for call in syncer.document.calls if call[0] in ('set_content', 'update_document')]
+
+    def test_first_run_writes_every_section(self):
+        calls, property_calls = self.run_sync()
+        self.assertEqual(calls, [('add_category', 'emea'), ('add_keyword', 'two'), ('remove_keyword', 'old')])
+        self.assertEqual(property_calls, [('django_to_openkm', self.document.pk)])
+        self.assertEqual(self.get_fetched(self.syncer), 1)
+        stored = TestDocument.objects.get(pk=self.document.pk).okm_sync_fingerprint
+        self.assertEqual(sync.SyncFingerprint.parse(stored).digests, self.syncer.get_fingerprint(
+            self.document, TestFolderList).digests)
+
+    def test_unchanged_sections_are_skipped(self):
+        self.run_sync()
+        self.assertEqual(self.run_sync(), ([], []))
+        self.assertEqual(self.get_fetched(self.syncer), 1)
+
+        # only the keywords are synced, against the keywords fetched from OpenKM
+        self.document.tags = 'one'
+        self.assertEqual(self.run_sync(), ([('remove_keyword', 'old')], []))
+        self.assertEqual(self.get_fetched(self.syncer), 2)
+
+    def test_unwritten_properties_count_as_changed(self):
+        self.syncer.sync_properties.written = False
+        self.run_sync()
+        previous = sync.SyncFingerprint.parse(self.document.okm_sync_fingerprint)
+        self.assertEqual(previous.digests['properties'], None)
+        self.assertEqual(self.syncer.get_changed_sections(self.document, self.syncer.get_fingerprint(
+            self.document, TestFolderList)), set(['properties']))
+
+    def test_protected_asset_is_not_fingerprinted(self):
+        syncer = self.make_syncer(sync.CustomDjangoToOpenKM)
+        syncer.document_client = syncer.document
+        syncer.asset = self.document
+        self.document.source, self.document.CMI = 'cmi', 'cmi'
+        self.document.is_linked_asset = lambda: False
+        self.assertTrue(syncer.execute(TestFolderList))
+        self.assertEqual(self.get_written(syncer), [])
+        self.assertEqual(TestDocument.objects.get(pk=self.document.pk).okm_sync_fingerprint, None)
+
+        self.document.source = 'gsa'
+        # as if the content were unchanged since it was last synced
+        content = syncer.get_fingerprint(self.document, TestFolderList).digests['content']
+        self.document.okm_sync_fingerprint = 'content=%s' % content
+        self.assertTrue(syncer.execute(TestFolderList))
+        self.assertEqual(self.get_written(syncer), [('update_document', '/okm:root/Uploads/a.pdf')])
+        self.assertNotEqual(TestDocument.objects.get(pk=self.document.pk).okm_sync_fingerprint, None)
+
+
+class ChangeFeedTest(PatchMixin, TestCase):
+
+    def setUp(self):
+        self.documents = [TestDocument.objects.create(okm_uuid='uuid-%s' % i) for i in range(3)]
+        self.modified = datetime.datetime(2026, 1, 1, 12)
+        self.okm_documents = []
+        for i in range(4):
+            okm_document = make_node('/okm:root/Uploads/%s.pdf' % i)
+            okm_document.uuid, okm_document.lastModified = 'uuid-%s' % i, self.modified
+            self.okm_documents.append(okm_document)
+        self.patch(sync, 'OpenKmToDjango', OfflineOpenKmToDjango)
+
+    def get_feed(self):
+        feed_ = feed.ChangeFeed(TestDocument, name='tests', page_size=2, workers=1)
+        feed_.search = fake_client(new_query_params=suds.sudsobject.Object,
+                                   find_paginated=lambda params, offset, limit: find_paginated(
+                                       self.okm_documents, offset, limit))()
+        return feed_
+
+    def get_queries(self, feed_):
+        return [(params.lastModifiedFrom, offset, limit)
+                for params, offset, limit in feed_.search.called('find_paginated')]
+
+    def test_first_poll_fetches_every_page(self):
+        feed_ = self.get_feed()
+        result = feed_.poll()
+        queries = self.get_queries(feed_)
+        self.assertEqual([(offset, limit) for since, offset, limit in queries], [(0, 2), (2, 2)])
+        self.assertEqual(queries[0][0], None)
+        self.assertEqual(sorted(result.succeeded), [document.pk for document in self.documents])
+        # the OpenKM document with no Django counterpart
+        self.assertEqual(result.skipped, ['uuid-3'])
+        self.assertTrue(feed_.get_high_water_mark() > self.modified)
+
+    def test_next_poll_overlaps_the_mark(self):
+        self.get_feed().poll()
+        feed_ = self.get_feed()
+        mark = feed_.get_high_water_mark()
+        feed_.poll()
+        self.assertEqual(self.get_queries(feed_)[0][0], mark - feed_.overlap)
+
+    def test_mark_is_held_at_the_earliest_failure(self):
+        self.patch(sync, 'OpenKmToDjango', FailingOpenKmToDjango)
+        feed_ = self.get_feed()
+        self.okm_documents[1].lastModified = self.modified - datetime.timedelta(hours=1)
+        result = feed_.poll()
+        self.assertEqual(len(result.failed), 3)
+        self.assertEqual(feed_.get_high_water_mark(), self.modified - datetime.timedelta(hours=1))
+
+    def test_mark_is_not_moved_when_a_failure_has_no_date(self):
+        feed_ = self.get_feed()
+        feed_.set_high_water_mark(self.modified)
+        self.patch(sync, 'OpenKmToDjango', FailingOpenKmToDjango)
+        del self.okm_documents[0].lastModified
+        feed_.poll()
+        self.assertEqual(feed_.get_high_water_mark(), self.modified)
+
+
+class FakeJobSyncer(object):
+    """ Stands in for DjangoToOpenKm in the worker, saving the document as a real sync does """
+    def __init__(self, error=None):
+        self.error = error
+        self.synced = []
+
+    def run(self, document, folderlist_class, taxonomy=False):
+        if self.error:
+            raise Exception(self.error)
+        document.okm_uuid = 'uuid-%s' % document.pk
+        document.save()
+        self.synced.append(document.pk)
+
+
+class JobsTest(TestCase):
+
+    def setUp(self):
+        self.document = TestDocument.objects.create()
+        self.worker = jobs.SyncWorker(name='tests')
+        self.syncer = FakeJobSyncer()
+        self.worker._syncers[jobs.Job.DJANGO_TO_OPENKM] = self.syncer
+
+    def tearDown(self):
+        post_save.disconnect(sender=TestDocument, dispatch_uid='openkm.jobs.TestDocument.%s' % jobs.Job.DJANGO_TO_OPENKM)
+
+    def test_enqueue_coalesces(self):
+        first = jobs.enqueue(self.document, TestFolderList, delay=0)
+        second = jobs.enqueue(self.document, TestFolderList, delay=0)
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(jobs.Job.objects.count(), 1)
+        self.assertEqual(first.folderlist, 'openkm.TestFolderList')
+
+    def test_claimed_jobs_are_not_claimed_again(self):
+        jobs.enqueue(self.document, TestFolderList, delay=0)
+        self.assertEqual(len(self.worker.claim()), 1)
+        self.assertEqual(jobs.SyncWorker(name='other').claim(), [])
+        self.assertEqual(jobs.Job.objects.get().claimed_by, 'tests')
+
+    def test_jobs_are_not_claimed_before_they_are_due(self):
+        jobs.enqueue(self.document, TestFolderList, delay=60)
+        self.assertEqual(self.worker.claim(), [])
+
+    def test_successful_job_is_deleted(self):
+        jobs.enqueue(self.document, TestFolderList, delay=0)
+        self.assertEqual(self.worker.run_once(), 1)
+        self.assertEqual(self.syncer.synced, [self.document.pk])
+        self.assertFalse(jobs.Job.objects.exists())
+
+    def test_saves_made_by_the_worker_do_not_enqueue(self):
+        jobs.connect(TestDocument, TestFolderList)
+        self.document.save()
+        self.assertEqual(jobs.Job.objects.count(), 1)
+        jobs.Job.objects.update(run_after=datetime.datetime.now())
+        self.worker.run_once()
+        self.assertFalse(jobs.Job.objects.exists())
+
+    def test_saves_while_running_requeue(self):
+        job = jobs.enqueue(self.document, TestFolderList, delay=0)
+        self.worker.claim()
+        jobs.enqueue(self.document, TestFolderList, delay=0)
+        self.worker.complete(jobs.Job.objects.get(pk=job.pk))
+        job = jobs.Job.objects.get(pk=job.pk)
+        self.assertEqual((job.state, job.requeue), (jobs.Job.PENDING, False))
+
+    def test_get_backoff(self):
+        with self.settings(OPENKM=dict(settings.OPENKM, configuration=dict(
+                settings.OPENKM['configuration'], SyncJobBackoff=30, SyncJobMaxBackoff=100))):
+            self.assertEqual([jobs.get_backoff(attempts) for attempts in (1, 2, 3, 4)], [30, 60, 100, 100])
+
+    def test_failed_job_is_retried_with_backoff(self):
+        self.syncer.error = 'OpenKM is down'
+        jobs.enqueue(self.document, TestFolderList, delay=0)
+        before = datetime.datetime.now()
+        self.worker.run_once()
+        job = jobs.Job.objects.get()
+        self.assertEqual((job.state, job.attempts, job.last_error), (jobs.Job.PENDING, 1, 'OpenKM is down'))
+        self.assertTrue(job.run_after >= before + datetime.timedelta(seconds=jobs.get_backoff(1)))
+        self.assertEqual(job.claimed_by, None)
+
+    def test_job_fails_after_max_attempts(self):
+        self.syncer.error = 'OpenKM is down'
+        self.worker.max_attempts = 2
+        jobs.enqueue(self.document, TestFolderList, delay=0)
+        for attempt in range(2):
+            jobs.Job.objects.update(run_after=datetime.datetime.now())
+            self.worker.run_once()
+        job = jobs.Job.objects.get()
+        self.assertEqual((job.state, job.attempts), (jobs.Job.FAILED, 2))
+        jobs.Job.objects.update(run_after=datetime.datetime.now())
+        self.assertEqual(self.worker.run_once(), 0)
+
+    def test_enqueue_resets_a_failed_job(self):
+        jobs.enqueue(self.document, TestFolderList, delay=0)
+        jobs.Job.objects.update(state=jobs.Job.FAILED, attempts=5, last_error='error')
+        job = jobs.enqueue(self.document, TestFolderList, delay=0)
+        job = jobs.Job.objects.get(pk=job.pk)
+        self.assertEqual((job.state, job.attempts, job.last_error), (jobs.Job.PENDING, 0, None))
+
+    def test_release_stale_jobs(self):
+        jobs.enqueue(self.document, TestFolderList, delay=0)
+        self.worker.claim()
+        jobs.Job.objects.update(claimed_at=datetime.datetime.now() - datetime.timedelta(days=1))
+        self.assertEqual(jobs.release_stale_jobs(), 1)
+        self.assertEqual(jobs.Job.objects.get().state, jobs.Job.PENDING)
+
+
+class DebounceTest(TestCase):
+
+    def setUp(self):
+        self.document = TestDocument.objects.create()
+        self.configuration = dict(settings.OPENKM['configuration'], SyncDebounceSeconds=10, SyncDebounceMaxSeconds=30)
+
+    def enqueue(self):
+        with self.settings(OPENKM=dict(settings.OPENKM, configuration=self.configuration)):
+            return jobs.enqueue(self.document, TestFolderList)
+
+    def test_burst_gives_one_job(self):
+        for i in range(5):
+            self.enqueue()
+        self.assertEqual(jobs.Job.objects.count(), 1)
+
+    def test_run_after_is_pushed_back(self):
+        job = self.enqueue()
+        first_run_after = job.run_after
+        jobs.Job.objects.filter(pk=job.pk).update(pending_since=job.pending_since - datetime.timedelta(seconds=5),
+                                                  run_after=first_run_after - datetime.timedelta(seconds=5))
+        job = self.enqueue()
+        self.assertTrue(job.run_after >= first_run_after)
+        self.assertEqual(jobs.Job.objects.get(pk=job.pk).run_after, job.run_after)
+
+    def test_never_postponed_beyond_the_maximum(self):
+        job = self.enqueue()
+        # as if first queued 25 seconds ago
+        pending_since = job.pending_since - datetime.timedelta(seconds=25)
+        jobs.Job.objects.filter(pk=job.pk).update(pending_since=pending_since,
+                                                  run_after=pending_since + datetime.timedelta(seconds=10))
+        for i in range(3):
+            job = self.enqueue()
+        self.assertEqual(jobs.Job.objects.get(pk=job.pk).run_after, pending_since + datetime.timedelta(seconds=30))
+
+    def test_run_after_is_never_brought_forward(self):
+        job = self.enqueue()
+        later = job.run_after + datetime.timedelta(hours=1)
+        jobs.Job.objects.filter(pk=job.pk).update(run_after=later)
+        self.enqueue()
+        self.assertEqual(jobs.Job.objects.get(pk=job.pk).run_after, later)
+
+
 class FileSystemTest(TestCase):
 
     def setUp(self):
@@ -451,6 +1217,353 @@ class FileSystemTest(TestCase):
         self.assertEqual(denormalised, self.django_str, msg="%s not as expected %s" % (denormalised, self.openkm_str))
 
 
+class CategorySegmentsTest(TestCase):
+
+    def test_category_leaf(self):
+        segments = utils.get_category_segments('/okm:categories/Region/Latin  America')
+        self.assertEqual(segments, ('Region', 'latin america'))
+
+    def test_category_root(self):
+        segments = utils.get_category_segments('/okm:categories/Region')
+        self.assertEqual(segments, ('Region', None))
+
+    def test_not_a_category(self):
+        segments = utils.get_category_segments('/okm:root/Uploads/EMEA')
+        self.assertEqual(segments, (None, None))
+
+
+class CategoryLeavesTest(TestCase):
+
+    def setUp(self):
+        for path in ('/okm:categories/Region/EMEA', '/okm:categories/Region/Latin America',
+                     '/okm:categories/Region/APAC', '/okm:categories/Industries/EMEA'):
+            TestFolderList.objects.create(okm_uuid=path.rsplit('/', 1)[-1] + path.split('/')[2], okm_path=path)
+
+    def query(self, leaves):
+        return sorted(TestFolderList.objects.custom_path_query(['categories', 'Region'], leaves))
+
+    def test_same_results_as_path_query(self):
+        for leaves in (['EMEA'], ['emea', 'Latin America'], ['apac', 'Atlantis']):
+            path_query = TestFolderList.objects.get_path_queryset(['categories', 'Region'], leaves)
+            self.assertEqual(self.query(leaves), sorted(row.okm_uuid for row in path_query))
+
+    def test_category_is_case_insensitive(self):
+        self.assertEqual(TestFolderList.objects.category_leaf_uuids('region', ['EMEA']), ['EMEARegion'])
+
+    def test_rows_without_segments_fall_back_to_the_path(self):
+        # as saved before okm_category and okm_name existed
+        TestFolderList.objects.update(okm_category=None, okm_name=None)
+        self.assertFalse(TestFolderList.objects.has_path_segments())
+        self.assertEqual(self.query(['EMEA', 'Latin America']), ['EMEARegion', 'Latin AmericaRegion'])
+
+
+class PathHashTest(TestCase):
+
+    def test_unicode_and_bytes_hash_equally(self):
+        self.assertEqual(utils.path_hash(u'/okm:root/Uploads/a.pdf'), utils.path_hash('/okm:root/Uploads/a.pdf'))
+
+    def test_none(self):
+        self.assertEqual(utils.path_hash(None), None)
+
+    def test_fill_path_hashes(self):
+        folder = TestFolderList.objects.create(okm_uuid='emea', okm_path='/okm:categories/Region/EMEA')
+        TestFolderList.objects.filter(pk=folder.pk).update(okm_path_hash=None)
+        self.assertFalse(TestFolderList.objects.filter_by_path(folder.okm_path).exists())
+        self.assertEqual(openkm_path_hashes.fill_path_hashes(TestFolderList, batch_size=1), 1)
+        self.assertEqual(TestFolderList.objects.get_by_path(folder.okm_path).pk, folder.pk)
+
+
+class OpenKMEventTest(TestCase):
+
+    def test_content_round_trip(self):
+        content = {'path': '/okm:root/Uploads/a.pdf', 'keywords': ['one', 'two']}
+        event = models.OpenKMEvent(occured=datetime.datetime.now(), content=content)
+        event.save()
+        event = models.OpenKMEvent.objects.get(pk=event.pk)
+        self.assertTrue(models.OpenKMEvent.is_encoded(event.content))
+        self.assertEqual(event.get_content(), content)
+
+    def test_saving_twice_does_not_re_encode(self):
+        event = models.OpenKMEvent(occured=datetime.datetime.now(), content='abc')
+        event.save()
+        event.save()
+        self.assertEqual(event.get_content(), 'abc')
+
+
+class DrainingQueue(Queue.Queue):
+    """ A queue that sets drained whenever a get() leaves it empty """
+    def __init__(self):
+        Queue.Queue.__init__(self)
+        self.drained = threading.Event()
+
+    def _get(self):
+        item = Queue.Queue._get(self)
+        if not self.queue:
+            self.drained.set()
+        return item
+
+
+class RecordingAuditSink(services.BufferedAuditSink):
+    """ Keeps the batches it would write to the database, and passes each to written as well """
+    def __init__(self, *args, **kwargs):
+        super(RecordingAuditSink, self).__init__(*args, **kwargs)
+        self.queue = DrainingQueue()
+        self.batches = []
+        self.written = Queue.Queue()
+
+    def _write(self, batch):
+        self.batches.append(batch)
+        self.written.put(batch)
+
+
+class BufferedAuditSinkTest(TestCase):
+
+    def test_flush_writes_events_gathered_by_the_thread(self):
+        sink = RecordingAuditSink(batch_size=100, flush_interval=60)
+        for event in range(3):
+            sink.put(event)
+        # wait for the thread to take the events off the queue into its batch
+        self.assertTrue(sink.queue.drained.wait(5))
+        sink.flush()
+        self.assertEqual(sum(sink.batches, []), [0, 1, 2])
+
+    def test_full_batches_are_written_without_waiting(self):
+        sink = RecordingAuditSink(batch_size=2, flush_interval=60)
+        for event in range(5):
+            sink.put(event)
+        self.assertEqual([sink.written.get(timeout=5), sink.written.get(timeout=5)], [[0, 1], [2, 3]])
+        sink.flush()
+        self.assertEqual(sink.batches[2:], [[4]])
+
+    def test_put_after_flush_restarts_the_thread(self):
+        sink = RecordingAuditSink(batch_size=100, flush_interval=60)
+        sink.put(0)
+        sink.flush()
+        sink.put(1)
+        sink.flush()
+        self.assertEqual(sum(sink.batches, []), [0, 1])
+
+
+class AuditEventTest(TestCase):
+
+    def test_size_and_checksum_are_those_passed(self):
+        event = services.OpenKMAuditService().build_event(models.OpenKMEvent.CREATE, 'token', 'YWJj',
+                                                          datetime.datetime.now(), '/okm:root/a.txt',
+                                                          checksum='a9993e36', size=3)
+        self.assertEqual((event.size, event.checksum), (3, 'a9993e36'))
+        self.assertEqual(event.content, None)
+
+    def test_encode_file_for_transport_measures_the_file(self):
+        content, checksum, size = utils.encode_file_for_transport(StringIO.StringIO('abc'))
+        self.assertEqual(content, 'YWJj')
+        self.assertEqual((checksum, size), (hashlib.sha1('abc').hexdigest(), 3))
+
+
+class SyncFingerprintTest(TestCase):
+
+    def setUp(self):
+        self.fingerprint = sync.SyncFingerprint.for_values(content='a.pdf', keywords=['one', 'two'],
+                                                           categories=['uuid-1'], properties={'g': {'p': ['v']}})
+
+    def test_round_trip(self):
+        parsed = sync.SyncFingerprint.parse(unicode(self.fingerprint))
+        self.assertEqual(self.fingerprint.changed_sections(parsed), set())
+
+    def test_changed_sections(self):
+        other = sync.SyncFingerprint.for_values(content='a.pdf', keywords=['one'],
+                                                categories=['uuid-1'], properties={'g': {'p': ['v']}})
+        self.assertEqual(other.changed_sections(self.fingerprint), set(['keywords']))
+
+    def test_everything_changed_when_never_synced(self):
+        changed = self.fingerprint.changed_sections(sync.SyncFingerprint.parse(None))
+        self.assertEqual(changed, set(sync.SyncFingerprint.SECTIONS))
+
+
+class ContentFingerprintTest(TestCase):
+
+    def setUp(self):
+        self.storage = FileSystemStorage(location=tempfile.mkdtemp())
+        self.name = self.storage.save('report.pdf', ContentFile('first version'))
+        self.file_obj = File(None, self.name)
+        self.file_obj.storage = self.storage
+        self.syncer = sync.DjangoToOpenKm.__new__(sync.DjangoToOpenKm)
+
+    def tearDown(self):
+        shutil.rmtree(self.storage.location)
+
+    def replace(self, content):
+        with open(self.storage.path(self.name), 'wb') as file_obj:
+            file_obj.write(content)
+
+    def test_replaced_content_changes_the_fingerprint(self):
+        before = self.syncer.get_content_fingerprint(self.file_obj)
+        self.replace('second version, longer')
+        self.assertNotEqual(self.syncer.get_content_fingerprint(self.file_obj), before)
+
+    def test_same_size_replacement_changes_the_fingerprint(self):
+        before = self.syncer.get_content_fingerprint(self.file_obj)
+        self.replace('other version')
+        modified = os.path.getmtime(self.storage.path(self.name)) + 10
+        os.utime(self.storage.path(self.name), (modified, modified))
+        self.assertNotEqual(self.syncer.get_content_fingerprint(self.file_obj), before)
+
+    def test_unchanged_file(self):
+        self.assertEqual(self.syncer.get_content_fingerprint(self.file_obj),
+                         self.syncer.get_content_fingerprint(self.file_obj))
+
+    def test_no_file(self):
+        self.assertEqual(self.syncer.get_content_fingerprint(None), None)
+
+
+class PopulatePropertyGroupTest(PatchMixin, TestCase):
+
+    def setUp(self):
+        self.sync_properties = sync.SyncProperties.__new__(sync.SyncProperties)
+        # each real client fetches the WSDL and logs in
+        self.document = self.patch(sync.client, 'Document', fake_client(
+            create_group_properties_object=lambda: make_node(None, properties=[]),
+            create_group_property_object=suds.sudsobject.Object))
+
+    def test_one_client_per_thread(self):
+        properties = dict(('okg:group%s' % i, {'okp:group%s.name' % i: 'value'}) for i in range(10))
+        for i in range(5):
+            groups = self.sync_properties.populate_property_group(properties)
+        self.assertEqual(len(groups), 10)
+        self.assertEqual(len(self.document.instances), 1)
+
+    def test_values(self):
+        groups = self.sync_properties.populate_property_group({'okg:group': {'okp:group.name': 'value'}})
+        self.assertEqual(groups[0].groupName, 'okg:group')
+        self.assertEqual([(p.name, p.values) for p in groups[0].properties], [('okp:group.name', ['value'])])
+
+    def test_list_values(self):
+        groups = self.sync_properties.populate_property_group({'okg:group': {'okp:group.name': ['one', 'two']}})
+        self.assertEqual(groups[0].properties[0].values, ['one', 'two'])
+
+
+class FakeFactory(object):
+    """ Stands in for a SUDS client factory, counting schema lookups """
+    def __init__(self):
+        self.resolver = self
+        self.builder = self
+        self.found = []
+
+    def find(self, name):
+        self.found.append(name)
+        if name != 'missing':
+            return name
+
+    def build(self, type):
+        obj = suds.sudsobject.Object()
+        obj.type = type
+        return obj
+
+
+class CreateObjectTest(TestCase):
+
+    def setUp(self):
+        self.document = client.Document.__new__(client.Document)
+        self.document.client = suds.sudsobject.Object()
+        self.document.client.factory = FakeFactory()
+
+    def test_types_are_looked_up_once(self):
+        for i in range(3):
+            data = self.document.create_document_data_object()
+            folder = self.document.create_category_folder_object('/okm:categories/Region/EMEA')
+        self.assertEqual(data.type, 'documentData')
+        self.assertEqual(folder.path, '/okm:categories/Region/EMEA')
+        self.assertEqual(self.document.client.factory.found, ['documentData', 'documentData.document.categories'])
+
+    def test_objects_are_not_shared(self):
+        self.assertFalse(self.document.create_group_property_object() is self.document.create_group_property_object())
+
+    def test_unknown_type(self):
+        self.assertRaises(suds.TypeNotFound, self.document.create_object, 'missing')
+
+
+class PropertyPlanTest(TestCase):
+
+    def setUp(self):
+        self.plan = sync.PropertyPlan({
+            'okg:customProperties': {
+                'okp:customProperties.title': {'attribute': 'name'},
+                'okp:customProperties.languages': {'attribute': 'languages', 'choices': None},
+            },
+            'okg:salesProperties': {
+                'okp:salesProperties.assetType': {'attribute': 'type', 'choices': (('sm', 'Solution Map'),)},
+            },
+            'okg:gsaProperties': {
+                'okp:gsaProperties.startDate': {'attribute': 'publish'},
+            },
+        })
+
+    def test_kinds(self):
+        group = self.plan.get('okg:customProperties')
+        self.assertEqual(group['okp:customProperties.title'].kind, 'value')
+        self.assertEqual(group['okp:customProperties.languages'].kind, 'language')
+        self.assertEqual(self.plan.get('okg:salesProperties')['okp:salesProperties.assetType'].kind, 'choice')
+
+    def test_choice_lookups(self):
+        mapping = self.plan.get('okg:salesProperties')['okp:salesProperties.assetType']
+        self.assertEqual(mapping.from_openkm('Solution Map'), 'sm')
+        self.assertEqual(mapping.from_openkm('Unknown'), False)
+
+    def test_gsa_properties_are_not_mapped(self):
+        self.assertEqual(self.plan.get('okg:gsaProperties'), {})
+
+
+class OutboundPropertiesTest(PatchMixin, TestCase):
+    """ The values SyncProperties sends to OpenKM, read through the compiled PropertyPlan """
+
+    def setUp(self):
+        self.sync_properties = sync.SyncProperties.__new__(sync.SyncProperties)
+        self.document = TestDocument(okm_path='/okm:root/doc.pdf')
+        self.document.__dict__.update(name=u'Title\x07', description=u'About', notes='Notes', publish_now=False,
+                                      publish=datetime.date(2013, 4, 20), expire=datetime.date(2014, 4, 20),
+                                      is_public=True, is_published=False, type=None, language=None, region='eu')
+
+    def use_plan(self, properties):
+        self.patch(sync, '_property_plan', sync.PropertyPlan(properties, sync.SyncProperties.GETTERS))
+
+    def test_default_getters(self):
+        self.use_plan({})
+        properties = self.sync_properties.get_properties_dict(self.document)
+        self.assertEqual(properties['okg:customProperties'], {
+            'okp:customProperties.title': [u'Title'],
+            'okp:customProperties.description': [u'About'],
+            'okp:customProperties.languages': ['en'],
+            'okp:customProperties.contentOwner': ['okmAdmin'],
+            'okp:customProperties.expirationDate': ['20140420000000'],
+            'okp:customProperties.public': ['True'],
+        })
+        self.assertEqual(properties['okg:salesProperties'], {'okp:salesProperties.assetType': ['']})
+        self.assertEqual(properties['okg:gsaProperties']['okp:gsaProperties.gsaPublishedStatus'], ['Not Published'])
+        self.assertEqual(properties['okg:gsaProperties']['okp:gsaProperties.startDate'], ['20130420000000'])
+
+    def test_settings_add_and_override_getters(self):
+        self.use_plan({
+            'okg:customProperties': {
+                'okp:customProperties.title': {'attribute': 'name', 'getter': 'get_content_owner'},
+                'okp:customProperties.summary': {'attribute': 'notes'},
+            },
+            'okg:regionProperties': {
+                'okp:regionProperties.region': {'attribute': 'region', 'choices': (('eu', 'Europe'),)},
+            },
+        })
+        properties = self.sync_properties.get_properties_dict(self.document)
+        self.assertEqual(properties['okg:customProperties']['okp:customProperties.title'], ['okmAdmin'])
+        self.assertEqual(properties['okg:customProperties']['okp:customProperties.summary'], [u'Notes'])
+        self.assertEqual(properties['okg:regionProperties'], {'okp:regionProperties.region': ['Europe']})
+
+    def test_populate_property_group_map(self):
+        self.use_plan({})
+        map = {'okg:customProperties': {'okp:customProperties.title': {'attribute': 'name'}},
+               'okg:otherProperties': {'okp:otherProperties.name': {'attribute': 'name'}}}
+        self.sync_properties.populate_property_group_map(map, self.document)
+        self.assertEqual(map['okg:customProperties']['okp:customProperties.title'], {'attribute': 'name', 'value': u'Title'})
+        self.assertEqual(map['okg:otherProperties']['okp:otherProperties.name'], {'attribute': 'name'})
+
+
 class TaxonomyTest(TestCase):
 
     def setUp(self):
@@ -468,6 +1581,594 @@ class TaxonomyTest(TestCase):
         self.taxonomy.build_path(dependencies)
 
 
+class FakeRepository(object):
+    """ Stands in for RepositoryManager, holding the set of folders on OpenKM """
+    def __init__(self, paths):
+        self.paths = set(paths)
+        self.checked = []
+
+    def has_node(self, path):
+        self.checked.append(path)
+        return path in self.paths
+
+
+class FakeFolder(object):
+    """ Stands in for FolderManager, creating folders in a FakeRepository """
+    def __init__(self, repository, created_elsewhere=()):
+        self.repository = repository
+        self.created_elsewhere = set(created_elsewhere)
+        self.created = []
+
+    def new(self):
+        return suds.sudsobject.Object()
+
+    def create(self, folder_obj):
+        if folder_obj.path in self.created_elsewhere:
+            raise exceptions.ItemExistsException(folder_obj.path)
+        self.created.append(folder_obj.path)
+        self.repository.paths.add(folder_obj.path)
+
+
+class EnsureFolderTest(TestCase):
+
+    def setUp(self):
+        cache.known_folders.clear()
+        self.repository = FakeRepository(['/okm:root', '/okm:root/Uploads'])
+        self.folder = FakeFolder(self.repository)
+        self.taxonomy = facades.Taxonomy()
+        self.taxonomy._repository, self.taxonomy._folder = self.repository, self.folder
+
+    def tearDown(self):
+        cache.known_folders.clear()
+
+    def test_only_the_missing_suffix_is_created(self):
+        self.taxonomy.ensure_folder('/okm:root/Uploads/EMEA/2012')
+        self.assertEqual(self.folder.created, ['/okm:root/Uploads/EMEA', '/okm:root/Uploads/EMEA/2012'])
+        self.assertEqual(self.repository.checked,
+                         ['/okm:root/Uploads/EMEA/2012', '/okm:root/Uploads/EMEA', '/okm:root/Uploads'])
+
+    def test_known_folders_are_not_checked_again(self):
+        self.taxonomy.ensure_folder('/okm:root/Uploads/EMEA/2012')
+        self.repository.checked = []
+        self.taxonomy.ensure_folder('/okm:root/Uploads/EMEA/2012')
+        self.taxonomy.ensure_folder('/okm:root/Uploads/EMEA/2013')
+        self.assertEqual(self.repository.checked, ['/okm:root/Uploads/EMEA/2013'])
+        self.assertEqual(self.folder.created[-1], '/okm:root/Uploads/EMEA/2013')
+
+    def test_folder_created_by_another_process(self):
+        self.folder.created_elsewhere.add('/okm:root/Uploads/EMEA')
+        self.taxonomy.ensure_folder('/okm:root/Uploads/EMEA/2012')
+        self.assertEqual(self.folder.created, ['/okm:root/Uploads/EMEA/2012'])
+        self.assertTrue('/okm:root/Uploads/EMEA' in cache.known_folders)
+
+    def test_build_path_from_dependencies(self):
+        self.taxonomy.build_path(self.taxonomy.generate_path_dependencies(['EMEA', '2012']))
+        self.assertEqual(self.folder.created, ['/okm:root/Uploads/EMEA', '/okm:root/Uploads/EMEA/2012'])
+
+
+class KnownFoldersTest(TestCase):
+
+    def setUp(self):
+        django_cache.clear()
+
+    def test_add_and_discard(self):
+        known_folders = cache.KnownFolders()
+        known_folders.add('/okm:root/Uploads/EMEA')
+        self.assertTrue('/okm:root/Uploads/EMEA' in known_folders)
+        known_folders.discard('/okm:root/Uploads/EMEA')
+        self.assertFalse('/okm:root/Uploads/EMEA' in known_folders)
+
+    def test_shared_through_the_django_cache(self):
+        configuration = dict(settings.OPENKM['configuration'], FolderCache=True)
+        with self.settings(OPENKM=dict(settings.OPENKM, configuration=configuration)):
+            cache.KnownFolders().add('/okm:root/Uploads/EMEA')
+            self.assertTrue('/okm:root/Uploads/EMEA' in cache.KnownFolders())
+        self.assertFalse('/okm:root/Uploads/EMEA' in cache.KnownFolders())
+
+
+class FakeCategory(object):
+    """ Stands in for facades.Category, with the children of /okm:categories/Region given """
+    children = []
+    created = []
+    fail = {}
+
+    def __init__(self):
+        self.folder = self
+
+    def get_children(self, path):
+        children = suds.sudsobject.Object()
+        children.item = [make_node('%s/%s' % (path, name)) for name in self.children]
+        return children
+
+    def construct_valid_path_string(self, base_path, name):
+        return '%s/%s' % (base_path, name)
+
+    def create(self, path):
+        if path in self.fail:
+            raise self.fail[path]
+        self.created.append(path)
+
+
+class CreateCategoriesTest(PatchMixin, TestCase):
+
+    def setUp(self):
+        for name in ('EMEA', 'APAC', 'Latin/America', 'Raced', 'Broken'):
+            TestRegion.objects.create(name=name)
+        FakeCategory.children, FakeCategory.created = ['EMEA'], []
+        FakeCategory.fail = {'/okm:categories/Region/Raced': exceptions.ItemExistsException(),
+                             '/okm:categories/Region/Broken': Exception('Access denied')}
+        self.sync_categories = sync.SyncCategories.__new__(sync.SyncCategories)
+        self.sync_categories.category = FakeCategory()
+        self.patch(sync.facades, 'Category', FakeCategory)
+
+    def test_only_missing_categories_are_created(self):
+        counts = self.sync_categories.create_categories_from_django_model(TestRegion, 'Region', workers=1)
+        self.assertEqual(sorted(FakeCategory.created), ['/okm:categories/Region/APAC',
+                                                        '/okm:categories/Region/Latin--America'])
+        self.assertEqual(dict(counts), {'created': 2, 'skipped': 2, 'failed': 1})
+
+    def test_get_child_category_names(self):
+        self.assertEqual(self.sync_categories.get_child_category_names('/okm:categories/Region'), set(['EMEA']))
+
+
+class TransferManifestTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'manifest')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_entries_are_read_back(self):
+        manifest = transfer.TransferManifest(self.path)
+        manifest.record('/okm:root/a.txt', size=1, sha1='x')
+        manifest.record('/okm:root/b.txt', size=2, sha1='y')
+        manifest.record('/okm:root/a.txt', size=3, sha1='z')
+        manifest.close()
+        # an interrupted write leaves a partial last line
+        with open(self.path, 'a') as manifest_file:
+            manifest_file.write('{"path": "/okm:root/c.txt", "si')
+
+        manifest = transfer.TransferManifest(self.path)
+        self.assertEqual(manifest.get('/okm:root/a.txt'), {'size': 3, 'sha1': 'z'})
+        self.assertEqual(manifest.get('/okm:root/b.txt'), {'size': 2, 'sha1': 'y'})
+        self.assertEqual(manifest.get('/okm:root/c.txt'), None)
+        manifest.close()
+
+
+class DirectoryImporterUploadTest(PatchMixin, TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.local_path = os.path.join(self.source, 'a.txt')
+        self.write('first')
+        self.importer = transfer.DirectoryImporter.__new__(transfer.DirectoryImporter)
+        self.importer.overwrite = False
+        self.importer.manifest_path = os.path.join(self.source, transfer.DirectoryImporter.MANIFEST_NAME)
+        self.importer.manifest = transfer.TransferManifest(self.importer.manifest_path)
+        self.document = self.patch(transfer.client, 'Document', fake_client(
+            new=suds.sudsobject.Object, create=None, checkout=None, set_content=None, checkin=None))
+        self.patch(transfer.client, 'Repository', fake_client(has_node=lambda path: True))
+
+    def tearDown(self):
+        self.importer.manifest.close()
+        shutil.rmtree(self.source)
+
+    def write(self, content, mtime=None):
+        with open(self.local_path, 'wb') as file_obj:
+            file_obj.write(content)
+        if mtime is not None:
+            os.utime(self.local_path, (mtime, mtime))
+
+    def upload(self):
+        return self.importer.upload((self.local_path, '/okm:root/Archive/a.txt'))
+
+    def get_uploads(self):
+        """ :returns a list of ('create' or 'update', path) """
+        return [('create', call[1].path) if call[0] == 'create' else ('update', call[1])
+                for call in self.document.calls if call[0] in ('create', 'set_content')]
+
+    def resume(self):
+        """ Reopens the manifest as a new run of the import would """
+        self.importer.manifest.close()
+        self.importer.manifest = transfer.TransferManifest(self.importer.manifest_path)
+
+    def test_unchanged_file_is_skipped_after_resume(self):
+        self.assertEqual(self.upload(), ('/okm:root/Archive/a.txt', None, False, 5))
+        self.resume()
+        self.assertEqual(self.upload(), ('/okm:root/Archive/a.txt', None, True, 0))
+        self.assertEqual(self.get_uploads(), [('create', '/okm:root/Archive/a.txt')])
+
+    def test_touched_file_with_same_content_is_skipped(self):
+        self.write('first', mtime=1000000000)
+        self.upload()
+        self.write('first', mtime=1000000100)
+        self.assertEqual(self.upload(), ('/okm:root/Archive/a.txt', None, True, 0))
+        self.assertEqual(len(self.get_uploads()), 1)
+        # the new modification time is recorded, so the next run skips without reading
+        self.assertEqual(self.importer.manifest.get('/okm:root/Archive/a.txt')['mtime'], 1000000100)
+
+    def test_changed_file_is_updated(self):
+        self.write('first', mtime=1000000000)
+        self.upload()
+        self.write('second', mtime=1000000100)
+        self.resume()
+        self.assertEqual(self.upload(), ('/okm:root/Archive/a.txt', None, False, 6))
+        self.assertEqual(self.get_uploads(),
+                         [('create', '/okm:root/Archive/a.txt'), ('update', '/okm:root/Archive/a.txt')])
+        self.assertEqual(self.importer.manifest.get('/okm:root/Archive/a.txt')['sha1'],
+                         hashlib.sha1('second').hexdigest())
+
+
+class SubtreeExporterDownloadTest(PatchMixin, TestCase):
+
+    def setUp(self):
+        self.destination = tempfile.mkdtemp()
+        self.exporter = transfer.SubtreeExporter('/okm:root/Archive', self.destination, metadata=False)
+        self.exporter.manifest = transfer.TransferManifest(self.exporter.manifest_path)
+        # the same content for every path
+        self.downloads = self.patch(transfer.client, 'Document', fake_client(
+            get_content=lambda path: 'Y29udGVudA==')).calls
+
+    def tearDown(self):
+        self.exporter.manifest.close()
+        shutil.rmtree(self.destination)
+
+    def at_version(self, version):
+        return make_node('/okm:root/Archive/2014/a.txt', 'uuid-1', version)
+
+    def test_download(self):
+        self.assertEqual(self.exporter.download(self.at_version('1.0')),
+                         ('/okm:root/Archive/2014/a.txt', None, False, 7))
+        with open(os.path.join(self.destination, '2014', 'a.txt')) as file_obj:
+            self.assertEqual(file_obj.read(), 'content')
+        self.assertEqual(self.exporter.manifest.get('/okm:root/Archive/2014/a.txt')['version'], '1.0')
+
+    def test_same_version_is_skipped(self):
+        self.exporter.download(self.at_version('1.0'))
+        self.assertEqual(self.exporter.download(self.at_version('1.0')),
+                         ('/okm:root/Archive/2014/a.txt', None, True, 0))
+        self.assertEqual(len(self.downloads), 1)
+
+    def test_new_version_is_downloaded(self):
+        self.exporter.download(self.at_version('1.0'))
+        self.assertEqual(self.exporter.download(self.at_version('1.1'))[2], False)
+        self.assertEqual(len(self.downloads), 2)
+
+    def test_deleted_local_file_is_downloaded_again(self):
+        self.exporter.download(self.at_version('1.0'))
+        os.remove(os.path.join(self.destination, '2014', 'a.txt'))
+        self.assertEqual(self.exporter.download(self.at_version('1.0'))[2], False)
+        self.assertEqual(len(self.downloads), 2)
+
+    def test_unknown_version_is_never_skipped(self):
+        self.exporter.download(self.at_version(None))
+        self.assertEqual(self.exporter.download(self.at_version(None))[2], False)
+
+
+class ReconcilerTest(PatchMixin, TestCase):
+
+    def setUp(self):
+        self.listing = reconcile.OpenKmListing()
+        self.listing.add([make_node('/okm:root/a.txt', 'uuid-a', '1.0'),
+                          make_node('/okm:root/moved/b.txt', 'uuid-b', '1.0'),
+                          make_node('/okm:root/c.txt', 'uuid-c', '1.1'),
+                          make_node('/okm:root/z.txt', 'uuid-z', '1.0')])
+        # where OpenKM finds the documents missing from the listing
+        self.locations = {
+            'uuid-d': exceptions.PathNotFoundException(),
+            'uuid-e': Exception('Connection refused'),
+            'uuid-f': make_node('/okm:elsewhere/f.txt', 'uuid-f', '1.0'),
+        }
+        self.patch(reconcile.client, 'Document', fake_client(get_path=self.get_path, get_properties=self.get_properties))
+        self.pks = {}
+        for name in 'abcdefg':
+            uuid = 'uuid-%s' % name if name != 'g' else None
+            path = '/okm:root/%s.txt' % name if uuid else None
+            document = TestDocument.objects.create(okm_uuid=uuid, okm_path=path, okm_latest_version='1.0',
+                                                   okm_filename='%s.txt' % name)
+            self.pks[name] = document.pk
+
+    def tearDown(self):
+        self.listing.close()
+
+    def get_path(self, uuid):
+        location = self.locations[uuid]
+        if isinstance(location, Exception):
+            raise location
+        return location.path
+
+    def get_properties(self, path):
+        return [document for document in self.locations.values() if getattr(document, 'path', None) == path][0]
+
+    def compare(self, repair=False):
+        reconciler = reconcile.Reconciler(TestDocument, path='/okm:root', workers=1, repair=repair)
+        result = reconcile.ReconcileResult()
+        for chunk in reconciler.get_chunks():
+            reconciler.compare(chunk, self.listing, result)
+        return result
+
+    def pks_of(self, names):
+        return sorted(self.pks[name] for name in names)
+
+    def test_classification(self):
+        result = self.compare()
+        self.assertEqual(result.checked, 7)
+        self.assertEqual(sorted(result.moved), self.pks_of('bf'))
+        self.assertEqual(result.stale, self.pks_of('c'))
+        self.assertEqual(result.missing, self.pks_of('d'))
+        self.assertEqual(result.unknown, self.pks_of('e'))
+        self.assertEqual(result.unsynced, self.pks_of('g'))
+        self.assertEqual(self.listing.count(matched=False), 1)
+
+    def test_apply_repairs(self):
+        self.compare(repair=True)
+        documents = TestDocument.objects.in_bulk(self.pks.values())
+        moved = documents[self.pks['b']]
+        self.assertEqual((moved.okm_path, moved.okm_filename), ('/okm:root/moved/b.txt', 'b.txt'))
+        self.assertEqual(moved.okm_path_hash, utils.path_hash('/okm:root/moved/b.txt'))
+        self.assertEqual(documents[self.pks['f']].okm_path, '/okm:elsewhere/f.txt')
+        self.assertEqual(documents[self.pks['c']].okm_latest_version, '1.1')
+        missing = documents[self.pks['d']]
+        self.assertEqual((missing.okm_uuid, missing.okm_path, missing.okm_path_hash), (None, None, None))
+        # a document that could not be looked up keeps its metadata
+        unknown = documents[self.pks['e']]
+        self.assertEqual((unknown.okm_uuid, unknown.okm_path), ('uuid-e', '/okm:root/e.txt'))
+
+    def test_locate_raises_other_errors(self):
+        reconciler = reconcile.Reconciler(TestDocument, path='/okm:root')
+        self.assertEqual(reconciler.locate('uuid-d'), None)
+        self.assertRaises(Exception, reconciler.locate, 'uuid-e')
+        self.assertEqual(reconciler.locate('uuid-f'), ('/okm:elsewhere/f.txt', '1.0'))
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000000000.0
+
+    def time(self):
+        return self.now
+
+
+class CountingSearch(object):
+    """ A client.Search stand in counting the searches that reach OpenKM """
+    searches = 0
+
+    @cache.cached_search
+    def by_keyword(self, keywords):
+        CountingSearch.searches += 1
+        return suds.sudsobject.Object()
+
+    @cache.invalidates_search
+    def add_keyword(self, path, keyword):
+        pass
+
+
+class SearchCacheTest(PatchMixin, TestCase):
+
+    def setUp(self):
+        self.patch(cache, 'time', FakeClock())
+        self.patch(cache, '_search_cache', None)
+        CountingSearch.searches = 0
+
+    def test_make_key(self):
+        self.assertEqual(cache.SearchCache.make_key('by_name', '  annual   report '),
+                         cache.SearchCache.make_key('by_name', 'annual report'))
+        self.assertEqual(cache.SearchCache.make_key('by_keyword', ['sales', 'emea']),
+                         cache.SearchCache.make_key('by_keyword', ['emea', 'sales', 'emea']))
+        self.assertNotEqual(cache.SearchCache.make_key('by_name', 'report'),
+                            cache.SearchCache.make_key('by_content', 'report'))
+
+    def test_results_are_shared(self):
+        search_cache = cache.SearchCache()
+        result = suds.sudsobject.Object()
+        search_cache.set('key', result)
+        self.assertTrue(search_cache.get('key') is result)
+        self.assertEqual((search_cache.hits, search_cache.misses), (1, 0))
+
+    def test_timeout(self):
+        search_cache = cache.SearchCache(timeout=60)
+        search_cache.set('key', 'result')
+        cache.time.now += 59
+        self.assertEqual(search_cache.get('key'), 'result')
+        cache.time.now += 2
+        self.assertEqual(search_cache.get('key'), None)
+        self.assertEqual(len(search_cache), 0)
+
+    def test_max_entries(self):
+        search_cache = cache.SearchCache(max_entries=2)
+        search_cache.set('a', 'result')
+        search_cache.set('b', 'result')
+        search_cache.get('a')
+        search_cache.set('c', 'result')
+        # b is the least recently used
+        self.assertEqual([search_cache.get(key) for key in 'abc'], ['result', None, 'result'])
+
+    def test_max_bytes(self):
+        # each entry is 1 byte of key and 12 of JSON encoded result
+        search_cache = cache.SearchCache(max_bytes=30)
+        search_cache.set('a', 'x' * 10)
+        search_cache.set('b', 'x' * 10)
+        self.assertEqual(len(search_cache), 2)
+        search_cache.set('c', 'x' * 10)
+        self.assertEqual([search_cache.get(key) for key in 'abc'], [None, 'x' * 10, 'x' * 10])
+        # too large to ever be cached
+        search_cache.set('d', 'x' * 30)
+        self.assertEqual((search_cache.get('d'), len(search_cache)), (None, 2))
+
+    def test_cached_search_and_invalidation(self):
+        configuration = dict(settings.OPENKM['configuration'], SearchCache=True)
+        with self.settings(OPENKM=dict(settings.OPENKM, configuration=configuration)):
+            search = CountingSearch()
+            search.by_keyword(['sales', 'emea'])
+            search.by_keyword(['emea', 'sales'])
+            self.assertEqual(CountingSearch.searches, 1)
+            search.add_keyword('/okm:root/a.txt', 'sales')
+            self.assertEqual(len(cache.get_search_cache()), 0)
+            search.by_keyword(['sales', 'emea'])
+            self.assertEqual(CountingSearch.searches, 2)
+
+    def test_disabled(self):
+        configuration = dict(settings.OPENKM['configuration'], SearchCache=False)
+        with self.settings(OPENKM=dict(settings.OPENKM, configuration=configuration)):
+            CountingSearch().by_keyword(['sales'])
+            CountingSearch().by_keyword(['sales'])
+            self.assertEqual(CountingSearch.searches, 2)
+
+
+class PagedSearchManager(facades.SearchManager):
+    """ A SearchManager over total fake hits, recording the offset of every page fetched """
+
+    def __init__(self, total):
+        self.documents = [make_node('/okm:root/%03d.txt' % i, 'uuid-%s' % i, '1.0') for i in range(total)]
+        self.offsets = []
+
+    def new_query_params(self):
+        return suds.sudsobject.Object()
+
+    def find_paginated(self, params, offset, limit):
+        self.offsets.append(offset)
+        self.params = params
+        return find_paginated(self.documents, offset, limit)
+
+
+class SearchResultsTest(TestCase):
+
+    def setUp(self):
+        self.search = PagedSearchManager(45)
+        self.results = self.search.find_documents(name='report', keywords=['sales', 'emea'], page_size=20)
+
+    def test_find_documents(self):
+        self.assertEqual(self.search.offsets, [])
+        len(self.results)
+        self.assertEqual((self.search.params.name, self.search.params.keywords), ('report', 'sales emea'))
+
+    def test_len_fetches_one_page(self):
+        self.assertEqual(len(self.results), 45)
+        self.assertEqual(self.search.offsets, [0])
+
+    def test_indexing(self):
+        self.assertEqual(self.results[25].path, '/okm:root/025.txt')
+        self.assertEqual(self.results[-1].path, '/okm:root/044.txt')
+        self.results[30]
+        self.assertEqual(self.search.offsets, [20, 40])
+        self.assertRaises(IndexError, lambda: self.results[45])
+
+    def test_slicing(self):
+        records = self.results[18:22]
+        self.assertEqual([record.uuid for record in records], ['uuid-18', 'uuid-19', 'uuid-20', 'uuid-21'])
+        self.assertEqual(sorted(self.search.offsets), [0, 20])
+
+    def test_iteration(self):
+        self.assertEqual(len(list(self.results)), 45)
+        self.assertEqual(self.search.offsets, [0, 20, 40])
+        self.assertTrue(isinstance(iter(self.results).next(), facades.NodeRecord))
+
+    def test_paginator(self):
+        paginator = Paginator(self.results, 10)
+        self.assertEqual((paginator.count, paginator.num_pages), (45, 5))
+        page = paginator.page(3)
+        self.assertEqual([record.path for record in page.object_list][0], '/okm:root/020.txt')
+        self.assertEqual(len(page.object_list), 10)
+        self.assertEqual(len(paginator.page(5).object_list), 5)
+        # the count fetches the first page of results, paginator pages 3 and 5 the second and third
+        self.assertEqual(sorted(self.search.offsets), [0, 20, 40])
+
+    def test_page(self):
+        self.assertEqual([record.path for record in self.results.page(3)],
+                         ['/okm:root/%03d.txt' % i for i in range(40, 45)])
+        self.assertEqual(self.search.offsets, [40])
+
+
+def has_fts5():
+    try:
+        sqlite3.connect(':memory:').execute('CREATE VIRTUAL TABLE fts USING fts5 (text)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+@unittest.skipUnless(has_fts5(), 'SQLite was built without FTS5')
+class MetadataIndexTest(PatchMixin, TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = index.MetadataIndex(os.path.join(self.directory, 'index.sqlite'), workers=1)
+        # every document has an okg:sales group, holding its region
+        regions = {'/okm:root/Reports/Annual report 2014.pdf': 'Northern Europe'}
+        self.patch(index.client, 'PropertyGroup', fake_client(
+            get_groups=lambda path: [[make_node(None, name='okg:sales')]],
+            get_properties=lambda path, group_name: [[make_form_element('okp:sales.region', regions.get(path))]]))
+        self.index.update_documents([
+            make_node('/okm:root/Reports/Annual report 2014.pdf', 'uuid-1', '1.0', ['sales', 'emea'],
+                      ['/okm:categories/Region/EMEA'], mimeType='application/pdf'),
+            make_node('/okm:root/Reports/Quarterly summary.doc', 'uuid-2', '1.0', ['sales'],
+                      mimeType='application/msword'),
+            make_node('/okm:root/Reports_old/annual_review.pdf', 'uuid-3', '1.0', mimeType='application/pdf'),
+            make_node('/okm:root/ReportsXold/annals.pdf', 'uuid-4', '1.0', mimeType='application/pdf'),
+        ])
+
+    def tearDown(self):
+        self.index.get_connection().close()
+        shutil.rmtree(self.directory)
+
+    def find(self, **criteria):
+        return [record.uuid for record in self.index.find_documents(**criteria)]
+
+    def test_name_prefix(self):
+        self.assertEqual(self.find(name='ann'), ['uuid-1', 'uuid-4', 'uuid-3'])
+        self.assertEqual(self.find(name='annual rep'), ['uuid-1'])
+        self.assertEqual(self.find(name='report 2014'), ['uuid-1'])
+
+    def test_keywords(self):
+        self.assertEqual(self.find(keywords=['sales']), ['uuid-1', 'uuid-2'])
+        self.assertEqual(self.find(keywords=['sales', 'emea']), ['uuid-1'])
+        self.assertEqual(self.find(keywords=['sale']), [])
+
+    def test_path(self):
+        self.assertEqual(self.find(path='/okm:root/Reports/'), ['uuid-1', 'uuid-2'])
+        # _ is not a LIKE wildcard
+        self.assertEqual(self.find(path='/okm:root/Reports_old'), ['uuid-3'])
+
+    def test_text(self):
+        self.assertEqual(self.find(text='northern'), ['uuid-1'])
+        self.assertEqual(self.find(text='emea'), ['uuid-1'])
+        self.assertEqual(self.find(text='sales quarterly'), ['uuid-2'])
+
+    def test_other_criteria(self):
+        self.assertEqual(self.find(categories=['/okm:categories/Region/EMEA']), ['uuid-1'])
+        self.assertEqual(self.find(properties={'okp:sales.region': 'Northern Europe'}), ['uuid-1'])
+        self.assertEqual(self.find(mime_type='application/msword'), ['uuid-2'])
+
+    def test_query_syntax_is_quoted(self):
+        self.assertEqual(self.find(name='annual OR quarterly'), [])
+        # a stray quote is part of the word, which the tokenizer then drops
+        self.assertEqual(self.find(name='"annual'), ['uuid-1', 'uuid-3'])
+        self.assertEqual(self.find(text='sales NEAR( -emea *'), [])
+        self.assertEqual(index.match_expression('say "hi"', 'name'), 'name : ("say"* """hi"""*)')
+
+    def test_pagination(self):
+        results = self.index.find_documents(page_size=3)
+        self.assertEqual(len(results), 4)
+        self.assertEqual([record.uuid for record in results.page(2)], ['uuid-3'])
+        self.assertEqual(results[1].path, '/okm:root/Reports/Quarterly summary.doc')
+        self.assertEqual(results[1].keywords, ['sales'])
+
+    def test_update_and_remove(self):
+        self.index.update_documents([make_node('/okm:root/Reports/Q1.doc', 'uuid-2', '1.0')], properties=False)
+        self.assertEqual(self.find(keywords=['sales']), ['uuid-1'])
+        self.assertEqual(self.find(name='q1'), ['uuid-2'])
+        self.index.remove('uuid-1')
+        self.assertEqual(self.find(name='annual'), ['uuid-3'])
+
+    def test_local_search_manager(self):
+        search = index.LocalSearchManager(self.index)
+        results = search.find_documents(name='annual', keywords=['emea'], text='northern')
+        self.assertEqual([record.uuid for record in results], ['uuid-1'])
+
+
 def get_content_for_upload():
     """
     Generates a file like object with random data and returns it in a form ready to be passed
@@ -0,0 +1,317 @@
+"""
+Bulk transfer of directory trees between the local file system and OpenKM
+"""
+import os
+import errno
+import json
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import bulk, client, facades, utils
+
+logger = logging.getLogger(__name__)
+
+
+class TransferResult(bulk.BulkSyncResult):
+    """
+    A BulkSyncResult that also counts the bytes transferred
+    """
+    def __init__(self):
+        super(TransferResult, self).__init__()
+        self.bytes = 0
+
+    def record(self, key, error=None, skipped=False, size=0):
+        super(TransferResult, self).record(key, error, skipped)
+        if error is None and not skipped:
+            self.bytes += size
+
+    @property
+    def megabytes_per_second(self):
+        return self.bytes / 1048576.0 / self.elapsed if self.elapsed else 0.0
+
+    def __unicode__(self):
+        return u"%s succeeded, %s skipped, %s failed, %.1f MB in %.1fs (%.2f files/s, %.2f MB/s)" % (
+            len(self.succeeded), len(self.skipped), len(self.failed), self.bytes / 1048576.0,
+            self.elapsed, self.rate, self.megabytes_per_second)
+
+
+class TransferManifest(object):
+    """
+    An append-only record of the files transferred so far, one JSON object per line,
+    so that an interrupted transfer can be resumed.  Later lines for a path win.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as manifest:
+                for line in manifest:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by an interruption
+                        continue
+                    self.entries[entry.pop('path')] = entry
+        self._file = open(path, 'a')
+
+    def get(self, path):
+        return self.entries.get(path)
+
+    def record(self, path, **entry):
+        line = json.dumps(dict(entry, path=path)) + '\n'
+        with self._lock:
+            self.entries[path] = entry
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class DirectoryImporter(object):
+    """
+    Uploads a local directory tree to an OpenKM folder, mirroring its folder structure.
+
+    Folders are created through facades.Taxonomy, which remembers the folders that
+    exist, and files are uploaded on a pool of worker threads, each with its own
+    web service client.  Every upload is recorded with its size, modification time
+    and sha1 in a manifest, so files that have not changed since they were last
+    imported are skipped; unchanged modification times skip them without reading.
+
+        importer = DirectoryImporter('/archive', '/okm:root/Archive', workers=8)
+        result = importer.execute()
+    """
+    MANIFEST_NAME = '.openkm_import'
+
+    def __init__(self, source, okm_path, workers=4, chunk_size=100, manifest=None, overwrite=False):
+        """
+        :param source: local directory
+        :param okm_path: OpenKM folder eg. '/okm:root/Archive'
+        :param workers: number of concurrent uploads
+        :param chunk_size: number of files queued for upload at a time
+        :param manifest: path of the manifest file, defaults to .openkm_import in source
+        :param overwrite: replace the content of documents that already exist on OpenKM
+        but are not in the manifest (they are skipped otherwise)
+        """
+        self.source = os.path.abspath(source)
+        self.okm_path = utils.remove_trailing_slash(okm_path)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.manifest_path = manifest or os.path.join(self.source, self.MANIFEST_NAME)
+        self.overwrite = overwrite
+        self.taxonomy = facades.Taxonomy()
+
+    def execute(self):
+        """
+        :returns TransferResult, keyed by OpenKM path
+        """
+        result = TransferResult()
+        self.manifest = TransferManifest(self.manifest_path)
+        pool = ThreadPool(self.workers)
+        try:
+            # the tree is walked in this thread, a chunk at a time, so memory use stays bounded
+            for chunk in utils.chunks(self.get_files(), self.chunk_size):
+                for okm_path, error, skipped, size in pool.map(self.upload, chunk):
+                    result.record(okm_path, error, skipped, size)
+                logger.info('Imported %s files: %s', result.processed, result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            self.manifest.close()
+            result.finish()
+        logger.info('Import finished: %s', result)
+        return result
+
+    def get_files(self):
+        """
+        Walks the source directory, making sure each folder exists on OpenKM before its files are yielded
+        :returns a generator of (local path, OpenKM path) tuples
+        """
+        for directory, folders, files in os.walk(self.source):
+            folders.sort()
+            relative = os.path.relpath(directory, self.source)
+            segments = [] if relative == os.curdir else relative.split(os.sep)
+            okm_folder = '/'.join([self.okm_path] + segments)
+            self.taxonomy.ensure_folder(okm_folder)
+            for name in sorted(files):
+                local_path = os.path.join(directory, name)
+                if local_path != self.manifest_path:
+                    yield local_path, '%s/%s' % (okm_folder, name)
+
+    def upload(self, paths):
+        """
+        :returns a tuple of (OpenKM path, error message or None, skipped, bytes uploaded)
+        """
+        local_path, okm_path = paths
+        try:
+            stat = os.stat(local_path)
+            entry = self.manifest.get(okm_path)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                return okm_path, None, True, 0
+
+            with open(local_path, 'rb') as file_obj:
+                content, checksum, size = utils.encode_file_for_transport(file_obj)
+            if entry and entry['sha1'] == checksum:
+                self.manifest.record(okm_path, size=size, mtime=stat.st_mtime, sha1=checksum)
+                return okm_path, None, True, 0
+
+            document_client = utils.thread_local_instance(client.Document)
+            if entry or self.overwrite:
+                if not self.update(document_client, okm_path, content):
+                    self.create(document_client, okm_path, content)
+            elif not self.create(document_client, okm_path, content):
+                return okm_path, None, True, 0
+
+            self.manifest.record(okm_path, size=size, mtime=stat.st_mtime, sha1=checksum)
+            return okm_path, None, False, size
+        except Exception, e:
+            logger.exception('Import of %s failed', local_path)
+            return okm_path, unicode(e) or e.__class__.__name__, False, 0
+
+    def create(self, document_client, okm_path, content):
+        """ :returns False if the document already exists """
+        document = document_client.new()
+        document.path = okm_path
+        try:
+            document_client.create(document, content)
+            return True
+        except Exception, e:
+            if facades.is_item_exists_exception(e):
+                return False
+            raise
+
+    def update(self, document_client, okm_path, content):
+        """ :returns False if the document does not exist """
+        if not utils.thread_local_instance(client.Repository).has_node(okm_path):
+            return False
+        document_client.checkout(okm_path)
+        try:
+            document_client.set_content(okm_path, content)
+            document_client.checkin(okm_path, comment='Imported')
+        except:
+            document_client.cancel_checkout(okm_path)
+            raise
+        return True
+
+
+class SubtreeExporter(object):
+    """
+    Mirrors an OpenKM folder to a local directory.
+
+    Folders are listed a level at a time with DirectoryListing.walk and documents
+    are downloaded concurrently, each decoded straight to disk.  The version of
+    every exported document is recorded in a manifest, so documents whose version
+    has not changed since they were last exported are skipped.  Keywords,
+    categories and property groups are written to a .metadata.json sidecar
+    file next to each document.
+
+        exporter = SubtreeExporter('/okm:root/Archive', '/backup', workers=8)
+        result = exporter.execute()
+    """
+    MANIFEST_NAME = '.openkm_export'
+    METADATA_SUFFIX = '.metadata.json'
+
+    def __init__(self, okm_path, destination, workers=4, chunk_size=100, manifest=None, metadata=True):
+        """
+        :param okm_path: OpenKM folder eg. '/okm:root/Archive'
+        :param destination: local directory
+        :param workers: number of concurrent downloads and folder listings
+        :param chunk_size: number of documents downloaded at a time
+        :param manifest: path of the manifest file, defaults to .openkm_export in destination
+        :param metadata: write sidecar metadata files
+        """
+        self.okm_path = utils.remove_trailing_slash(okm_path)
+        self.destination = os.path.abspath(destination)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.manifest_path = manifest or os.path.join(self.destination, self.MANIFEST_NAME)
+        self.metadata = metadata
+
+    def execute(self):
+        """
+        :returns TransferResult, keyed by OpenKM path
+        """
+        result = TransferResult()
+        if not os.path.isdir(self.destination):
+            os.makedirs(self.destination)
+        self.manifest = TransferManifest(self.manifest_path)
+        try:
+            for folder_path, documents in facades.DirectoryListing().walk(self.okm_path, self.workers):
+                for chunk in utils.chunks(documents, self.chunk_size):
+                    for okm_path, error, skipped, size in utils.concurrent_map(self.download, chunk, self.workers):
+                        result.record(okm_path, error, skipped, size)
+                logger.info('Exported %s: %s', folder_path, result)
+        finally:
+            self.manifest.close()
+            result.finish()
+        logger.info('Export finished: %s', result)
+        return result
+
+    def get_local_path(self, okm_path):
+        relative = okm_path[len(self.okm_path):].strip('/')
+        return os.path.join(self.destination, *relative.split('/'))
+
+    def get_version(self, document):
+        return getattr(getattr(document, 'actualVersion', None), 'name', None)
+
+    def download(self, document):
+        """
+        :returns a tuple of (OpenKM path, error message or None, skipped, bytes downloaded)
+        """
+        local_path = self.get_local_path(document.path)
+        version = self.get_version(document)
+        try:
+            entry = self.manifest.get(document.path)
+            if entry and version and entry['version'] == version and os.path.exists(local_path):
+                return document.path, None, True, 0
+
+            content = utils.thread_local_instance(client.Document).get_content(document.path)
+            make_directory(os.path.dirname(local_path))
+            # written under a temporary name so an interrupted download never looks complete
+            partial_path = local_path + '.part'
+            with open(partial_path, 'wb') as file_obj:
+                checksum, size = utils.decode_transport_to_file(content or '', file_obj)
+            os.rename(partial_path, local_path)
+
+            if self.metadata:
+                with open(local_path + self.METADATA_SUFFIX, 'w') as file_obj:
+                    json.dump(self.get_metadata(document), file_obj, indent=2, sort_keys=True)
+            self.manifest.record(document.path, version=version, size=size, sha1=checksum,
+                                 uuid=getattr(document, 'uuid', None))
+            return document.path, None, False, size
+        except Exception, e:
+            logger.exception('Export of %s failed', document.path)
+            return document.path, unicode(e) or e.__class__.__name__, False, 0
+
+    def get_metadata(self, document):
+        """
+        :returns a dict of the document's keywords, categories and property groups
+        """
+        property_group = utils.thread_local_instance(client.PropertyGroup)
+        properties = {}
+        for group in utils.get_array_items(property_group.get_groups(document.path)):
+            if hasattr(group, 'name'):
+                values = property_group.get_properties(document.path, group.name)
+                properties[group.name] = utils.suds_to_dict(utils.get_array_items(values))
+        return {
+            'uuid': getattr(document, 'uuid', None),
+            'path': document.path,
+            'version': self.get_version(document),
+            'keywords': list(getattr(document, 'keywords', None) or []),
+            'categories': [category.path for category in getattr(document, 'categories', None) or []],
+            'properties': properties,
+        }
+
+
+def make_directory(path):
+    """ Creates path and its parents, tolerating other threads creating them at the same time """
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
@@ -1,6 +1,11 @@
 import base64
+import datetime
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
 
 import suds
+import suds.sudsobject
 
 """
 Some useful helper and decorator functions
@@ -11,12 +16,54 @@ def make_file_java_byte_array_compatible(file_obj):
     :param file object
     :return string
     """
-    encoded_data = base64.b64encode(file_obj.read())
-    strg = ''
-    for i in xrange((len(encoded_data)/40)+1):
-        strg += encoded_data[i*40:(i+1)*40]
-        
-    return strg
+    return encode_file_for_transport(file_obj)[0]
+
+# a multiple of 3 bytes, so that each chunk encodes without base64 padding
+TRANSPORT_CHUNK_SIZE = 3 * 1024 * 64
+
+def encode_file_for_transport(file_obj, chunk_size=TRANSPORT_CHUNK_SIZE):
+    """
+    Base64 encodes a file chunk by chunk, hashing it on the way
+    :param file object
+    :return a tuple of (encoded string, sha1 hex digest of the content, size in bytes)
+    """
+    checksum = hashlib.sha1()
+    encoded = []
+    size = 0
+    remainder = ''
+    while True:
+        chunk = file_obj.read(chunk_size)
+        if not chunk:
+            break
+        checksum.update(chunk)
+        size += len(chunk)
+        # only whole 3 byte groups are encoded, in case of a short read
+        chunk = remainder + chunk
+        cut = len(chunk) - len(chunk) % 3
+        encoded.append(base64.b64encode(chunk[:cut]))
+        remainder = chunk[cut:]
+    encoded.append(base64.b64encode(remainder))
+    return ''.join(encoded), checksum.hexdigest(), size
+
+def decode_transport_to_file(content, file_obj, chunk_size=TRANSPORT_CHUNK_SIZE * 4 / 3):
+    """
+    Base64 decodes content received from OpenKM straight into a file, chunk by chunk
+    :param content: base64 encoded string
+    :param file_obj: file object opened for binary writing
+    :return a tuple of (sha1 hex digest of the content, size in bytes)
+    """
+    if any(char in content for char in '\r\n '):
+        content = ''.join(content.split())
+    checksum = hashlib.sha1()
+    size = 0
+    # a multiple of 4 characters decodes independently of its neighbours
+    chunk_size -= chunk_size % 4
+    for start in xrange(0, len(content), chunk_size):
+        data = base64.b64decode(content[start:start + chunk_size])
+        checksum.update(data)
+        file_obj.write(data)
+        size += len(data)
+    return checksum.hexdigest(), size
 
 def java_byte_array_to_binary(file_obj):
     """ 
@@ -52,6 +99,59 @@ def get_category_from_path(path):
     else:
         return parts[2:]
 
+def get_category_segments(path):
+    """
+    Splits a category folder path into its top level category and normalised leaf name
+    eg. '/okm:categories/Region/EMEA' returns ('Region', 'emea')
+    :param path: string
+    :return tuple (category, leaf), either of which may be None
+    """
+    parts = get_category_from_path(path or '/')
+    category = parts[0] if parts else None
+    leaf = normalise_category_leaf(parts[-1]) if len(parts) > 1 else None
+    return category, leaf
+
+def normalise_category_leaf(name):
+    """
+    Folds a category leaf name to the form stored in OpenKmFolderList.okm_name
+    """
+    return strip_runs_of_whitespace(name).lower()
+
+def path_hash(path):
+    """
+    Returns the hex sha1 of an OpenKM node path, used as an indexable stand-in for the path
+    :param path: string or None
+    :return string or None
+    """
+    if path is None:
+        return None
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return hashlib.sha1(path).hexdigest()
+
+def suds_to_dict(obj):
+    """
+    Recursively converts a SUDS object into JSON serialisable dicts and lists,
+    leaving out empty fields
+    :param obj: SUDS object, list or plain value
+    """
+    if isinstance(obj, suds.sudsobject.Object):
+        result = {}
+        for key, value in suds.sudsobject.items(obj):
+            value = suds_to_dict(value)
+            if value not in (None, [], {}):
+                result[key] = value
+        return result
+    if isinstance(obj, (list, tuple)):
+        return [suds_to_dict(item) for item in obj]
+    if isinstance(obj, dict):
+        return dict((key, suds_to_dict(value)) for key, value in obj.items())
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    if obj is None or isinstance(obj, (basestring, bool, int, long, float)):
+        return obj
+    return unicode(obj)
+
 def replace_dict_key(dict, old_key, new_key):
     """
     Renames a dictionary key, keeping the value intact, by creating a new key with the original value
@@ -89,3 +189,60 @@ def strip_runs_of_whitespace(_str):
     return ' '.join(_str.split())
 
 
+def get_array_items(array):
+    """
+    Returns the items of an array returned by the web services as a list, which is
+    empty when OpenKM returns no items
+    """
+    if not array:
+        return []
+    items = array[0]
+    return items if isinstance(items, list) else [items]
+
+def chunks(iterable, size):
+    """
+    Yields lists of up to size items from any iterable, without loading it all
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+_thread_local = threading.local()
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+def thread_local_instance(klass):
+    """
+    Returns an instance of klass shared by all callers on the current thread.
+    SUDS clients should not be shared between threads, so this lets worker threads
+    reuse a web service client (and its session) for every call they make
+    :param klass: class object, instantiated without arguments
+    """
+    instances = _thread_local.__dict__.setdefault('instances', {})
+    if klass not in instances:
+        instances[klass] = klass()
+    return instances[klass]
+
+def concurrent_map(function, items, workers=4):
+    """
+    Applies function to each item on a shared pool of worker threads and returns the
+    results in order.  The pool lives for the life of the process so that clients
+    created with thread_local_instance are reused between calls.
+    function must not itself call concurrent_map, as it could wait on its own pool
+    :param function: callable taking a single item
+    :param items: iterable
+    :param workers: int size of the pool
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return map(function, items)
+    with _thread_pools_lock:
+        if workers not in _thread_pools:
+            _thread_pools[workers] = ThreadPool(workers)
+        pool = _thread_pools[workers]
+    return pool.map(function, items)